@@ -0,0 +1,35 @@
+#!/bin/bash
+
+# メッシュごとのマッチング候補 (mesh_candidates) を更新するバッチスクリプト。
+# building_master, propertyid_master, full_id_master の変更をトリガーで記録したメッシュだけを作り直す。
+# --full を指定すると、すべてのメッシュの元データのハッシュ値を比べて、内容が変わったメッシュを作り直す
+# (トリガーがなかった間の変更も反映される)。
+# mesh_candidates は run_optional_steps.sh で作成しておくこと。
+
+# 実行方法
+# プロジェクトルートディレクトリ (docker-compose.yml がある) にて
+# bash app/refresh_mesh_candidates.sh [--full]
+
+# docker-compose.yml で指定している設定情報
+# この値を変更する場合は docker-compose.yml の変更が必要。
+PGHOST=${PGHOST:-localhost}
+PGPORT=${PGPORT:-5432}
+PGDB=${PGDB:-pgdb}
+PGUSER=${PGUSER:-pguser}
+PGPASS=${PGPASS:-pgpass}
+
+PSQL="psql postgresql://${PGUSER}:${PGPASS}@${PGHOST}:${PGPORT}/${PGDB}"
+
+FULL_REFRESH=false
+if [ "$1" == "--full" ]; then
+    FULL_REFRESH=true
+fi
+
+echo "処理開始: `date`"
+${PSQL} -v ON_ERROR_STOP=1 -c "SELECT * FROM refresh_mesh_candidates(${FULL_REFRESH});" -c "ANALYZE mesh_candidates;"
+if [ $? != 0 ]; then
+    echo -e "\e[31mNG\e[0m"
+    exit 1
+fi
+echo -e "\e[32mOK\e[0m"
+echo "処理終了: `date`"
@@ -70,6 +70,9 @@ WORK_DIR=${ROOT_DIR}/work
 JAGEOCODER_OUTPUT_DIR=${WORK_DIR}/jageocoder_output
 CUSTOM_JAGEOCODER_DIR=${WORK_DIR}/jageocoder_chiban
 
+# building_master_subdivided で、建物の領域を分割した1つの図形の最大頂点数
+SUBDIVIDE_MAX_VERTICES=${SUBDIVIDE_MAX_VERTICES:-256}
+
 # パラメータ設定 ここまで
 
 # =====================================================
@@ -278,6 +281,34 @@ ${PSQL} -f ${SQL_DIR}/07_update_building_master.sql >> ${LOGFILE}
 status_check
 echo -n "${DEFAULT}"
 
+step=`expr $step + 1`
+echo "[$step] 建物データに3次メッシュコードを付与する。"
+echo -n "${SKYBULE}"
+${PSQL} -f ${SQL_DIR}/10_create_mesh_code.sql >> ${LOGFILE}
+status_check
+echo -n "${DEFAULT}"
+
+step=`expr $step + 1`
+echo "[$step] 建物データに平面直角座標系での領域の面積を付与する。"
+echo -n "${SKYBULE}"
+${PSQL} -f ${SQL_DIR}/12_create_projected_area.sql >> ${LOGFILE}
+status_check
+echo -n "${DEFAULT}"
+
+step=`expr $step + 1`
+echo "[$step] 建物データの領域を分割したテーブル (building_master_subdivided) を作成する。"
+echo -n "${SKYBULE}"
+${PSQL} -v max_vertices=${SUBDIVIDE_MAX_VERTICES} -f ${SQL_DIR}/13_create_building_master_subdivided.sql >> ${LOGFILE}
+status_check
+echo -n "${DEFAULT}"
+
+step=`expr $step + 1`
+echo "[$step] 建物データの版数を更新する (古い版数のマッチング結果のキャッシュを削除する)。"
+echo -n "${SKYBULE}"
+${PSQL} -f ${SQL_DIR}/14_create_master_data_version.sql >> ${LOGFILE}
+status_check
+echo -n "${DEFAULT}"
+
 
 echo -e "---------------------------------\n8. 結果確認\n"
 step=1
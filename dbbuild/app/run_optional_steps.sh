@@ -71,6 +71,27 @@ ${PSQL} -f ${SQL_DIR}/08_create_master.sql >> ${LOGFILE}
 status_check
 echo -e -n "\e[0m"
 
+step=`expr $step + 1`
+echo "[$step] full_id_master に3次メッシュコードを付与。"
+echo -e -n "\e[36m"
+${PSQL} -f ${SQL_DIR}/10_create_mesh_code.sql >> ${LOGFILE}
+status_check
+echo -e -n "\e[0m"
+
+step=`expr $step + 1`
+echo "[$step] メッシュごとのマッチング候補 mesh_candidates を作成。"
+echo -e -n "\e[36m"
+${PSQL} -f ${SQL_DIR}/11_create_mesh_candidates.sql >> ${LOGFILE}
+status_check
+echo -e -n "\e[0m"
+
+step=`expr $step + 1`
+echo "[$step] 建物データの版数を更新 (full_id_master を作り直したため)。"
+echo -e -n "\e[36m"
+${PSQL} -f ${SQL_DIR}/14_create_master_data_version.sql >> ${LOGFILE}
+status_check
+echo -e -n "\e[0m"
+
 # A2. plateau_answer を作成
 step=`expr $step + 1`
 echo "[$step] plateau_answer を作成。"
@@ -79,6 +100,18 @@ ${PSQL} -f ${SQL_DIR}/09_plateau_matching.sql >> ${LOGFILE}
 status_check
 echo -e -n "\e[0m"
 
+# A3. 不動産ID確認システムのデータからマッチング用のテーブルを作成 (確認システムのデータがある場合)
+step=`expr $step + 1`
+echo "[$step] 不動産ID確認システムのマッチング用テーブルを作成。"
+echo -e -n "\e[36m"
+if [ "`${PSQL} -XAwt -c "SELECT to_regclass('fudosan_id_kakunin_system_build_grouped') IS NOT NULL"`" = "t" ]; then
+    ${PSQL} -f ${SQL_DIR}/15_create_confirmation_system_tables.sql >> ${LOGFILE}
+    status_check
+else
+    echo "不動産ID確認システムのデータがないため、作成しません。"
+fi
+echo -e -n "\e[0m"
+
 
 echo -e "---------------------------------\n完了しました。"
 echo "処理終了: `date`" >> ${LOGFILE}
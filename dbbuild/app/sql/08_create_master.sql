@@ -38,7 +38,9 @@ LEFT JOIN
 GROUP BY b.bldg_id;
 
 -- 建物データに土地不動産ID、個別不動産IDを追加したテーブルを作成する。
-DROP TABLE IF EXISTS full_id_master;
+-- mesh_candidates_source ビューと mesh_candidates を更新するトリガー (11_create_mesh_candidates.sql) も削除されるので、
+-- 11_create_mesh_candidates.sql を再実行すること。
+DROP TABLE IF EXISTS full_id_master CASCADE;
 CREATE TABLE full_id_master AS
 SELECT
   b.bldg_id,
@@ -83,3 +85,4 @@ LEFT JOIN tmp_kobetsu_id tk ON b.bldg_id=tk.bldg_id
 LEFT JOIN tmp_tochi_id tt ON b.bldg_id=tt.bldg_id;
 
 CREATE INDEX idx_full_id_master_geom ON full_id_master USING gist(geom);
+CREATE INDEX idx_full_id_master_bldg_id ON full_id_master (bldg_id);
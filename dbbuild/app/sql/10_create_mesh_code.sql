@@ -0,0 +1,70 @@
+-- 10_create_mesh_code.sql
+-- building_master と full_id_master に、建物の代表点を含む
+-- 3次メッシュ（基準地域メッシュ, JIS X 0410）のコード mesh_code を付与する。
+-- building_master には、領域の外接矩形と重なるすべての3次メッシュのコードの配列 mesh_codes も付与する。
+-- PLATEAU の CityGML はファイル名が3次メッシュコードなので、
+-- マッチング時に mesh_codes の GIN インデックスで候補を絞り込める
+-- （代表点のメッシュだけでは、複数のメッシュにまたがる大きな領域を取りこぼすため）。
+-- 何度実行してもよい（full_id_master を作り直した後にも実行する）。
+
+set client_min_messages = warning;
+
+-- 点を含む3次メッシュのコード（8桁）を返す関数
+-- 1次メッシュ: 緯度 40分 x 経度 1度、2次メッシュ: 1次を 8x8 分割、3次メッシュ: 2次を 10x10 分割
+CREATE OR REPLACE FUNCTION jis_mesh3_code(p geometry) RETURNS char(8) AS $$
+  SELECT
+    lpad(floor(lat15)::text, 2, '0')
+    || lpad((floor(lon) - 100)::text, 2, '0')
+    || floor((lat15 - floor(lat15)) * 8)::text
+    || floor((lon - floor(lon)) * 8)::text
+    || floor(((lat15 - floor(lat15)) * 8 - floor((lat15 - floor(lat15)) * 8)) * 10)::text
+    || floor(((lon - floor(lon)) * 8 - floor((lon - floor(lon)) * 8)) * 10)::text
+  FROM (SELECT ST_Y(p)::numeric * 1.5 AS lat15, ST_X(p)::numeric AS lon) AS c
+$$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE;
+
+-- 範囲（西端経度, 南端緯度, 東端経度, 北端緯度）と重なる3次メッシュのコードの配列を返す関数
+-- 3次メッシュは緯度 30秒 x 経度 45秒なので、南北に緯度 x 120、東西に経度 x 80 番目のメッシュとして数える
+CREATE OR REPLACE FUNCTION jis_mesh3_codes(west float8, south float8, east float8, north float8)
+RETURNS char(8)[] AS $$
+  SELECT array_agg(
+    (lpad((r / 80)::text, 2, '0')
+     || lpad((c / 80 - 100)::text, 2, '0')
+     || (r % 80 / 10)::text
+     || (c % 80 / 10)::text
+     || (r % 10)::text
+     || (c % 10)::text)::char(8)
+    ORDER BY r, c)
+  FROM generate_series(floor(south::numeric * 120)::integer, floor(north::numeric * 120)::integer) AS r,
+       generate_series(floor(west::numeric * 80)::integer, floor(east::numeric * 80)::integer) AS c
+$$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE;
+
+-- 図形の外接矩形と重なる3次メッシュのコードの配列を返す関数
+CREATE OR REPLACE FUNCTION jis_mesh3_codes(p geometry) RETURNS char(8)[] AS $$
+  SELECT jis_mesh3_codes(ST_XMin(p), ST_YMin(p), ST_XMax(p), ST_YMax(p))
+$$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE;
+
+-- 建物データ
+-- 代表点は領域上の点 (ST_PointOnSurface) とし、領域がない場合は所在地の代表点を使う
+ALTER TABLE building_master ADD COLUMN IF NOT EXISTS mesh_code char(8);
+ALTER TABLE building_master ADD COLUMN IF NOT EXISTS mesh_codes char(8)[];
+UPDATE building_master
+SET mesh_code = jis_mesh3_code(COALESCE(ST_PointOnSurface(region), center)),
+    mesh_codes = jis_mesh3_codes(COALESCE(region, center));
+CREATE INDEX IF NOT EXISTS idx_building_master_mesh_code ON building_master (mesh_code);
+CREATE INDEX IF NOT EXISTS idx_building_master_mesh_codes ON building_master USING gin (mesh_codes);
+ANALYZE building_master;
+
+-- 建物データに土地不動産ID、個別不動産IDを追加したテーブル（オプション手順で作成した場合のみ）
+DO $$
+BEGIN
+  IF to_regclass('public.full_id_master') IS NOT NULL THEN
+    ALTER TABLE full_id_master ADD COLUMN IF NOT EXISTS mesh_code char(8);
+    UPDATE full_id_master f
+    SET mesh_code = b.mesh_code
+    FROM building_master b
+    WHERE f.bldg_id = b.bldg_id;
+    CREATE INDEX IF NOT EXISTS idx_full_id_master_mesh_code ON full_id_master (mesh_code);
+    ANALYZE full_id_master;
+  END IF;
+END
+$$;
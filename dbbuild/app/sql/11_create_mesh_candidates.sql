@@ -0,0 +1,239 @@
+-- 11_create_mesh_candidates.sql
+-- PLATEAU 建物とのマッチングで使う建物データ (building_master, propertyid_master,
+-- full_id_master の結合結果) を、3次メッシュごとに mesh_candidates テーブルに展開する。
+-- マッチング処理はこのテーブルを mesh_code で読むだけで候補を取得できる。
+-- 10_create_mesh_code.sql の後に実行すること。
+--
+-- 元データのテーブルのトリガーで変更のあったメッシュを mesh_candidates_dirty に記録し、
+-- SELECT * FROM refresh_mesh_candidates(); では記録されたメッシュだけを作り直す。
+-- 元データのテーブルを作り直すとトリガーもなくなるので、その後はこのファイルを再実行すること
+-- （すべてのメッシュの元データのハッシュ値を比べて、変わったメッシュだけを作り直す）。
+
+set client_min_messages = warning;
+
+-- propertyid_master を建物IDで引くためのインデックス
+CREATE INDEX IF NOT EXISTS idx_propertyid_master_bldg_id ON propertyid_master (bldg_id);
+
+-- マッチング候補の元データ
+-- propertyid_master との結合で建物が不動産IDの数だけ重複するので、
+-- その件数を propertyid_count に持ち、マッチング時に展開する
+-- (件数は建物ごとに数え、一部のメッシュだけを読むときに propertyid_master 全体を集計しないようにする)
+CREATE OR REPLACE VIEW mesh_candidates_source AS
+SELECT
+  bm.mesh_code,
+  bm.bldg_id,
+  fim.tatemono_id,
+  fim.tochi_id,
+  fim.kobetsu_id,
+  bm.bunrui,
+  bm.n_touki,
+  bm.floor_space,
+  bm.structure_code,
+  bm.floors,
+  bm.floors_below_ground,
+  bm.usage_code,
+  bm.construction_year,
+  pm.propertyid_count,
+  bm.region,
+  bm.mesh_codes
+FROM building_master bm
+CROSS JOIN LATERAL (
+  SELECT COUNT(*)::integer AS propertyid_count
+  FROM propertyid_master p
+  WHERE p.bldg_id = bm.bldg_id
+) pm
+JOIN full_id_master fim ON fim.bldg_id = bm.bldg_id
+WHERE bm.mesh_code IS NOT NULL AND pm.propertyid_count > 0;
+
+-- メッシュごとのマッチング候補
+-- 候補は代表点のメッシュ (mesh_code) ごとに作り直し、マッチングでは
+-- 領域の外接矩形と重なるメッシュ (mesh_codes) の GIN インデックスで絞り込む
+CREATE TABLE IF NOT EXISTS mesh_candidates (
+  mesh_code char(8) NOT NULL,
+  bldg_id VARCHAR(18) NOT NULL,
+  tatemono_id VARCHAR(18),
+  tochi_id TEXT,
+  kobetsu_id TEXT,
+  bunrui VARCHAR(8),
+  n_touki SMALLINT,
+  floor_space REAL,
+  structure_code SMALLINT,
+  floors SMALLINT,
+  floors_below_ground SMALLINT,
+  usage_code SMALLINT,
+  construction_year SMALLINT,
+  propertyid_count INTEGER NOT NULL,
+  region GEOMETRY(MultiPolygon,4326),
+  mesh_codes char(8)[]
+);
+-- mesh_codes がない以前のテーブルには列を追加する
+-- (元データのハッシュ値が変わるので、次の refresh_mesh_candidates() ですべてのメッシュを作り直す)
+ALTER TABLE mesh_candidates ADD COLUMN IF NOT EXISTS mesh_codes char(8)[];
+CREATE INDEX IF NOT EXISTS idx_mesh_candidates_mesh_code ON mesh_candidates (mesh_code);
+CREATE INDEX IF NOT EXISTS idx_mesh_candidates_mesh_codes ON mesh_candidates USING gin (mesh_codes);
+CREATE INDEX IF NOT EXISTS idx_mesh_candidates_region ON mesh_candidates USING gist(region);
+
+-- メッシュごとの元データのハッシュ値
+CREATE TABLE IF NOT EXISTS mesh_candidates_state (
+  mesh_code char(8) PRIMARY KEY,
+  source_hash char(32) NOT NULL,
+  n_candidates INTEGER NOT NULL,
+  refreshed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+
+-- 元データに変更のあったメッシュ
+CREATE TABLE IF NOT EXISTS mesh_candidates_dirty (
+  mesh_code char(8) PRIMARY KEY
+);
+
+-- 元データのテーブルの変更 (文単位) で、変更のあった建物のメッシュを mesh_candidates_dirty に記録する
+-- propertyid_master, full_id_master は建物IDから building_master のメッシュを引く
+CREATE OR REPLACE FUNCTION mark_mesh_candidates_dirty()
+RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'TRUNCATE' THEN
+    -- 削除された行はわからないので、候補のあるメッシュをすべて作り直す
+    -- (新しい行のメッシュは、続く INSERT のトリガーで記録される)
+    INSERT INTO mesh_candidates_dirty (mesh_code)
+    SELECT st.mesh_code FROM mesh_candidates_state st
+    ON CONFLICT DO NOTHING;
+  ELSIF TG_TABLE_NAME = 'building_master' THEN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+      INSERT INTO mesh_candidates_dirty (mesh_code)
+      SELECT DISTINCT o.mesh_code FROM old_rows o WHERE o.mesh_code IS NOT NULL
+      ON CONFLICT DO NOTHING;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+      INSERT INTO mesh_candidates_dirty (mesh_code)
+      SELECT DISTINCT n.mesh_code FROM new_rows n WHERE n.mesh_code IS NOT NULL
+      ON CONFLICT DO NOTHING;
+    END IF;
+  ELSE
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+      INSERT INTO mesh_candidates_dirty (mesh_code)
+      SELECT DISTINCT bm.mesh_code
+      FROM old_rows o JOIN building_master bm ON bm.bldg_id = o.bldg_id
+      WHERE bm.mesh_code IS NOT NULL
+      ON CONFLICT DO NOTHING;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+      INSERT INTO mesh_candidates_dirty (mesh_code)
+      SELECT DISTINCT bm.mesh_code
+      FROM new_rows n JOIN building_master bm ON bm.bldg_id = n.bldg_id
+      WHERE bm.mesh_code IS NOT NULL
+      ON CONFLICT DO NOTHING;
+    END IF;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 遷移テーブルを使うトリガーは1つのイベントにしか指定できないので、イベントごとに作成する
+DO $$
+DECLARE
+  t text;
+BEGIN
+  FOREACH t IN ARRAY ARRAY['building_master', 'propertyid_master', 'full_id_master'] LOOP
+    EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', t || '_mesh_dirty_insert', t);
+    EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', t || '_mesh_dirty_update', t);
+    EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', t || '_mesh_dirty_delete', t);
+    EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', t || '_mesh_dirty_truncate', t);
+    EXECUTE format('CREATE TRIGGER %I AFTER INSERT ON %I REFERENCING NEW TABLE AS new_rows '
+                   'FOR EACH STATEMENT EXECUTE FUNCTION mark_mesh_candidates_dirty()', t || '_mesh_dirty_insert', t);
+    EXECUTE format('CREATE TRIGGER %I AFTER UPDATE ON %I REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows '
+                   'FOR EACH STATEMENT EXECUTE FUNCTION mark_mesh_candidates_dirty()', t || '_mesh_dirty_update', t);
+    EXECUTE format('CREATE TRIGGER %I AFTER DELETE ON %I REFERENCING OLD TABLE AS old_rows '
+                   'FOR EACH STATEMENT EXECUTE FUNCTION mark_mesh_candidates_dirty()', t || '_mesh_dirty_delete', t);
+    EXECUTE format('CREATE TRIGGER %I AFTER TRUNCATE ON %I '
+                   'FOR EACH STATEMENT EXECUTE FUNCTION mark_mesh_candidates_dirty()', t || '_mesh_dirty_truncate', t);
+  END LOOP;
+END
+$$;
+
+-- 記録されたメッシュ (full_refresh が true の場合はすべてのメッシュ) の元データのハッシュ値を比べ、
+-- 元データが変わったメッシュ、なくなったメッシュの候補を作り直して件数を返す
+-- 以前の引数のない関数があると呼び出しがあいまいになるので削除する
+DROP FUNCTION IF EXISTS refresh_mesh_candidates();
+CREATE OR REPLACE FUNCTION refresh_mesh_candidates(full_refresh boolean DEFAULT false)
+RETURNS TABLE (changed_meshes bigint, removed_meshes bigint, inserted_candidates bigint) AS $$
+BEGIN
+  -- 作り直している間に記録されたメッシュを取りこぼさないよう、元データの変更はこの関数の終了まで待たせる
+  LOCK TABLE mesh_candidates_dirty IN EXCLUSIVE MODE;
+
+  DROP TABLE IF EXISTS tmp_mesh_target;
+  IF full_refresh THEN
+    CREATE TEMPORARY TABLE tmp_mesh_target AS
+    SELECT bm.mesh_code FROM building_master bm WHERE bm.mesh_code IS NOT NULL
+    UNION
+    SELECT st.mesh_code FROM mesh_candidates_state st;
+  ELSE
+    CREATE TEMPORARY TABLE tmp_mesh_target AS
+    SELECT d.mesh_code FROM mesh_candidates_dirty d;
+  END IF;
+  DELETE FROM mesh_candidates_dirty;
+  ANALYZE tmp_mesh_target;
+
+  DROP TABLE IF EXISTS tmp_mesh_hash;
+  CREATE TEMPORARY TABLE tmp_mesh_hash AS
+  SELECT
+    s.mesh_code,
+    md5(string_agg(s::text, '|' ORDER BY s.bldg_id)) AS source_hash,
+    COUNT(*)::integer AS n_candidates
+  FROM mesh_candidates_source s
+  WHERE s.mesh_code IN (SELECT t.mesh_code FROM tmp_mesh_target t)
+  GROUP BY s.mesh_code;
+
+  DROP TABLE IF EXISTS tmp_mesh_changed;
+  CREATE TEMPORARY TABLE tmp_mesh_changed AS
+  SELECT h.mesh_code
+  FROM tmp_mesh_hash h
+  LEFT JOIN mesh_candidates_state st ON st.mesh_code = h.mesh_code
+  WHERE st.source_hash IS DISTINCT FROM h.source_hash;
+
+  DROP TABLE IF EXISTS tmp_mesh_removed;
+  CREATE TEMPORARY TABLE tmp_mesh_removed AS
+  SELECT st.mesh_code
+  FROM mesh_candidates_state st
+  JOIN tmp_mesh_target t ON t.mesh_code = st.mesh_code
+  WHERE NOT EXISTS (SELECT 1 FROM tmp_mesh_hash h WHERE h.mesh_code = st.mesh_code);
+
+  DELETE FROM mesh_candidates mc
+  WHERE mc.mesh_code IN (
+    SELECT c.mesh_code FROM tmp_mesh_changed c
+    UNION ALL
+    SELECT r.mesh_code FROM tmp_mesh_removed r);
+
+  INSERT INTO mesh_candidates
+  SELECT s.*
+  FROM mesh_candidates_source s
+  JOIN tmp_mesh_changed c ON c.mesh_code = s.mesh_code;
+
+  INSERT INTO mesh_candidates_state (mesh_code, source_hash, n_candidates)
+  SELECT h.mesh_code, h.source_hash, h.n_candidates
+  FROM tmp_mesh_hash h
+  JOIN tmp_mesh_changed c ON c.mesh_code = h.mesh_code
+  ON CONFLICT (mesh_code) DO UPDATE
+  SET source_hash = EXCLUDED.source_hash,
+      n_candidates = EXCLUDED.n_candidates,
+      refreshed_at = now();
+
+  DELETE FROM mesh_candidates_state st
+  WHERE st.mesh_code IN (SELECT r.mesh_code FROM tmp_mesh_removed r);
+
+  RETURN QUERY
+  SELECT
+    (SELECT COUNT(*) FROM tmp_mesh_changed),
+    (SELECT COUNT(*) FROM tmp_mesh_removed),
+    (SELECT COALESCE(SUM(h.n_candidates), 0)::bigint
+     FROM tmp_mesh_hash h JOIN tmp_mesh_changed c ON c.mesh_code = h.mesh_code);
+
+  DROP TABLE tmp_mesh_target;
+  DROP TABLE tmp_mesh_hash;
+  DROP TABLE tmp_mesh_changed;
+  DROP TABLE tmp_mesh_removed;
+END;
+$$ LANGUAGE plpgsql;
+
+-- トリガーがなかった間の変更は記録されていないので、すべてのメッシュを比べる
+SELECT * FROM refresh_mesh_candidates(true);
+ANALYZE mesh_candidates;
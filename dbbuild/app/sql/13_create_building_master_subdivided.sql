@@ -0,0 +1,34 @@
+-- 13_create_building_master_subdivided.sql
+-- building_master の領域 (筆ポリゴンの ST_UNION) を ST_Subdivide で小さな図形に分割した
+-- building_master_subdivided テーブルを作成する。
+-- 大きな区分建物の敷地や農地では領域の頂点数が数千になり、外接矩形も大きくなるため、
+-- マッチング処理で GiST インデックスの誤検出が増え、ST_Intersects も遅くなる。
+-- 分割した図形は外接矩形が小さく頂点数も少ないので、交差判定を速く行える。
+-- 10_create_mesh_code.sql の後に実行すること。
+--
+-- 1つの図形の最大頂点数は psql の変数 max_vertices で指定する（省略時は 256）。
+--   psql -v max_vertices=128 -f 13_create_building_master_subdivided.sql
+
+set client_min_messages = warning;
+
+\if :{?max_vertices}
+\else
+\set max_vertices 256
+\endif
+
+-- mesh_codes は分割した図形ごとの外接矩形と重なる3次メッシュのコード（10_create_mesh_code.sql の jis_mesh3_codes）
+DROP TABLE IF EXISTS building_master_subdivided;
+CREATE TABLE building_master_subdivided AS
+SELECT
+  s.bldg_id,
+  jis_mesh3_codes(s.geom) AS mesh_codes,
+  s.geom
+FROM (
+  SELECT b.bldg_id, ST_Subdivide(b.region, :max_vertices) AS geom
+  FROM building_master b
+  WHERE b.region IS NOT NULL
+) s;
+
+CREATE INDEX idx_building_master_subdivided_geom ON building_master_subdivided USING gist(geom);
+CREATE INDEX idx_building_master_subdivided_mesh_codes ON building_master_subdivided USING gin (mesh_codes);
+ANALYZE building_master_subdivided;
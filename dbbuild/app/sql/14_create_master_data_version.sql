@@ -0,0 +1,26 @@
+-- 14_create_master_data_version.sql
+-- 建物データ (building_master, propertyid_master, full_id_master) の版数を master_data_version に記録する。
+-- matching/batch のマッチング結果のキャッシュ (match_cache) は版数ごとに保持するので、
+-- 建物データを作り直したときは、最後にこのファイルを実行して版数を更新すること。
+-- 古い版数のキャッシュは削除する。
+
+set client_min_messages = warning;
+
+CREATE TABLE IF NOT EXISTS master_data_version (
+  version char(32) NOT NULL,
+  built_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+
+TRUNCATE master_data_version;
+INSERT INTO master_data_version (version)
+VALUES (md5(clock_timestamp()::text || random()::text));
+
+-- match_cache.cache_version は「版数:面積の計算方法」
+DO $$
+BEGIN
+  IF to_regclass('match_cache') IS NOT NULL THEN
+    DELETE FROM match_cache c
+    WHERE split_part(c.cache_version, ':', 1) <> (SELECT v.version FROM master_data_version v);
+  END IF;
+END
+$$;
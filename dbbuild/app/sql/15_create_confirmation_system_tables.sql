@@ -0,0 +1,46 @@
+-- 15_create_confirmation_system_tables.sql
+-- 不動産ID確認システムのデータ (fudosan_id_kakunin_system_build_grouped, fudosan_id_kakunin_system_build,
+-- fudosan_id_kakunin_system_build_check) から、matching/batch の確認システムでのマッチング
+-- (USE_ESTATE_ID_CONFIRMATION_SYSTEM=1) で使う、インデックス付きのテーブルを作成する。
+--
+-- fudosan_id_kakunin_system_candidates: マッチングの候補
+--   不動産ID数が1件の建物だけを、建物の分類 (bunrui) と領域の面積 (geom_area) を付けて保持する。
+--   面積は ST_Area(geometry) で、マッチング処理の重なりの割合・面積の比の計算と同じ単位。
+-- fudosan_id_kakunin_system_land: 建物の不動産ID (18桁) ごとの土地不動産IDと筆の領域
+--   マッチング後に土地不動産IDを設定する UPDATE で、ファイルごとに SELECT DISTINCT しないようにする。
+--
+-- 確認システムのデータを読み込み直したら、このファイルを実行すること。何度実行してもよい。
+
+set client_min_messages = warning;
+
+BEGIN;
+
+DROP TABLE IF EXISTS fudosan_id_kakunin_system_candidates;
+CREATE TABLE fudosan_id_kakunin_system_candidates AS
+SELECT
+  h.不動産IDリスト AS fudosan_id,
+  b.bunrui,
+  h.geom,
+  ST_Area(h.geom) AS geom_area
+FROM fudosan_id_kakunin_system_build_grouped h
+LEFT JOIN fudosan_id_kakunin_system_build b ON h.最小不動産番号 = b.fudosan_bango
+WHERE h.不動産ID数 = 1;
+
+CREATE INDEX idx_fudosan_id_kakunin_system_candidates_geom
+  ON fudosan_id_kakunin_system_candidates USING gist (geom);
+
+DROP TABLE IF EXISTS fudosan_id_kakunin_system_land;
+CREATE TABLE fudosan_id_kakunin_system_land AS
+SELECT DISTINCT
+  fudosan_id, tochi_id, fude_geom
+FROM fudosan_id_kakunin_system_build_check
+WHERE rate > 0
+AND tochi_id IS NOT NULL;
+
+CREATE INDEX idx_fudosan_id_kakunin_system_land_fudosan_id
+  ON fudosan_id_kakunin_system_land (fudosan_id);
+
+COMMIT;
+
+ANALYZE fudosan_id_kakunin_system_candidates;
+ANALYZE fudosan_id_kakunin_system_land;
@@ -0,0 +1,77 @@
+"""
+add_estate_id_to_gml の不動産ID付与処理 (gml_output.write_enriched_gml, splice_enriched_gml) のベンチマーク。
+
+建物数を変えた合成 CityGML に対して付与処理の時間を計測し、
+建物1件あたりの処理時間が建物数によらずほぼ一定 (線形スケール) であることを確認する。
+--modes に pretty (write_enriched_gml) と splice (splice_enriched_gml) を指定して比較できる。
+
+実行方法:
+    python bench/bench_enrichment.py [--counts 1000 2000 4000 8000 16000] [--modes pretty splice]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from lxml import etree  # noqa: E402
+
+from gml_output import splice_enriched_gml, write_enriched_gml  # noqa: E402
+from synthetic_citygml import write_citygml  # noqa: E402
+
+
+def make_enrich(rows_by_gml_id: dict):
+    """main.add_estate_id_to_gml と同じ辞書引きで属性を付与する関数を作る"""
+    def enrich(building: etree._Element, uro_uri: str) -> bool:
+        record = rows_by_gml_id.get(building.get('{http://www.opengis.net/gml}id'))
+        if record is None:
+            return False
+        element = etree.SubElement(building, etree.QName(uro_uri, "bldgRealEstateIDAttribute"))
+        sub = etree.SubElement(element, etree.QName(uro_uri, "RealEstateIDAttribute"))
+        etree.SubElement(sub, etree.QName(uro_uri, "realEstateIDOfBuilding")).text = record[1]
+        return True
+    return enrich
+
+
+def make_attributes(rows_by_gml_id: dict):
+    """main.add_estate_id_to_gml と同じ辞書引きで、splice_enriched_gml に渡す属性のリストを返す関数を作る"""
+    def attributes(gml_id: str):
+        record = rows_by_gml_id.get(gml_id)
+        if record is None:
+            return None
+        return [{"name": "realEstateIDOfBuilding", "type": "string", "value": record[1]}]
+    return attributes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--counts", type=int, nargs="+", default=[1000, 2000, 4000, 8000, 16000])
+    parser.add_argument("--match-rate", type=float, default=0.8, help="マッチング結果を持つ建物の割合")
+    parser.add_argument("--modes", nargs="+", choices=("pretty", "splice"), default=["pretty"])
+    args = parser.parse_args()
+
+    print(f"{'mode':>8} {'buildings':>10} {'matched':>10} {'seconds':>10} {'us/building':>12}")
+    with tempfile.TemporaryDirectory() as work_dir:
+        src = os.path.join(work_dir, "input.gml")
+        dst = os.path.join(work_dir, "output.gml")
+        for count in args.counts:
+            write_citygml(src, count)
+            rows = {
+                f"bldg_{i:08d}": (f"bldg_{i:08d}", f"{i:013d}-0000")
+                for i in range(int(count * args.match_rate))
+            }
+            for mode in args.modes:
+                start = time.perf_counter()
+                if mode == "splice":
+                    matched = splice_enriched_gml(src, dst, "https://www.geospatial.jp/iur/uro/3.0",
+                                                  make_attributes(rows))
+                else:
+                    matched = write_enriched_gml(src, dst, "https://www.geospatial.jp/iur/uro/3.0", make_enrich(rows))
+                elapsed = time.perf_counter() - start
+                print(f"{mode:>8} {count:>10} {matched:>10} {elapsed:>10.3f} {elapsed / count * 1e6:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
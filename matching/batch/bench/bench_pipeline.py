@@ -0,0 +1,493 @@
+"""
+マッチング処理全体 (src/main.py) を合成データで実行するエンドツーエンドのベンチマーク。
+
+合成 CityGML (lod0RoofEdge / lod0FootPrint, appearance, uro の属性) と、その建物に対応する合成の
+building_master, propertyid_master, full_id_master をベンチマーク用のデータベースに作成し、
+S3 と SES をスタブに置き換えて main.main() を実行する。
+建物数ごとにスループット (建物/秒) と段階ごとの計測値 (metrics.summarize) を表示し、
+結果を JSON (ベースライン) に保存する。--baseline に以前の結果を指定すると、処理時間の比を表示する。
+
+データベースの建物データ (building_master など) は削除して作り直すので、
+bench/docker-compose.yml のベンチマーク用の PostGIS コンテナで実行すること
+(データベース名が bench で終わらない場合は --force を指定しない限り実行しない)。
+dbbuild の 01, 10〜14 の SQL を psql で実行するので、psql が必要。
+
+実行方法:
+    docker compose -f bench/docker-compose.yml up -d postgis_bench
+    docker compose -f bench/docker-compose.yml run --rm bench \\
+        python bench/bench_pipeline.py [--counts 1000 10000 100000] [--workers 4] [--baseline bench/results/xxx.json]
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from synthetic_citygml import ORIGIN, PITCH, SIZE, building_square, grid_columns, write_citygml  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DBBUILD_SQL_DIR = os.path.join(BENCH_DIR, "..", "..", "..", "dbbuild", "app", "sql")
+
+# main.py はインポート時に入力ディレクトリを環境変数から決めるので、インポートの前に設定する
+BENCH_ENV = {
+    "ESTATE_ID_USER_ID": "bench",
+    "ESTATE_ID_SESSION_ID": "bench",
+    "USE_ESTATE_ID_CONFIRMATION_SYSTEM": "0",
+    # S3 へのマルチパートアップロードの経路を計測するため、IAM モード (スタブの S3 に書き込む) で実行する
+    "NO_USE_IAM_MODE": "0",
+    "BUCKET_NAME": "bench",
+}
+for _key, _value in BENCH_ENV.items():
+    os.environ.setdefault(_key, _value)
+
+import db  # noqa: E402
+import main  # noqa: E402
+import metrics  # noqa: E402
+import s3_transfer  # noqa: E402
+
+# building_master の合成データの bldg_id, 区分所有建物の個別不動産の不動産番号, 土地の不動産番号の起点
+BLDG_ID_BASE = 5000000000000
+KOBETSU_BANGO_BASE = 6000000000000
+TOCHI_BANGO_BASE = 7000000000000
+
+BUILDING_MASTER_COLUMNS = (
+    "bldg_id", "tatemono_id", "n_touki", "n_kyotaku", "bunrui", "shozai_oyobi_chiban", "shikuchoson_code",
+    "floors", "floors_below_ground", "floor_space", "total_floor_space", "usage_code", "structure_code",
+    "construction_year", "region", "center",
+)
+PROPERTYID_MASTER_COLUMNS = ("fudosan_id", "fudosan_bango", "bldg_id", "bldg_number", "room_number")
+
+# 08_create_master.sql と同じ列の full_id_master を合成データから作成する
+# (土地不動産IDは建物ごとに1件の合成値とする)
+FULL_ID_MASTER_SQL = """
+DROP TABLE IF EXISTS full_id_master CASCADE;
+CREATE TABLE full_id_master AS
+SELECT
+  b.bldg_id,
+  b.tatemono_id,
+  b.n_touki,
+  b.n_kyotaku,
+  b.bunrui,
+  b.shozai_oyobi_chiban,
+  b.shikuchoson_code,
+  b.machiaza_id,
+  b.kaoku_bango,
+  b.shurui,
+  b.kousei_zairyo,
+  b.yane_no_shurui,
+  b.yuka_menseki,
+  b.kaisuu,
+  b.gennin_oyobi_sonohiduke_shudearutatemono_no_hyouji,
+  b.fuzoku_tatemono_umu,
+  b.address_level,
+  b.fude_status,
+  b.floors,
+  b.floors_below_ground,
+  b.floor_space,
+  b.total_floor_space,
+  b.usage_code,
+  b.structure_code,
+  b.construction_year,
+  concat((b.bldg_id::bigint - %(bldg_id_base)s + %(tochi_bango_base)s)::text, '-0000') AS tochi_id,
+  1::bigint AS tochi_id_count,
+  CASE
+    WHEN b.bunrui = '区建' THEN tk.kobetsu_id
+    ELSE NULL
+  END AS kobetsu_id,
+  CASE
+    WHEN b.bunrui = '区建' THEN tk.kobetsu_id_count
+    ELSE 0
+  END AS kobetsu_id_count,
+  tk.bldg_number AS bldg_number,
+  b.region as geom
+FROM building_master b
+LEFT JOIN (
+  SELECT
+    p.bldg_id,
+    COUNT(p.fudosan_id) AS kobetsu_id_count,
+    STRING_AGG(p.fudosan_id, ',' ORDER BY p.fudosan_id) AS kobetsu_id,
+    MIN(p.bldg_number) AS bldg_number
+  FROM propertyid_master p
+  GROUP BY p.bldg_id
+) tk ON b.bldg_id = tk.bldg_id;
+
+CREATE INDEX idx_full_id_master_geom ON full_id_master USING gist(geom);
+CREATE INDEX idx_full_id_master_bldg_id ON full_id_master (bldg_id);
+"""
+
+
+class LocalS3Client:
+    """
+    s3_transfer と main.py が使う S3 クライアントの操作を、ローカルディレクトリ root で置き換えるスタブ。
+    バケット bucket のキー key は root/bucket/key のファイルになる。
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def _path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, bucket, key)
+
+    def get_paginator(self, name: str):
+        assert name == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket: str, Prefix: str):
+        base = self._path(Bucket, "")
+        contents = []
+        for dir_path, _, names in os.walk(self._path(Bucket, os.path.dirname(Prefix))):
+            for name in names:
+                key = os.path.relpath(os.path.join(dir_path, name), base)
+                if key.startswith(Prefix):
+                    contents.append({'Key': key})
+        yield {'Contents': sorted(contents, key=lambda obj: obj['Key'])}
+
+    def download_file(self, Bucket: str, Key: str, Filename: str, Config=None):
+        shutil.copyfile(self._path(Bucket, Key), Filename)
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, **kwargs):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body)
+        return {}
+
+    def create_multipart_upload(self, Bucket: str, Key: str):
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body: bytes):
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict):
+        with self.lock:
+            parts = self.uploads.pop(UploadId)
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            for part in MultipartUpload['Parts']:
+                f.write(parts[part['PartNumber']])
+        return {}
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str):
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+
+def layout(count: int, per_file: int) -> list:
+    """
+    count 件の建物を per_file 件ずつのファイルに分けた配置 [(ファイル名, 先頭の建物番号, 建物数, 原点)] を返す。
+    ファイルは東西方向に並べ、同じ建物番号の建物は count によらず同じ位置になる
+    """
+    columns = grid_columns(per_file)
+    files = []
+    for number, first_index in enumerate(range(0, count, per_file)):
+        origin = (ORIGIN[0], ORIGIN[1] + number * (columns + 2) * PITCH)
+        files.append((f"synthetic_{number:04d}.gml", first_index, min(per_file, count - first_index), origin))
+    return files
+
+
+def lod0_type_of(number: int, lod0_type: str) -> str:
+    """number 番目のファイルの lod0 の種類 (both の場合は交互にする)"""
+    if lod0_type != "both":
+        return lod0_type
+    return ("lod0RoofEdge", "lod0FootPrint")[number % 2]
+
+
+def master_rows(count: int, per_file: int, match_rate: float, kubun_rate: float, seed: int):
+    """合成の building_master, propertyid_master の行 (COPY のテキスト形式) を返す"""
+    rng = random.Random(seed)
+    columns = grid_columns(per_file)
+    buildings = io.StringIO()
+    properties = io.StringIO()
+    for _, first_index, n, origin in layout(count, per_file):
+        for offset in range(n):
+            if rng.random() >= match_rate:
+                continue
+            index = first_index + offset
+            bldg_id = str(BLDG_ID_BASE + index)
+            # CityGML の建物から少しずらした領域にして、重なりの割合を1未満にする
+            shift_lat, shift_lon = rng.uniform(-0.2, 0.2) * SIZE, rng.uniform(-0.2, 0.2) * SIZE
+            ring = ",".join(f"{lon + shift_lon:.7f} {lat + shift_lat:.7f}"
+                            for lat, lon in building_square(offset, columns, origin))
+            lat0, lon0 = building_square(offset, columns, origin)[0]
+            kubun = rng.random() < kubun_rate
+            n_touki = rng.randint(2, 8) if kubun else 1
+            floors = rng.randint(1, 10)
+            floor_space = rng.uniform(40, 200)
+            buildings.write("\t".join((
+                bldg_id,
+                f"{TOCHI_BANGO_BASE + index}-000B" if kubun else f"{bldg_id}-0000",
+                str(n_touki),
+                str(n_touki),
+                "区建" if kubun else "主建",
+                f"合成{index}番",
+                "38201",
+                str(floors),
+                "0",
+                f"{floor_space:.2f}",
+                f"{floor_space * floors:.2f}",
+                str(rng.choice((401, 411, 412, 421))),
+                str(rng.choice((601, 602, 610, 611))),
+                str(rng.randint(1960, 2020)),
+                f"SRID=4326;MULTIPOLYGON((({ring})))",
+                f"SRID=4326;POINT({lon0 + SIZE / 2 + shift_lon:.7f} {lat0 + SIZE / 2 + shift_lat:.7f})",
+            )) + "\n")
+            if kubun:
+                bangos = [str(KOBETSU_BANGO_BASE + index * 10 + room) for room in range(n_touki)]
+            else:
+                bangos = [bldg_id]
+            for room, bango in enumerate(bangos):
+                properties.write("\t".join((
+                    f"{bango}-0000", bango, bldg_id, "A" if kubun else "\\N",
+                    str(room + 101) if kubun else "\\N")) + "\n")
+    buildings.seek(0)
+    properties.seek(0)
+    return buildings, properties
+
+
+def psql_file(path: str, variables: dict = None):
+    """dbbuild の SQL ファイルを main.py と同じ接続先で psql で実行する"""
+    env = dict(os.environ, PGHOST=os.environ["HOST"], PGPORT=os.environ["PORT"],
+               PGDATABASE=os.environ["DBNAME"], PGUSER=os.environ["USER"], PGPASSWORD=os.environ["PASSWORD"])
+    command = ["psql", "-q", "-v", "ON_ERROR_STOP=1", "-f", path]
+    for name, value in (variables or {}).items():
+        command[1:1] = ["-v", f"{name}={value}"]
+    subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL)
+
+
+def create_master(count: int, args: argparse.Namespace) -> float:
+    """合成の建物データを作成し、dbbuild の後続の処理 (メッシュコード, 面積, 候補テーブル) を実行する"""
+    start = time.perf_counter()
+    psql_file(os.path.join(DBBUILD_SQL_DIR, "01_init_tables.sql"))
+    buildings, properties = master_rows(count, args.buildings_per_file, args.match_rate, args.kubun_rate, args.seed)
+    with db.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.copy_expert(f"COPY building_master ({', '.join(BUILDING_MASTER_COLUMNS)}) FROM STDIN", buildings)
+        cursor.copy_expert(f"COPY propertyid_master ({', '.join(PROPERTYID_MASTER_COLUMNS)}) FROM STDIN", properties)
+        cursor.execute("CREATE INDEX idx_building_master_region ON building_master USING gist(region)")
+        cursor.execute("CREATE INDEX idx_propertyid_master_bldg_id ON propertyid_master (bldg_id)")
+        cursor.execute(FULL_ID_MASTER_SQL, {"bldg_id_base": BLDG_ID_BASE, "tochi_bango_base": TOCHI_BANGO_BASE})
+    for name in ("10_create_mesh_code.sql", "12_create_projected_area.sql", "11_create_mesh_candidates.sql"):
+        psql_file(os.path.join(DBBUILD_SQL_DIR, name))
+    psql_file(os.path.join(DBBUILD_SQL_DIR, "13_create_building_master_subdivided.sql"),
+              {"max_vertices": args.subdivide_max_vertices})
+    psql_file(os.path.join(DBBUILD_SQL_DIR, "14_create_master_data_version.sql"))
+    with db.autocommit() as conn:
+        conn.cursor().execute("ANALYZE")
+    return time.perf_counter() - start
+
+
+def write_inputs(count: int, args: argparse.Namespace, s3_root: str, input_dir: str) -> int:
+    """count 件の建物の合成 CityGML をスタブの S3 の input_dir に書き出し、ファイル数を返す"""
+    target_dir = os.path.join(s3_root, os.environ["BUCKET_NAME"], input_dir)
+    os.makedirs(target_dir, exist_ok=True)
+    files = layout(count, args.buildings_per_file)
+    for number, (name, first_index, n, origin) in enumerate(files):
+        write_citygml(os.path.join(target_dir, name), n, lod0_type_of(number, args.lod0_type),
+                      appearance_count=int(n * args.appearance_rate), seed=args.seed + number,
+                      origin=origin, first_index=first_index, columns=grid_columns(args.buildings_per_file))
+    return len(files)
+
+
+def run(count: int, args: argparse.Namespace, work_dir: str, s3_root: str) -> dict:
+    """count 件の建物で main.main() を実行し、計測結果を返す"""
+    session_id = f"bench_{count}"
+    # ワーカープロセスは環境変数から入出力ディレクトリを決めるので、環境変数も変更する
+    os.environ["ESTATE_ID_SESSION_ID"] = session_id
+    main.input_dir = f"data/input/{os.environ['ESTATE_ID_USER_ID']}/{session_id}"
+    main.output_dir = f"data/output/{os.environ['ESTATE_ID_USER_ID']}/{session_id}"
+    file_count = write_inputs(count, args, s3_root, main.input_dir)
+
+    mails = []
+    main.send_complete_mail = lambda: mails.append(session_id)
+    del metrics.records[:]
+    argv = sys.argv
+    sys.argv = [argv[0], "--workers", str(args.workers), "--match-scope", args.match_scope]
+    start = time.perf_counter()
+    try:
+        main.main()
+    finally:
+        sys.argv = argv
+    wall_s = time.perf_counter() - start
+
+    summary = metrics.summarize(list(metrics.records))
+    failed = sum(total["failed"] for total in summary.values())
+    if not args.keep:
+        shutil.rmtree(os.path.join(work_dir, "data"), ignore_errors=True)
+        shutil.rmtree(os.path.join(s3_root, os.environ["BUCKET_NAME"], main.input_dir), ignore_errors=True)
+    return {
+        "buildings": count,
+        "files": file_count,
+        "wall_s": round(wall_s, 3),
+        "buildings_per_s": round(count / wall_s, 1),
+        "matched": summary.get("match", {}).get("rows_out", 0),
+        "enriched": summary.get("enrich", {}).get("rows_out", 0),
+        "failed_stages": failed,
+        "mails": len(mails),
+        "stages": summary,
+    }
+
+
+def explain_match_statements(plans: dict):
+    """
+    マッチングの SQL 文 (main.match_to_estate_id) を、文の名前ごとに初回だけ EXPLAIN して plans に記録するよう
+    db.execute_prepared を置き換える (このプロセスで実行するマッチングだけが対象)
+    """
+    execute_prepared = db.execute_prepared
+
+    def explain_and_execute(conn, name: str, sql: str, params: tuple = ()):
+        if name.startswith("match_to_estate_id") and name not in plans:
+            cursor = conn.cursor()
+            if name not in conn.prepared_statements:
+                cursor.execute(f"PREPARE {name} AS {sql}")
+                conn.prepared_statements.add(name)
+            cursor.execute(f"EXPLAIN EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+            plans[name] = "\n".join(row[0] for row in cursor.fetchall())
+            print(f"{name} の実行計画:\n{plans[name]}")
+        return execute_prepared(conn, name, sql, params)
+
+    db.execute_prepared = explain_and_execute
+
+
+def server_version() -> str:
+    with db.autocommit() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT version(), postgis_full_version()")
+        return " / ".join(cursor.fetchone())
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=BENCH_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_run(result: dict):
+    print(f"{result['buildings']:>8}件 {result['files']:>4}ファイル {result['wall_s']:>9.2f}秒 "
+          f"{result['buildings_per_s']:>9.1f}件/秒 マッチング {result['matched']}件 付与 {result['enriched']}件")
+    for name, total in result["stages"].items():
+        print(f"    {name:<9} {total['wall_s']:>9.2f}秒 (CPU {total['cpu_s']:.2f}秒, "
+              f"SQL {total['db_statements']}件, 最大RSS {total['peak_rss_kb'] // 1024}MB)")
+
+
+def compare(results: list, baseline: dict):
+    """ベースラインと同じ建物数の結果について、処理時間の比 (今回 / ベースライン) を表示する"""
+    previous = {run["buildings"]: run for run in baseline["runs"]}
+    print(f"ベースライン ({baseline.get('created_at')}, {baseline.get('git_commit')}) との比較 (今回 / ベースライン)")
+    for result in results:
+        before = previous.get(result["buildings"])
+        if before is None:
+            continue
+        print(f"{result['buildings']:>8}件 全体 {result['wall_s'] / before['wall_s']:.2f}")
+        for name, total in result["stages"].items():
+            before_total = before["stages"].get(name)
+            if before_total and before_total["wall_s"] > 0:
+                print(f"    {name:<9} {total['wall_s'] / before_total['wall_s']:.2f}")
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--counts", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--match-scope", choices=("file", "session"), default="file")
+    parser.add_argument("--buildings-per-file", type=int, default=5000)
+    parser.add_argument("--lod0-type", choices=("lod0RoofEdge", "lod0FootPrint", "both"), default="both")
+    parser.add_argument("--appearance-rate", type=float, default=0.1,
+                        help="建物数に対する app:appearanceMember の数の割合")
+    parser.add_argument("--match-rate", type=float, default=0.8, help="建物データがある建物の割合")
+    parser.add_argument("--kubun-rate", type=float, default=0.1, help="建物データのうち区分所有建物の割合")
+    parser.add_argument("--subdivide-max-vertices", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="結果の JSON の保存先 (省略時は bench/results/pipeline_[日時].json)")
+    parser.add_argument("--baseline", help="比較する以前の結果の JSON")
+    parser.add_argument("--keep", action="store_true", help="入出力ファイルを削除しない")
+    parser.add_argument("--explain", action="store_true",
+                        help="マッチングの SQL 文の実行計画を表示し、結果の JSON に保存する "
+                             "(--workers 1 または --match-scope session の場合)")
+    parser.add_argument("--force", action="store_true",
+                        help="データベース名が bench で終わらなくても実行する (建物データを作り直すので注意)")
+    args = parser.parse_args()
+
+    if not os.environ["DBNAME"].endswith("bench") and not args.force:
+        parser.error(f"データベース {os.environ['DBNAME']} の建物データを作り直すので、"
+                     "ベンチマーク用のデータベースを使うか --force を指定してください")
+    if args.explain and args.workers > 1 and args.match_scope == "file":
+        parser.error("ファイル単位のマッチングはワーカープロセスで実行するので、--explain は --workers 1 で指定してください")
+
+    started_at = datetime.datetime.now()
+    print("合成の建物データを作成...")
+    master_s = create_master(max(args.counts), args)
+    print(f"建物データの作成: {master_s:.1f}秒")
+
+    work_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    s3_root = os.path.join(work_dir, "s3")
+    # main.py は作業ディレクトリからの相対パスで入出力を行う
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    # S3 のスタブ (ワーカープロセスは S3 を使わないので、このプロセスだけ置き換える)
+    s3_client = LocalS3Client(s3_root)
+    s3_transfer.get_s3_client = lambda: s3_client
+    plans = {}
+    if args.explain:
+        explain_match_statements(plans)
+    results = []
+    try:
+        for count in args.counts:
+            result = run(count, args, work_dir, s3_root)
+            print_run(result)
+            results.append(result)
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    document = {
+        "created_at": started_at.isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "server": server_version(),
+        "master_build_s": round(master_s, 3),
+        "settings": {key: value for key, value in vars(args).items()
+                     if key not in ("output", "baseline", "keep", "force", "explain")},
+        "environment": {key: os.environ.get(key) for key in (
+            "ESTATE_ID_STAGING_MODE", "ESTATE_ID_CANDIDATE_SOURCE", "ESTATE_ID_SCORING_AREA",
+            "ESTATE_ID_IMPORTER", "SCORING_BACKEND", "ESTATE_ID_MATCH_CACHE", "ESTATE_ID_GML_OUTPUT",
+            "ESTATE_ID_SIDECAR_FORMATS")},
+        "runs": results,
+    }
+    if plans:
+        document["plans"] = plans
+    output = args.output or os.path.join(BENCH_DIR, "results", f"pipeline_{started_at:%Y%m%d%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(document, f, ensure_ascii=False, indent=2)
+    print(f"結果を{output}に保存しました")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,117 @@
+"""
+作業用テーブルのステージングモード (ESTATE_ID_STAGING_MODE=unlogged) のベンチマーク。
+
+data/input/[ESTATE_ID_USER_ID]/[ESTATE_ID_SESSION_ID] の CityGML を、
+通常のモード (LOGGED, すべてのインデックスを投入前に作成) とステージングモード
+(UNLOGGED, 必要なインデックスだけを投入後に作成) のそれぞれでインポート・マッチングし、
+書き込まれた WAL の量 (pg_current_wal_lsn の差分) と処理時間を計測する。
+WAL はサーバー全体の値なので、他のセッションがデータベースを使っていないときに実行すること。
+
+計測用のセッションIDは [ESTATE_ID_SESSION_ID]__bench_[モード] とし、計測後にパーティションを削除する。
+
+実行方法 (main.py と同じ環境変数を設定して実行する):
+    python bench/bench_staging.py [--match-scope session] [--repeat 3]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from dotenv import load_dotenv  # noqa: E402
+
+# main.py はインポート時に入力ディレクトリを環境変数から決めるので、先に .env を読み込んでおく
+load_dotenv()
+
+import db  # noqa: E402
+import main  # noqa: E402
+import working_tables  # noqa: E402
+
+# (モード名, staging)
+MODES = (
+    ('logged', False),
+    ('unlogged', True),
+)
+
+
+def current_wal_lsn(conn) -> str:
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_current_wal_lsn()")
+    return cursor.fetchone()[0]
+
+
+def wal_bytes_since(conn, lsn: str) -> int:
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s)", (lsn,))
+    return int(cursor.fetchone()[0])
+
+
+def run_mode(files: list, staging: bool, match_scope: str) -> tuple:
+    """1つのモードでインポートとマッチングを行い、(WAL のバイト数, 処理時間 [秒]) を返す"""
+    defer_indexes = staging and match_scope == "session"
+    with db.autocommit() as conn:
+        start_lsn = current_wal_lsn(conn)
+    start = time.perf_counter()
+
+    main.create_import_table(staging, defer_indexes)
+    main.create_working_table(staging, defer_indexes)
+    if match_scope == "session":
+        with db.transaction() as conn:
+            for file in files:
+                main.gml2postgis(conn, file)
+        with db.transaction() as conn:
+            main.match_files(conn, files)
+            if staging:
+                working_tables.create_session_indexes(
+                    conn, "building_citygml_matched",
+                    os.environ['ESTATE_ID_USER_ID'], os.environ['ESTATE_ID_SESSION_ID'], staging=True)
+    else:
+        for file in files:
+            with db.transaction() as conn:
+                main.gml2postgis(conn, file)
+                main.match_files(conn, [file])
+
+    elapsed = time.perf_counter() - start
+    with db.autocommit() as conn:
+        wal_bytes = wal_bytes_since(conn, start_lsn)
+    return wal_bytes, elapsed
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--match-scope", choices=("file", "session"), default="file")
+    parser.add_argument("--repeat", type=int, default=1, help="モードごとの計測回数")
+    args = parser.parse_args()
+
+    files = main.list_input_files()
+    user_id = os.environ['ESTATE_ID_USER_ID']
+    session_id = os.environ['ESTATE_ID_SESSION_ID']
+    print(f"ファイル数: {len(files)}, マッチング単位: {args.match_scope}")
+
+    results = {}
+    for _ in range(args.repeat):
+        for name, staging in MODES:
+            # 作業用テーブルのパーティションはモードごとに別のセッションIDで作成する
+            bench_session_id = f"{session_id}__bench_{name}"
+            os.environ['ESTATE_ID_SESSION_ID'] = bench_session_id
+            try:
+                results.setdefault(name, []).append(run_mode(files, staging, args.match_scope))
+            finally:
+                with db.autocommit() as conn:
+                    for table in working_tables.WORKING_TABLES:
+                        working_tables.drop_session_partition(conn, table, user_id, bench_session_id)
+                os.environ['ESTATE_ID_SESSION_ID'] = session_id
+
+    print(f"{'モード':<10}{'WAL [MB]':>12}{'時間 [秒]':>12}")
+    for name, values in results.items():
+        wal_mb = min(wal for wal, _ in values) / (1024 * 1024)
+        elapsed = min(seconds for _, seconds in values)
+        print(f"{name:<10}{wal_mb:>12.1f}{elapsed:>12.2f}")
+    logged_wal, logged_time = (min(v) for v in zip(*results['logged']))
+    unlogged_wal, unlogged_time = (min(v) for v in zip(*results['unlogged']))
+    print(f"削減量: WAL {(logged_wal - unlogged_wal) / (1024 * 1024):.1f}MB, 時間 {logged_time - unlogged_time:.2f}秒")
+
+
+if __name__ == "__main__":
+    run()
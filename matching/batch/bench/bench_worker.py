@@ -0,0 +1,167 @@
+"""
+小さなジョブの処理時間 (中央値) を、ジョブごとに新しいプロセスで実行する場合 (AWS Batch と同じ) と、
+常駐ワーカー (src/worker.py) で続けて処理する場合とで比較するベンチマーク。
+
+bench_pipeline.py と同じ合成の建物データと CityGML を使い、同じ内容の小さなジョブ (既定では1ファイル200棟) を
+セッションを変えて繰り返し処理する。
+新しいプロセスで実行する場合は、Python の起動・モジュールのインポート・DB への接続を含めた時間を計る
+(コンテナの起動とイメージの取得は含まない)。
+常駐ワーカーの場合は、file: のキューにジョブを入れ、1つのプロセスで取り出して処理する時間を計る。
+--workers を2以上にすると、ファイルを並列に処理するプロセスプールを、新しいプロセスではジョブごとに作成し、
+常駐ワーカーではジョブをまたいで使う。
+
+実行方法:
+    docker compose -f bench/docker-compose.yml up -d postgis_bench
+    docker compose -f bench/docker-compose.yml run --rm bench python bench/bench_worker.py [--jobs 20] [--buildings 200]
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# bench_pipeline のインポートで、ベンチマーク用の環境変数と src へのパスを設定する
+import bench_pipeline
+from bench_pipeline import BENCH_DIR, LocalS3Client, create_master, write_inputs
+
+import db  # noqa: E402
+import job_queue  # noqa: E402
+import main  # noqa: E402
+import s3_transfer  # noqa: E402
+import worker  # noqa: E402
+
+
+def install_stubs(s3_root: str, mails: list):
+    """S3 と完了メールをスタブに置き換える"""
+    s3_client = LocalS3Client(s3_root)
+    s3_transfer.get_s3_client = lambda: s3_client
+    main.send_complete_mail = lambda: mails.append(os.environ['ESTATE_ID_SESSION_ID'])
+
+
+def percentile(values: list, rate: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * rate))]
+
+
+def latency_summary(latencies: list) -> dict:
+    return {
+        "jobs": len(latencies),
+        "median_s": round(statistics.median(latencies), 3),
+        "p90_s": round(percentile(latencies, 0.9), 3),
+        "min_s": round(min(latencies), 3),
+        "max_s": round(max(latencies), 3),
+    }
+
+
+def run_cold_one(session_id: str, work_dir: str, workers: int):
+    """(子プロセス) 1件のジョブを main.main() で処理する"""
+    os.chdir(work_dir)
+    install_stubs(os.path.join(work_dir, "s3"), [])
+    worker.set_session(os.environ['ESTATE_ID_USER_ID'], session_id)
+    sys.argv = [sys.argv[0], "--workers", str(workers)]
+    main.main()
+
+
+def run_cold(args: argparse.Namespace, work_dir: str, s3_root: str) -> list:
+    """ジョブごとに新しいプロセスで処理し、ジョブごとの処理時間を返す"""
+    latencies = []
+    for number in range(args.cold_jobs):
+        session_id = f"cold_{number:04d}"
+        write_inputs(args.buildings, args, s3_root, f"data/input/{os.environ['ESTATE_ID_USER_ID']}/{session_id}")
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--cold-one", session_id, "--work-dir", work_dir,
+                        "--workers", str(args.workers)],
+                       check=True, stdout=subprocess.DEVNULL)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def run_warm(args: argparse.Namespace, work_dir: str, s3_root: str) -> list:
+    """常駐ワーカーで続けて処理し、ジョブごとの処理時間を返す"""
+    queue_spec = f"file:{os.path.join(work_dir, 'queue')}"
+    queue = job_queue.open_queue(queue_spec)
+    for number in range(args.jobs):
+        session_id = f"warm_{number:04d}"
+        write_inputs(args.buildings, args, s3_root, f"data/input/{os.environ['ESTATE_ID_USER_ID']}/{session_id}")
+        queue.enqueue(os.environ['ESTATE_ID_USER_ID'], session_id)
+    mails = []
+    install_stubs(s3_root, mails)
+    worker_args = argparse.Namespace(queue=queue_spec, max_jobs=0, idle_exit=True, workers=args.workers,
+                                     match_scope="file")
+    latencies = worker.serve(worker_args)
+    if len(mails) != args.jobs:
+        print(f"完了したジョブが {len(mails)}/{args.jobs}件しかありません")
+    return latencies
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=20, help="常駐ワーカーで処理するジョブの数")
+    parser.add_argument("--cold-jobs", type=int, default=5, help="新しいプロセスで処理するジョブの数")
+    parser.add_argument("--buildings", type=int, default=200, help="1件のジョブの建物数")
+    parser.add_argument("--files", type=int, default=1, help="1件のジョブのファイル数")
+    parser.add_argument("--workers", type=int, default=1, help="ファイルを並列に処理するプロセス数")
+    parser.add_argument("--lod0-type", choices=("lod0RoofEdge", "lod0FootPrint", "both"), default="both")
+    parser.add_argument("--appearance-rate", type=float, default=0.1)
+    parser.add_argument("--match-rate", type=float, default=0.8)
+    parser.add_argument("--kubun-rate", type=float, default=0.1)
+    parser.add_argument("--subdivide-max-vertices", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="結果の JSON の保存先 (省略時は bench/results/worker_[日時].json)")
+    parser.add_argument("--force", action="store_true",
+                        help="データベース名が bench で終わらなくても実行する (建物データを作り直すので注意)")
+    parser.add_argument("--cold-one", help=argparse.SUPPRESS)
+    parser.add_argument("--work-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    # 1件のジョブの建物を --files 個のファイルに分ける
+    args.buildings_per_file = max(1, args.buildings // args.files)
+
+    if args.cold_one:
+        run_cold_one(args.cold_one, args.work_dir, args.workers)
+        return
+
+    if not os.environ["DBNAME"].endswith("bench") and not args.force:
+        parser.error(f"データベース {os.environ['DBNAME']} の建物データを作り直すので、"
+                     "ベンチマーク用のデータベースを使うか --force を指定してください")
+
+    started_at = datetime.datetime.now()
+    print("合成の建物データを作成...")
+    create_master(args.buildings, args)
+    db.close_pool()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_worker_")
+    s3_root = os.path.join(work_dir, "s3")
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        cold = run_cold(args, work_dir, s3_root)
+        warm = run_warm(args, work_dir, s3_root)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    document = {
+        "created_at": started_at.isoformat(),
+        "git_commit": bench_pipeline.git_commit(),
+        "settings": {key: value for key, value in vars(args).items()
+                     if key not in ("output", "force", "cold_one", "work_dir")},
+        "cold": latency_summary(cold),
+        "warm": latency_summary(warm),
+    }
+    for name in ("cold", "warm"):
+        summary = document[name]
+        print(f"{name}: {summary['jobs']}件 中央値 {summary['median_s']:.3f}秒 p90 {summary['p90_s']:.3f}秒")
+    output = args.output or os.path.join(BENCH_DIR, "results", f"worker_{started_at:%Y%m%d%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(document, f, ensure_ascii=False, indent=2)
+    print(f"結果を{output}に保存しました")
+
+
+if __name__ == "__main__":
+    main_bench()
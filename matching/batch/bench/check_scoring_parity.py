@@ -0,0 +1,139 @@
+"""
+スコア計算 (scoring.score_candidates, scoring_python.score_candidates_python) の結果が、
+従来の UPDATE ごとの処理 (scoring.score_candidates_legacy) と一致することを確認するスクリプト。
+
+data/input/[ESTATE_ID_USER_ID]/[ESTATE_ID_SESSION_ID] の CityGML ごとに、
+インポートとマッチングを行って候補を作り、同じ候補を方式ごとのセッションIDに複製して
+それぞれの方式でスコアを計算し、残ったレコードを全カラムで従来の方式と比較する。
+処理はすべてロールバックするので、データベースには何も残らない。
+
+実行方法 (main.py と同じ環境変数を設定して実行する):
+    python bench/check_scoring_parity.py [ファイル名 ...]
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from dotenv import load_dotenv  # noqa: E402
+
+# main.py はインポート時に入力ディレクトリを環境変数から決めるので、先に .env を読み込んでおく
+load_dotenv()
+# 従来の方式は測地線面積で score_wide を計算するので、比較する方式も測地線面積を使う
+# (既定の平面直角座標系の面積では、四捨五入の境界にある候補のスコアが1点ずれることがある)
+os.environ['ESTATE_ID_SCORING_AREA'] = 'geography'
+
+import db  # noqa: E402
+import main  # noqa: E402
+import scoring  # noqa: E402
+import working_tables  # noqa: E402
+from scoring_python import score_candidates_python  # noqa: E402
+
+GEOMETRY_COLUMNS = ('lod0geom', 'region')
+
+
+def score_then_demote(conn, user_id: str, session_id: str, file: str) -> tuple:
+    """
+    建物IDの重複除去をスコア計算とは別の SQL 文で行う場合 (マッチング結果のキャッシュを使う場合) の
+    scoring.score_candidates と同じ (候補件数, 足切り後の件数, 採用件数) を返す
+    """
+    candidate_count, passed_count, matched_count = scoring.score_candidates(
+        conn, user_id, session_id, file, demote=False)
+    return (candidate_count, passed_count,
+            matched_count - scoring.demote_duplicate_buildings(conn, user_id, session_id, file))
+
+
+# 従来の方式と比較するスコア計算の方式 (名前, 関数)
+BACKENDS = (
+    ('sql', scoring.score_candidates),
+    ('python', score_candidates_python),
+    ('sql_demote', score_then_demote),
+)
+
+
+def compare_columns() -> str:
+    """比較するカラムのリスト (セッションIDを除く。ジオメトリは EWKB で比較する)"""
+    return ', '.join(
+        f'ST_AsEWKB({column})' if column in GEOMETRY_COLUMNS else column
+        for column in scoring.MATCHED_COLUMNS if column != 'session_id')
+
+
+def copy_candidates(conn, user_id: str, session_id: str, file: str, copy_session_id: str):
+    """ファイル file の候補を、セッションIDだけ変えて複製する"""
+    working_tables.create_session_partition(conn, "building_citygml_matched", user_id, copy_session_id)
+    working_tables.create_session_indexes(conn, "building_citygml_matched", user_id, copy_session_id)
+    columns = ', '.join(
+        '%s' if column == 'session_id' else column for column in scoring.MATCHED_COLUMNS)
+    conn.cursor().execute(
+        f'''
+        INSERT INTO building_citygml_matched
+        SELECT {columns}
+        FROM building_citygml_matched
+        WHERE user_id = %s AND session_id = %s AND filename = %s
+        ''', (copy_session_id, user_id, session_id, file))
+
+
+def count_differences(conn, user_id: str, session_id: str, other_session_id: str, file: str) -> int:
+    """2つのセッションIDに残ったレコードのうち、一方にしかないレコードの件数を返す"""
+    columns = compare_columns()
+    select_sql = f'''
+    SELECT {columns}
+    FROM building_citygml_matched
+    WHERE user_id = %s AND session_id = %s AND filename = %s
+    '''
+    cursor = conn.cursor()
+    cursor.execute(
+        f'''
+        SELECT count(*) FROM (
+            ({select_sql} EXCEPT ALL {select_sql})
+            UNION ALL
+            ({select_sql} EXCEPT ALL {select_sql})
+        ) AS diff
+        ''', (user_id, session_id, file, user_id, other_session_id, file,
+              user_id, other_session_id, file, user_id, session_id, file))
+    return cursor.fetchone()[0]
+
+
+def check_file(file: str, user_id: str, session_id: str) -> bool:
+    legacy_session_id = f"{session_id}__legacy"
+    results = []
+    with db.connection() as conn:
+        try:
+            main.gml2postgis(conn, file)
+            main.match_to_estate_id(conn, [file])
+            for name, _ in BACKENDS:
+                copy_candidates(conn, user_id, session_id, file, f"{session_id}__{name}")
+            copy_candidates(conn, user_id, session_id, file, legacy_session_id)
+
+            legacy_counts = tuple(scoring.score_candidates_legacy(conn, user_id, legacy_session_id, file))
+            for name, score in BACKENDS:
+                backend_session_id = f"{session_id}__{name}"
+                counts = tuple(score(conn, user_id, backend_session_id, file))
+                differences = count_differences(conn, user_id, backend_session_id, legacy_session_id, file)
+                results.append((name, counts, differences))
+        finally:
+            conn.rollback()
+
+    matched = True
+    for name, counts, differences in results:
+        print(f"{file} [{name}]: 件数 {counts} / 従来 {legacy_counts}, 不一致レコード {differences}件")
+        matched = matched and counts == legacy_counts and differences == 0
+    return matched
+
+
+def run():
+    user_id = os.environ.get('ESTATE_ID_USER_ID')
+    session_id = os.environ.get('ESTATE_ID_SESSION_ID')
+    main.create_import_table()
+    main.create_working_table()
+
+    files = sys.argv[1:] or main.list_input_files()
+    failed = [file for file in files if not check_file(file, user_id, session_id)]
+    if failed:
+        print(f"結果が一致しないファイル: {failed}")
+        sys.exit(1)
+    print("すべてのファイルで結果が一致しました")
+
+
+if __name__ == "__main__":
+    run()
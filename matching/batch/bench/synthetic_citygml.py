@@ -0,0 +1,115 @@
+"""
+ベンチマーク用の合成 CityGML (建物) を生成するモジュール。
+"""
+import random
+
+HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<core:CityModel xmlns:core="http://www.opengis.net/citygml/2.0" xmlns:gml="http://www.opengis.net/gml" xmlns:bldg="http://www.opengis.net/citygml/building/2.0" xmlns:gen="http://www.opengis.net/citygml/generics/2.0" xmlns:uro="https://www.geospatial.jp/iur/uro/3.0" xmlns:app="http://www.opengis.net/citygml/appearance/2.0" xmlns:xlink="http://www.w3.org/1999/xlink">
+	<gml:boundedBy>
+		<gml:Envelope srsName="http://www.opengis.net/def/crs/EPSG/0/6697" srsDimension="3">
+			<gml:lowerCorner>{lat0} {lon0} 0</gml:lowerCorner>
+			<gml:upperCorner>{lat1} {lon1} 100</gml:upperCorner>
+		</gml:Envelope>
+	</gml:boundedBy>
+"""
+
+BUILDING = """	<core:cityObjectMember>
+		<bldg:Building gml:id="bldg_{index:08d}">
+			<gen:stringAttribute name="建物ID">
+				<gen:value>00000-bldg-{index}</gen:value>
+			</gen:stringAttribute>
+			<bldg:usage codeSpace="../../codelists/Building_usage.xml">{usage}</bldg:usage>
+			<bldg:yearOfConstruction>{year}</bldg:yearOfConstruction>
+			<bldg:measuredHeight uom="m">{height:.1f}</bldg:measuredHeight>
+			<bldg:storeysAboveGround>{floors}</bldg:storeysAboveGround>
+			<bldg:storeysBelowGround>0</bldg:storeysBelowGround>
+			<bldg:{lod0_type}>
+				<gml:MultiSurface>
+					<gml:surfaceMember>
+						<gml:Polygon>
+							<gml:exterior>
+								<gml:LinearRing>
+									<gml:posList>{pos_list}</gml:posList>
+								</gml:LinearRing>
+							</gml:exterior>
+						</gml:Polygon>
+					</gml:surfaceMember>
+				</gml:MultiSurface>
+			</bldg:{lod0_type}>
+			<uro:buildingDetailAttribute>
+				<uro:BuildingDetailAttribute>
+					<uro:buildingStructureType codeSpace="../../codelists/BuildingDetailAttribute_buildingStructureType.xml">{structure}</uro:buildingStructureType>
+					<uro:buildingFootprintArea uom="m2">{footprint:.2f}</uro:buildingFootprintArea>
+				</uro:BuildingDetailAttribute>
+			</uro:buildingDetailAttribute>
+		</bldg:Building>
+	</core:cityObjectMember>
+"""
+
+APPEARANCE = """	<app:appearanceMember>
+		<app:Appearance>
+			<app:theme>rgbTexture</app:theme>
+			<app:surfaceDataMember>
+				<app:ParameterizedTexture>
+					<app:imageURI>{index}.jpg</app:imageURI>
+					<app:target uri="#poly_{index}">
+						<app:TexCoordList>
+							<app:textureCoordinates ring="#ring_{index}">{coords}</app:textureCoordinates>
+						</app:TexCoordList>
+					</app:target>
+				</app:ParameterizedTexture>
+			</app:surfaceDataMember>
+		</app:Appearance>
+	</app:appearanceMember>
+"""
+
+FOOTER = "</core:CityModel>\n"
+
+# 生成する建物の基準点 (緯度, 経度) と、建物の間隔 (度)
+ORIGIN = (33.83, 132.75)
+PITCH = 0.0002
+SIZE = 0.0001
+
+
+def grid_columns(building_count: int) -> int:
+    """building_count 件の建物を並べる格子の列数"""
+    return max(1, int(building_count ** 0.5))
+
+
+def building_square(index: int, columns: int, origin: tuple = ORIGIN) -> list:
+    """origin から格子状に並べた index 番目の建物の外周 (緯度, 経度) を返す"""
+    lat = origin[0] + (index // columns) * PITCH
+    lon = origin[1] + (index % columns) * PITCH
+    return [(lat, lon), (lat + SIZE, lon), (lat + SIZE, lon + SIZE), (lat, lon + SIZE), (lat, lon)]
+
+
+def write_citygml(path: str, building_count: int, lod0_type: str = "lod0RoofEdge",
+                  appearance_count: int = 0, seed: int = 0,
+                  origin: tuple = ORIGIN, first_index: int = 0, columns: int = None) -> None:
+    """
+    building_count 件の建物を持つ合成 CityGML を path に書き出す。
+    建物は origin から columns 列 (省略時は grid_columns) の格子状に並べ、
+    gml:id には first_index からの通し番号を付ける
+    """
+    rng = random.Random(seed)
+    columns = columns or grid_columns(building_count)
+    rows = (building_count + columns - 1) // columns
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(HEADER.format(lat0=origin[0], lon0=origin[1],
+                              lat1=origin[0] + rows * PITCH, lon1=origin[1] + columns * PITCH))
+        for index in range(building_count):
+            floors = rng.randint(1, 10)
+            f.write(BUILDING.format(
+                index=first_index + index,
+                usage=rng.choice((401, 411, 412, 421)),
+                year=rng.randint(1960, 2020),
+                height=floors * 2.85 + 1.93,
+                floors=floors,
+                lod0_type=lod0_type,
+                pos_list=" ".join(f"{lat:.7f} {lon:.7f} 0" for lat, lon in building_square(index, columns, origin)),
+                structure=rng.choice((601, 602, 610, 611)),
+                footprint=rng.uniform(40, 200),
+            ))
+        for index in range(appearance_count):
+            f.write(APPEARANCE.format(index=index, coords=" ".join(["0.5"] * 512)))
+        f.write(FOOTER)
@@ -0,0 +1,152 @@
+"""
+バッチ処理の PostgreSQL への接続を管理するモジュール。
+
+- 接続はプロセスごとのコネクションプールから取得する (ワーカープロセスごとに1接続)
+- ファイル単位のトランザクションは transaction() で明示的に開始し、最後に1回だけコミットする
+- execute_prepared() で PREPARE した文は、同じ接続であればファイルをまたいで再利用する
+- 開いた接続数と実行したSQL文の数を stats で数える
+"""
+import os
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+# 開いた接続数と実行したSQL文の数 (プロセスごと)
+stats = {
+    "connections_opened": 0,
+    "statements_executed": 0,
+}
+
+_pool: Optional[psycopg2.pool.SimpleConnectionPool] = None
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """実行したSQL文の数を数えるカーソル"""
+
+    def execute(self, query, vars=None):
+        stats["statements_executed"] += 1
+        return super().execute(query, vars)
+
+    def copy_expert(self, sql, file, size=8192):
+        stats["statements_executed"] += 1
+        return super().copy_expert(sql, file, size)
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    """開いた接続数を数え、PREPARE 済みの文の名前を保持する接続"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        stats["connections_opened"] += 1
+        self.prepared_statements = set()
+
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault("cursor_factory", CountingCursor)
+        return super().cursor(*args, **kwargs)
+
+
+def get_dsn() -> str:
+    """環境変数 HOST, PORT, DBNAME, USER, PASSWORD から DSN 文字列を生成する"""
+    return "host={} port={} dbname={} user={} password={}".format(
+        os.environ["HOST"], os.environ["PORT"],
+        os.environ["DBNAME"], os.environ["USER"],
+        os.environ["PASSWORD"])
+
+
+def init_pool(maxconn: int = 1):
+    """このプロセスのコネクションプールを作成する"""
+    global _pool
+    close_pool()
+    _pool = psycopg2.pool.SimpleConnectionPool(
+        1, maxconn, get_dsn(), connection_factory=CountingConnection)
+
+
+def close_pool():
+    """
+    このプロセスのコネクションプールを閉じる。
+    ワーカープロセスを fork する前に呼び出し、親プロセスの接続が子プロセスに引き継がれないようにする。
+    """
+    global _pool
+    if _pool is not None:
+        _pool.closeall()
+        _pool = None
+
+
+@contextmanager
+def connection() -> Iterator[CountingConnection]:
+    """プールから接続を取得する。プールが未作成の場合は作成する"""
+    if _pool is None:
+        init_pool()
+    conn = _pool.getconn()
+    try:
+        yield conn
+    finally:
+        _pool.putconn(conn)
+
+
+@contextmanager
+def transaction() -> Iterator[CountingConnection]:
+    """
+    プールから取得した接続でトランザクションを実行する。
+    ブロックを正常に抜けたらコミットし、例外が発生したらロールバックする。
+    """
+    with connection() as conn:
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            if not conn.closed:
+                conn.rollback()
+            raise
+
+
+@contextmanager
+def autocommit() -> Iterator[CountingConnection]:
+    """
+    プールから取得した接続を autocommit にして返す。
+    トランザクションブロックの中で実行できない文 (DETACH PARTITION CONCURRENTLY など) に使う。
+    """
+    with connection() as conn:
+        conn.autocommit = True
+        try:
+            yield conn
+        finally:
+            conn.autocommit = False
+
+
+@contextmanager
+def savepoint(conn, name: str):
+    """トランザクション内でセーブポイントを設定し、例外が発生したらそこまでロールバックする"""
+    cursor = conn.cursor()
+    cursor.execute(f"SAVEPOINT {name}")
+    try:
+        yield
+    except BaseException:
+        cursor.execute(f"ROLLBACK TO SAVEPOINT {name}")
+        raise
+    cursor.execute(f"RELEASE SAVEPOINT {name}")
+
+
+def execute_prepared(conn, name: str, sql: str, params: tuple = ()):
+    """
+    sql を name という名前で PREPARE して EXECUTE し、カーソルを返す。
+    PREPARE は接続ごとに初回だけ行い、以降のファイルでは同じ文を再利用する。
+    sql のパラメータは $1, $2, ... で記述する。
+    """
+    cursor = conn.cursor()
+    if name not in conn.prepared_statements:
+        cursor.execute(f"PREPARE {name} AS {sql}")
+        conn.prepared_statements.add(name)
+    if params:
+        cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cursor.execute(f"EXECUTE {name}")
+    return cursor
+
+
+def get_stats() -> dict:
+    """このプロセスの接続数・SQL文数の現在値を返す"""
+    return dict(stats)
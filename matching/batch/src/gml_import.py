@@ -0,0 +1,341 @@
+"""
+CityGML (建物) を ogr2ogr を使わずに PostGIS の building_citygml テーブルへ
+インポートするモジュール。
+
+lxml の iterparse で bldg:Building を1件ずつ読み出し、
+COPY ... FROM STDIN (BINARY) で building_citygml に直接書き込む。
+"""
+import io
+import re
+import struct
+from typing import Iterable, Iterator, Optional
+
+from lxml import etree
+
+GML_NS = 'http://www.opengis.net/gml'
+BLDG_NS = 'http://www.opengis.net/citygml/building/2.0'
+GEN_NS = 'http://www.opengis.net/citygml/generics/2.0'
+
+GML_ID = f'{{{GML_NS}}}id'
+
+# lod0geom の SRID
+# PLATEAU の EPSG:6697 (JGD2011) と EPSG:4326 の変換は恒等変換なので、
+# 緯度・経度の軸順だけ入れ替えて 4326 として格納する (ogr2ogr + ST_Transform と同じ結果になる)
+SRID = 4326
+
+# EWKB のジオメトリ型
+_EWKB_Z = 0x80000000
+_EWKB_SRID = 0x20000000
+_WKB_POLYGON = 3
+_WKB_MULTIPOLYGON = 6
+
+# building_citygml への COPY 対象カラムと、バイナリ COPY での型
+COPY_COLUMNS = (
+    ('gml_id', 'text'),
+    ('"建物id"', 'text'),
+    ('measuredheight', 'float8'),
+    ('measuredheight_uom', 'text'),
+    ('filename', 'text'),
+    ('usage', 'int4'),
+    ('buildingStructureType_uro', 'int4'),
+    ('buildingFootprintArea_uro', 'float8'),
+    ('storeysAboveGround', 'int4'),
+    ('storeysBelowGround', 'int4'),
+    ('yearOfConstruction', 'int4'),
+    ('lod0geom', 'geometry'),
+    ('user_id', 'text'),
+    ('session_id', 'text'),
+)
+
+# app:appearanceMember の開始タグ (名前空間接頭辞は問わない)
+_APPEARANCE_START = re.compile(rb'<([A-Za-z_][\w.-]*:)?appearanceMember(?=[\s/>])')
+# チャンク境界で分断されたタグを取りこぼさないよう、次のチャンクに持ち越すバイト数
+_CARRY_SIZE = 64
+LOD0_TYPES = (b'lod0RoofEdge', b'lod0FootPrint')
+
+_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+_COPY_TRAILER = struct.pack('!h', -1)
+
+
+def _to_float(text: Optional[str]) -> Optional[float]:
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(text: Optional[str]) -> Optional[int]:
+    value = _to_float(text)
+    return None if value is None else int(value)
+
+
+def _find_text(building: etree._Element, path: str) -> Optional[str]:
+    element = next(building.iter(path), None)
+    return None if element is None else element.text
+
+
+def _read_building_id(building: etree._Element) -> Optional[str]:
+    """建物ID を取得する (gen:stringAttribute または uro:buildingID)"""
+    for attr in building.iterchildren(f'{{{GEN_NS}}}stringAttribute'):
+        if attr.get('name') == '建物ID':
+            return attr.findtext(f'{{{GEN_NS}}}value')
+    return _find_text(building, '{*}buildingID')
+
+
+def _read_ring(ring: etree._Element) -> list:
+    """gml:LinearRing の座標を (経度, 緯度[, 高さ]) のタプルのリストで返す"""
+    pos_list = ring.find(f'{{{GML_NS}}}posList')
+    if pos_list is not None:
+        values = [float(v) for v in pos_list.text.split()]
+        dim = int(pos_list.get('srsDimension') or (3 if len(values) % 3 == 0 else 2))
+        coords = [values[i:i + dim] for i in range(0, len(values), dim)]
+    else:
+        coords = [[float(v) for v in pos.text.split()] for pos in ring.iter(f'{{{GML_NS}}}pos')]
+    # 緯度・経度の軸順を入れ替える
+    return [(c[1], c[0], *c[2:]) for c in coords]
+
+
+def _read_polygons(geom_property: etree._Element) -> list:
+    """lod0RoofEdge / lod0FootPrint 以下の gml:Polygon をリング座標のリストとして返す"""
+    polygons = []
+    for polygon in geom_property.iter(f'{{{GML_NS}}}Polygon'):
+        rings = []
+        for boundary in ('exterior', 'interior'):
+            for element in polygon.iterchildren(f'{{{GML_NS}}}{boundary}'):
+                ring = element.find(f'{{{GML_NS}}}LinearRing')
+                if ring is not None:
+                    rings.append(_read_ring(ring))
+        if rings and rings[0]:
+            polygons.append(rings)
+    return polygons
+
+
+def polygons_to_ewkb(polygons: list, srid: int = SRID) -> Optional[bytes]:
+    """リング座標のリストを MultiPolygon (Z) の EWKB に変換する"""
+    if not polygons:
+        return None
+    has_z = len(polygons[0][0][0]) == 3
+    dim_flag = _EWKB_Z if has_z else 0
+    point_format = '<ddd' if has_z else '<dd'
+    buf = io.BytesIO()
+    buf.write(struct.pack('<BIiI', 1, _WKB_MULTIPOLYGON | dim_flag | _EWKB_SRID, srid, len(polygons)))
+    for rings in polygons:
+        buf.write(struct.pack('<BII', 1, _WKB_POLYGON | dim_flag, len(rings)))
+        for ring in rings:
+            buf.write(struct.pack('<I', len(ring)))
+            for coord in ring:
+                buf.write(struct.pack(point_format, *coord[:3 if has_z else 2]))
+    return buf.getvalue()
+
+
+def read_building(building: etree._Element, lod0_type: str) -> dict:
+    """bldg:Building 要素から building_citygml に格納する属性を読み出す"""
+    measured_height = building.find(f'{{{BLDG_NS}}}measuredHeight')
+    geom_property = building.find(f'{{{BLDG_NS}}}{lod0_type}')
+    return {
+        'gml_id': building.get(GML_ID),
+        '建物id': _read_building_id(building),
+        'measuredheight': None if measured_height is None else _to_float(measured_height.text),
+        'measuredheight_uom': None if measured_height is None else measured_height.get('uom'),
+        'usage': _to_int(building.findtext(f'{{{BLDG_NS}}}usage')) or 0,
+        'buildingStructureType_uro': _to_int(_find_text(building, '{*}buildingStructureType')) or 0,
+        'buildingFootprintArea_uro': _to_float(_find_text(building, '{*}buildingFootprintArea')) or 0,
+        'storeysAboveGround': _to_int(building.findtext(f'{{{BLDG_NS}}}storeysAboveGround')) or 0,
+        'storeysBelowGround': _to_int(building.findtext(f'{{{BLDG_NS}}}storeysBelowGround')) or 0,
+        'yearOfConstruction': _to_int(building.findtext(f'{{{BLDG_NS}}}yearOfConstruction')) or 0,
+        'lod0geom': None if geom_property is None else polygons_to_ewkb(_read_polygons(geom_property)),
+    }
+
+
+def iter_buildings(source, lod0_type: str) -> Iterator[dict]:
+    """
+    gmlファイルから bldg:Building を1件ずつ読み出す。
+    読み終えた要素と app:appearanceMember は破棄するので、ファイルサイズによらずメモリ使用量は一定に保たれる。
+    """
+    context = etree.iterparse(source, events=('end',), tag=(f'{{{BLDG_NS}}}Building', '{*}appearanceMember'),
+                              huge_tree=True, remove_blank_text=True)
+    for _, building in context:
+        if building.tag.endswith('}appearanceMember'):
+            # テクスチャ情報は使わないので、読み終えたら木から取り除く
+            building.clear()
+            if building.getparent() is not None:
+                building.getparent().remove(building)
+            continue
+        yield read_building(building, lod0_type)
+        # 処理済みの要素とその前の兄弟要素 (core:cityObjectMember) を破棄する
+        building.clear()
+        member = building.getparent()
+        if member is not None and member.getparent() is not None:
+            while member.getprevious() is not None:
+                del member.getparent()[0]
+    del context
+
+
+def _read_windows(src: str, chunk_size: int) -> Iterator[bytes]:
+    """
+    gmlファイルを chunk_size バイトずつ読み、チャンク境界で分断されたタグも見つかるよう
+    前のチャンクの末尾 _CARRY_SIZE バイトを先頭に付けて返す
+    """
+    tail = b''
+    with open(src, 'rb') as fin:
+        while True:
+            chunk = fin.read(chunk_size)
+            if not chunk:
+                return
+            window = tail + chunk
+            yield window
+            tail = window[-_CARRY_SIZE:]
+
+
+def detect_lod0_type(src: str, chunk_size: int = 1 << 20) -> Optional[str]:
+    """
+    gmlファイルを書き換えずに読み、lod0RoofEdge / lod0FootPrint のどちらが使われているかを判定する
+    (lod0RoofEdge が見つかった時点で読むのをやめる)。どちらもない場合は None を返す
+    """
+    found = set()
+    for window in _read_windows(src, chunk_size):
+        found.update(t for t in LOD0_TYPES if t in window)
+        if LOD0_TYPES[0] in found:
+            break
+    return next((t.decode() for t in LOD0_TYPES if t in found), None)
+
+
+def has_appearance_members(src: str, chunk_size: int = 1 << 20) -> bool:
+    """gmlファイルを書き換えずに読み、app:appearanceMember 要素があるかどうかを返す"""
+    return any(_APPEARANCE_START.search(window) for window in _read_windows(src, chunk_size))
+
+
+def strip_appearance_members(src: str, dst: str, chunk_size: int = 1 << 20) -> tuple:
+    """
+    gmlファイルを chunk_size バイトずつ dst にコピーしながら、すべての app:appearanceMember 要素を取り除く。
+    同時に lod0RoofEdge / lod0FootPrint のどちらが使われているかを判定する。
+    メモリ使用量はファイルサイズによらず chunk_size 程度に収まる。
+
+    Returns
+    -------
+    (取り除いた要素数, lod0の種類 ("lod0RoofEdge" / "lod0FootPrint" / None))
+    """
+    removed = 0
+    found = set()
+    detect_tail = b''
+    buf = b''
+    state = 'out'  # 'out': 要素外, 'start': 開始タグ内, 'body': 要素内
+    end_tag = b''
+
+    def write(data: bytes):
+        nonlocal detect_tail
+        if not data:
+            return
+        if LOD0_TYPES[0] not in found:
+            window = detect_tail + data
+            found.update(t for t in LOD0_TYPES if t in window)
+            detect_tail = window[-_CARRY_SIZE:]
+        fout.write(data)
+
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        while True:
+            chunk = fin.read(chunk_size)
+            eof = not chunk
+            buf += chunk
+            while True:
+                if state == 'out':
+                    m = _APPEARANCE_START.search(buf)
+                    if m is None:
+                        keep = 0 if eof else min(len(buf), _CARRY_SIZE)
+                        write(buf[:len(buf) - keep])
+                        buf = buf[len(buf) - keep:]
+                        break
+                    write(buf[:m.start()])
+                    end_tag = b'</' + (m.group(1) or b'') + b'appearanceMember'
+                    buf = buf[m.end():]
+                    state = 'start'
+                    removed += 1
+                if state == 'start':
+                    idx = buf.find(b'>')
+                    if idx == -1:
+                        buf = b'' if eof else buf
+                        break
+                    # <app:appearanceMember xlink:href="..."/> の場合は開始タグだけで終わる
+                    state = 'out' if buf[idx - 1:idx] == b'/' else 'body'
+                    buf = buf[idx + 1:]
+                if state == 'body':
+                    idx = buf.find(end_tag)
+                    close = -1 if idx == -1 else buf.find(b'>', idx)
+                    if close == -1:
+                        keep = len(buf) if idx != -1 else min(len(buf), len(end_tag))
+                        buf = b'' if eof else buf[len(buf) - keep:]
+                        break
+                    buf = buf[close + 1:]
+                    state = 'out'
+            if eof:
+                break
+
+    lod0_type = next((t.decode() for t in LOD0_TYPES if t in found), None)
+    return removed, lod0_type
+
+
+def _encode_field(value, field_type: str) -> bytes:
+    if value is None:
+        return struct.pack('!i', -1)
+    if field_type == 'text':
+        data = str(value).encode('utf-8')
+    elif field_type == 'float8':
+        data = struct.pack('!d', value)
+    elif field_type == 'int4':
+        data = struct.pack('!i', value)
+    else:
+        data = value
+    return struct.pack('!i', len(data)) + data
+
+
+def encode_copy_binary(rows: Iterable[dict]) -> Iterator[bytes]:
+    """行データを PostgreSQL のバイナリ COPY 形式のバイト列に変換する"""
+    yield _COPY_HEADER
+    field_count = struct.pack('!h', len(COPY_COLUMNS))
+    for row in rows:
+        yield field_count + b''.join(
+            _encode_field(row.get(name.strip('"')), field_type) for name, field_type in COPY_COLUMNS)
+    yield _COPY_TRAILER
+
+
+class IteratorStream(io.RawIOBase):
+    """バイト列のイテレータを copy_expert に渡せるファイルライクオブジェクトにする"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self.buffer:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.buffer = chunk
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+def copy_buildings(conn, rows: Iterable[dict], filename: str, user_id: str, session_id: str) -> int:
+    """
+    bldg:Building の属性を COPY ... FROM STDIN (BINARY) で building_citygml に書き込み、
+    書き込んだ件数を返す。
+    """
+    count = 0
+
+    def session_rows():
+        nonlocal count
+        for row in rows:
+            row.update(filename=filename, user_id=user_id, session_id=session_id)
+            count += 1
+            yield row
+
+    columns = ', '.join(name for name, _ in COPY_COLUMNS)
+    stream = io.BufferedReader(IteratorStream(encode_copy_binary(session_rows())), buffer_size=1 << 16)
+    conn.cursor().copy_expert(
+        f"COPY building_citygml ({columns}) FROM STDIN WITH (FORMAT binary)", stream, size=1 << 16)
+    return count
@@ -0,0 +1,230 @@
+"""
+不動産IDを付与した CityGML を出力するモジュール。
+
+write_enriched_gml: 文書全体を etree.parse で読み込まず、iterparse でルート直下の要素
+(core:cityObjectMember など) を1件ずつ読み出して書き出す。
+出力結果は etree.indent(tree, space="\t") + tree.write(pretty_print=True) と同一になる。
+
+splice_enriched_gml: 元のファイルのバイト列をそのまま書き出し、付与する建物の </bldg:Building> の直前にだけ
+uro:bldgRealEstateIDAttribute の断片を挿入する。XML として解析・直列化しないので、
+処理時間は主に付与する建物の数で決まり、付与しない部分の書式 (インデント, 改行, 属性の順序など) は変わらない。
+"""
+import mmap
+import re
+from typing import Callable, Optional
+from xml.sax.saxutils import escape, quoteattr
+
+from lxml import etree
+
+GML_NS = 'http://www.opengis.net/gml'
+BLDG_NS = 'http://www.opengis.net/citygml/building/2.0'
+BUILDING_TAG = f'{{{BLDG_NS}}}Building'
+
+INDENT = "\t"
+
+# splice_enriched_gml で一度に書き出すバイト数の上限
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
+_XML_ENCODING = re.compile(rb'^<\?xml[^>]*encoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']')
+
+
+def _start_tag(element: etree._Element) -> bytes:
+    """子要素を持たない要素を直列化し、開始タグだけを取り出す"""
+    data = etree.tostring(element, encoding='utf-8')
+    if data.endswith(b'/>'):
+        return data[:-2] + b'>'
+    return data[:data.index(b'>') + 1]
+
+
+def write_enriched_gml(src: str, dst: str, uro_uri_default: str,
+                       enrich: Callable[[etree._Element, str], bool]) -> int:
+    """
+    src の CityGML を読み、bldg:Building ごとに enrich(building, uro_uri) を呼び出してから dst に書き出す。
+    enrich が True を返した建物の数を返す。
+    """
+    matched = 0
+    root = None
+    wrapper = None
+    uro_uri = uro_uri_default
+    depth = 0
+    written = 0
+
+    with open(dst, 'wb') as fout:
+        fout.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+        for event, element in etree.iterparse(src, events=('start', 'end'), huge_tree=True):
+            if event == 'start':
+                depth += 1
+                if root is None:
+                    root = element
+                    uro_uri = (root.nsmap or {}).get('uro', uro_uri_default)
+                    fout.write(_start_tag(root))
+                    # ルート直下の要素を書き出すための入れ物。ルートと同じ名前空間を宣言しておくことで、
+                    # 要素ごとに名前空間宣言が重複して出力されるのを防ぐ
+                    wrapper = etree.Element(root.tag, nsmap=root.nsmap)
+                continue
+
+            depth -= 1
+            if depth != 1:
+                continue
+
+            # ルート直下の要素が読み終わったら、その要素までを書き出して破棄する
+            while len(root):
+                child = root[0]
+                if isinstance(child.tag, str):
+                    for building in list(child.iter(BUILDING_TAG)):
+                        if enrich(building, uro_uri):
+                            matched += 1
+                    etree.indent(child, space=INDENT, level=1)
+                child.tail = None
+                wrapper.append(child)
+                data = etree.tostring(wrapper, encoding='utf-8')
+                wrapper.remove(child)
+                fout.write(b"\n" + INDENT.encode() + data[data.index(b'>') + 1:data.rindex(b'</')])
+                written += 1
+                if child is element:
+                    break
+
+        if root is not None:
+            if written == 0:
+                fout.seek(fout.tell() - 1)
+                fout.write(b"/>\n")
+            else:
+                name = f"{root.prefix}:{etree.QName(root).localname}" if root.prefix else etree.QName(root).localname
+                fout.write(f"\n</{name}>\n".encode('utf-8'))
+    return matched
+
+
+def _root_namespaces(src: str) -> dict:
+    """src のルート要素で宣言された名前空間 {接頭辞: URI} を返す (ルートの開始タグまでしか読まない)"""
+    for _, element in etree.iterparse(src, events=('start',), huge_tree=True):
+        return dict(element.nsmap or {})
+    return {}
+
+
+def _prefix_of(nsmap: dict, uri: str) -> Optional[str]:
+    """nsmap で uri に対応する接頭辞 (既定の名前空間の場合は '') を返す。宣言されていなければ None"""
+    for prefix, value in nsmap.items():
+        if value == uri:
+            return prefix or ''
+    return None
+
+
+def _qualified(prefix: str, name: str) -> str:
+    return f"{prefix}:{name}" if prefix else name
+
+
+def estate_id_fragment(attributes: list, uro_prefix: str, xmlns: str = "", indent: Optional[str] = None) -> str:
+    """
+    不動産IDの属性のリスト [{"name", "value"}] から uro:bldgRealEstateIDAttribute 要素の文字列を作成する。
+    indent は bldg:Building の終了タグの行のインデントで、None の場合は改行・インデントを入れない
+    """
+    main_tag = _qualified(uro_prefix, "bldgRealEstateIDAttribute")
+    sub_tag = _qualified(uro_prefix, "RealEstateIDAttribute")
+    if indent is None:
+        children = "".join(
+            f"<{_qualified(uro_prefix, tag['name'])}>{escape(tag['value'])}</{_qualified(uro_prefix, tag['name'])}>"
+            for tag in attributes)
+        return f"<{main_tag}{xmlns}><{sub_tag}>{children}</{sub_tag}></{main_tag}>"
+    lines = [f"{INDENT}<{main_tag}{xmlns}>", f"{INDENT * 2}<{sub_tag}>"]
+    lines.extend(
+        f"{INDENT * 3}<{_qualified(uro_prefix, tag['name'])}>{escape(tag['value'])}"
+        f"</{_qualified(uro_prefix, tag['name'])}>"
+        for tag in attributes)
+    lines.extend((f"{INDENT * 2}</{sub_tag}>", f"{INDENT}</{main_tag}>"))
+    return "".join(f"{indent}{line}\n" for line in lines) + indent
+
+
+def splice_enriched_gml(src: str, dst: str, uro_uri_default: str,
+                        attributes: Callable[[str], Optional[list]]) -> int:
+    """
+    src の CityGML の bldg:Building ごとに attributes(gml_id) を呼び出し、
+    属性のリスト [{"name", "value"}] が返された建物の終了タグの直前に uro:bldgRealEstateIDAttribute を挿入して、
+    dst に書き出す。それ以外のバイト列は src のまま書き出す。属性を挿入した建物の数を返す。
+
+    付与する名前空間 (uro) は write_enriched_gml と同じく、ルートで uro の接頭辞が宣言されていればその URI、
+    なければ uro_uri_default を使う。ルートで宣言されていない場合は、挿入する要素で宣言する。
+    bldg:Building の開始タグ・終了タグはルートで宣言された接頭辞で探すので、コメントや CDATA の中の
+    タグ、ルート以外で宣言された接頭辞は考慮しない。
+    """
+    nsmap = _root_namespaces(src)
+    bldg_prefix = _prefix_of(nsmap, BLDG_NS)
+    gml_prefix = _prefix_of(nsmap, GML_NS)
+    if bldg_prefix is None or gml_prefix is None:
+        # 建物がない (または名前空間が宣言されていない) ファイルはそのまま書き出す
+        with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+            while True:
+                chunk = fin.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                fout.write(chunk)
+        return 0
+
+    uro_uri = nsmap.get('uro', uro_uri_default)
+    uro_prefix = _prefix_of(nsmap, uro_uri)
+    xmlns = ""
+    if uro_prefix is None:
+        uro_prefix = 'uro'
+        xmlns = f' xmlns:uro={quoteattr(uro_uri)}'
+
+    building_name = re.escape(_qualified(bldg_prefix, "Building").encode())
+    start_tag = re.compile(rb'<' + building_name + rb'(?=[\s/>])([^>]*)>')
+    end_tag = re.compile(rb'</' + building_name + rb'\s*>')
+    gml_id = re.compile(rb'(?:^|\s)' + re.escape(_qualified(gml_prefix, "id").encode())
+                        + rb'\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+    matched = 0
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        if fin.seek(0, 2) == 0:
+            return 0
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            declaration = _XML_ENCODING.match(data[:256])
+            encoding = declaration.group(1).decode('ascii') if declaration else 'utf-8'
+
+            def copy(begin: int, end: int):
+                for position in range(begin, end, COPY_CHUNK_SIZE):
+                    fout.write(data[position:min(position + COPY_CHUNK_SIZE, end)])
+
+            copied = 0
+            position = 0
+            while True:
+                start = start_tag.search(data, position)
+                if start is None:
+                    break
+                position = start.end()
+                found = gml_id.search(start.group(1))
+                if found is None:
+                    continue
+                tag_order_list = attributes((found.group(1) or found.group(2)).decode(encoding))
+                if tag_order_list is None:
+                    continue
+
+                if start.group(1).rstrip().endswith(b'/'):
+                    # 子要素のない <bldg:Building .../> は、開始タグと終了タグに分けて挿入する
+                    copy(copied, start.start(1) + start.group(1).rindex(b'/'))
+                    fragment = estate_id_fragment(tag_order_list, uro_prefix, xmlns)
+                    fout.write(f">{fragment}</{_qualified(bldg_prefix, 'Building')}>".encode(encoding))
+                    copied = start.end()
+                    matched += 1
+                    continue
+
+                end = end_tag.search(data, position)
+                if end is None:
+                    break
+                # 終了タグの行のインデントに合わせて挿入する (終了タグが行頭にない場合は改行しない)
+                line_start = data.rfind(b'\n', position, end.start()) + 1
+                indent = data[line_start:end.start()] if line_start > 0 else None
+                if indent is not None and indent.strip():
+                    indent = None
+                fragment = estate_id_fragment(
+                    tag_order_list, uro_prefix, xmlns, None if indent is None else indent.decode(encoding))
+                if indent is None:
+                    copy(copied, end.start())
+                else:
+                    # インデントは挿入する文字列に含めるので、行頭までを書き出す
+                    copy(copied, line_start)
+                fout.write(fragment.encode(encoding))
+                copied = end.start()
+                position = end.end()
+                matched += 1
+            copy(copied, len(data))
+    return matched
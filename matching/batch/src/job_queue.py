@@ -0,0 +1,230 @@
+"""
+常駐するワーカー (worker.py) が処理するセッションのジョブのキューを扱うモジュール。
+
+ジョブは {"user_id": ..., "session_id": ...} の JSON で、/receipt_request が AWS Batch に渡す環境変数と同じ内容。
+キューは環境変数 ESTATE_ID_WORKER_QUEUE (またはコマンドライン引数 --queue) で指定する。
+
+- sqs://... または https://sqs.... : Amazon SQS のキュー (本番用)
+- file:<ディレクトリ> : ディレクトリの JSON ファイル (ローカルでの試験用)
+- postgres : バッチ処理のDBの worker_job_queue テーブル (ローカルでの試験用)
+
+receive() はジョブを1件取り出して Job を返し (なければ None)、処理が終わったら ack()、失敗したら fail() を呼び出す。
+fail() したジョブはもう一度取り出され、session_ledger の記録から続きの処理を行う
+(SQS では再配信の上限を redrive policy で設定する)。
+SQS ではワーカーが途中で終了したジョブも可視性タイムアウトの後に再配信されるが、
+試験用のキューでは running のまま残るので、手動で pending に戻す。
+"""
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+import boto3
+
+import db
+
+# SQS のロングポーリングの待ち時間 (秒)
+SQS_WAIT_SECONDS = 20
+# 処理中のジョブの可視性タイムアウトを延長する間隔と、延長する長さ (秒)
+SQS_HEARTBEAT_SECONDS = 60
+SQS_VISIBILITY_SECONDS = 300
+# file: と postgres のキューで、ジョブがない場合に待つ時間 (秒)
+POLL_SECONDS = 1.0
+# file: と postgres のキューでジョブを取り出す回数の上限 (超えたジョブは failed にする)
+MAX_ATTEMPTS = 3
+
+
+class Job:
+    """キューから取り出したジョブ"""
+
+    def __init__(self, user_id: str, session_id: str, handle, attempts: int):
+        self.user_id = user_id
+        self.session_id = session_id
+        # キューごとの受信ハンドル (SQS の ReceiptHandle, ファイルのパス, テーブルの id)
+        self.handle = handle
+        # 取り出した回数 (1回目は 1)
+        self.attempts = attempts
+        # SQS の可視性タイムアウトの延長を止めるイベント
+        self.heartbeat = None
+
+
+def parse_body(body: str) -> tuple:
+    """ジョブの JSON から (user_id, session_id) を取り出す"""
+    message = json.loads(body)
+    return message["user_id"], message["session_id"]
+
+
+def job_body(user_id: str, session_id: str) -> str:
+    return json.dumps({"user_id": user_id, "session_id": session_id}, ensure_ascii=False)
+
+
+class SqsQueue:
+    """Amazon SQS のキュー"""
+
+    def __init__(self, queue_url: str):
+        if queue_url.startswith("sqs://"):
+            queue_url = "https://" + queue_url[len("sqs://"):]
+        self.queue_url = queue_url
+        self.client = boto3.client("sqs")
+
+    def receive(self) -> Optional[Job]:
+        response = self.client.receive_message(
+            QueueUrl=self.queue_url, MaxNumberOfMessages=1, WaitTimeSeconds=SQS_WAIT_SECONDS,
+            VisibilityTimeout=SQS_VISIBILITY_SECONDS, AttributeNames=["ApproximateReceiveCount"])
+        messages = response.get("Messages", [])
+        if not messages:
+            return None
+        message = messages[0]
+        try:
+            user_id, session_id = parse_body(message["Body"])
+        except (ValueError, KeyError) as err:
+            # ジョブとして読めないメッセージは削除する
+            print(err)
+            print(f"ジョブとして読めないメッセージを削除: {message['Body']}")
+            self.client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message["ReceiptHandle"])
+            return None
+        job = Job(user_id, session_id, message["ReceiptHandle"],
+                  int(message.get("Attributes", {}).get("ApproximateReceiveCount", 1)))
+        # 処理中は可視性タイムアウトを延長し続け、他のワーカーにジョブが再配信されないようにする
+        stop = threading.Event()
+        thread = threading.Thread(target=self._heartbeat, args=(job.handle, stop), daemon=True)
+        thread.start()
+        job.heartbeat = stop
+        return job
+
+    def _heartbeat(self, handle: str, stop: threading.Event):
+        while not stop.wait(SQS_HEARTBEAT_SECONDS):
+            try:
+                self.client.change_message_visibility(
+                    QueueUrl=self.queue_url, ReceiptHandle=handle, VisibilityTimeout=SQS_VISIBILITY_SECONDS)
+            except Exception as err:
+                print(err)
+                print("ジョブの可視性タイムアウトの延長に失敗")
+
+    def ack(self, job: Job):
+        job.heartbeat.set()
+        self.client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=job.handle)
+
+    def fail(self, job: Job):
+        # メッセージを削除せず、可視性タイムアウトが切れたら再配信する
+        job.heartbeat.set()
+
+    def enqueue(self, user_id: str, session_id: str):
+        self.client.send_message(QueueUrl=self.queue_url, MessageBody=job_body(user_id, session_id))
+
+
+class FileQueue:
+    """
+    ディレクトリを使ったキュー。
+    pending/ の JSON ファイルを running/ に移動 (rename) して取り出すので、複数のワーカーで同じジョブを取り出すことはない。
+    ack() したジョブは削除し、fail() したジョブは pending/ に戻す (取り出した回数が上限に達したら failed/ に移動する)
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        for name in ("pending", "running", "failed"):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    def receive(self) -> Optional[Job]:
+        pending = os.path.join(self.directory, "pending")
+        for name in sorted(os.listdir(pending)):
+            running = os.path.join(self.directory, "running", name)
+            try:
+                os.rename(os.path.join(pending, name), running)
+            except FileNotFoundError:
+                # 他のワーカーが先に取り出した
+                continue
+            with open(running, encoding="utf-8") as f:
+                message = json.load(f)
+            attempts = message.get("attempts", 0) + 1
+            return Job(message["user_id"], message["session_id"], running, attempts)
+        time.sleep(POLL_SECONDS)
+        return None
+
+    def ack(self, job: Job):
+        os.remove(job.handle)
+
+    def fail(self, job: Job):
+        name = os.path.basename(job.handle)
+        destination = "failed" if job.attempts >= MAX_ATTEMPTS else "pending"
+        with open(job.handle, "w", encoding="utf-8") as f:
+            json.dump({"user_id": job.user_id, "session_id": job.session_id, "attempts": job.attempts},
+                      f, ensure_ascii=False)
+        os.rename(job.handle, os.path.join(self.directory, destination, name))
+
+    def enqueue(self, user_id: str, session_id: str):
+        name = f"{time.time_ns():020d}_{os.getpid()}.json"
+        path = os.path.join(self.directory, "pending", name)
+        # 書きかけのファイルを取り出さないよう、書き終えてから pending/ に移動する
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(job_body(user_id, session_id))
+        os.rename(path + ".tmp", path)
+
+
+class PostgresQueue:
+    """
+    バッチ処理のDBの worker_job_queue テーブルを使ったキュー。
+    FOR UPDATE SKIP LOCKED で取り出すので、複数のワーカーで同じジョブを取り出すことはない
+    """
+
+    def __init__(self):
+        with db.transaction() as conn:
+            conn.cursor().execute('''
+            CREATE TABLE IF NOT EXISTS worker_job_queue (
+                id bigserial PRIMARY KEY,
+                user_id varchar(255) NOT NULL,
+                session_id varchar(255) NOT NULL,
+                -- pending, running, done, failed
+                status varchar(16) NOT NULL DEFAULT 'pending',
+                attempts integer NOT NULL DEFAULT 0,
+                enqueued_at timestamp with time zone NOT NULL DEFAULT now(),
+                started_at timestamp with time zone NULL,
+                finished_at timestamp with time zone NULL
+            );
+            CREATE INDEX IF NOT EXISTS worker_job_queue_pending_idx ON worker_job_queue (id) WHERE status = 'pending';
+            ''')
+
+    def receive(self) -> Optional[Job]:
+        with db.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+            UPDATE worker_job_queue q
+            SET status = 'running', attempts = q.attempts + 1, started_at = now()
+            WHERE q.id = (
+                SELECT id FROM worker_job_queue WHERE status = 'pending' ORDER BY id
+                FOR UPDATE SKIP LOCKED LIMIT 1)
+            RETURNING q.id, q.user_id, q.session_id, q.attempts
+            ''')
+            row = cursor.fetchone()
+        if row is None:
+            time.sleep(POLL_SECONDS)
+            return None
+        return Job(row[1], row[2], row[0], row[3])
+
+    def ack(self, job: Job):
+        self._finish(job, "done")
+
+    def fail(self, job: Job):
+        self._finish(job, "failed" if job.attempts >= MAX_ATTEMPTS else "pending")
+
+    def _finish(self, job: Job, status: str):
+        with db.transaction() as conn:
+            conn.cursor().execute(
+                "UPDATE worker_job_queue SET status = %s, finished_at = now() WHERE id = %s", (status, job.handle))
+
+    def enqueue(self, user_id: str, session_id: str):
+        with db.transaction() as conn:
+            conn.cursor().execute(
+                "INSERT INTO worker_job_queue (user_id, session_id) VALUES (%s, %s)", (user_id, session_id))
+
+
+def open_queue(spec: str):
+    """キューの指定 spec からキューを開く"""
+    if spec.startswith("sqs://") or spec.startswith("https://sqs."):
+        return SqsQueue(spec)
+    if spec.startswith("file:"):
+        return FileQueue(spec[len("file:"):])
+    if spec == "postgres":
+        return PostgresQueue()
+    raise ValueError(f"キューの指定が不正です: {spec}")
@@ -0,0 +1,71 @@
+"""
+セッションの処理の進み具合を session_ledger テーブルに記録するモジュール。
+
+ファイルごとに完了した段階 (import, match, score, enrich) を、その段階の処理と同じトランザクションで記録する。
+ジョブが途中で終了 (Spot インスタンスの中断, DB のフェイルオーバーなど) した後に同じセッションで再実行すると、
+記録のある段階は実行せず、記録のない段階だけをやり直す。記録とデータは同時にコミットされるので、
+途中まで処理したファイルのデータは残らず、やり直すのは中断時に処理中だったファイルだけになる。
+
+セッション全体に対する記録 (ジョブの開始と出力先のフォルダ名, セッション単位のマッチング) は
+filename を SESSION として記録する。セッションの処理が完了したら、作業用テーブルと一緒に記録も削除する。
+"""
+from typing import Optional
+
+import db
+
+# セッション全体に対する記録の filename
+SESSION = ''
+
+MARK_SQL = """
+INSERT INTO session_ledger (user_id, session_id, filename, stage, detail)
+VALUES ($1, $2, $3, $4, $5)
+ON CONFLICT (user_id, session_id, filename, stage) DO UPDATE
+SET detail = EXCLUDED.detail, completed_at = now()
+"""
+
+
+def create_table(conn):
+    """記録のテーブルを作成する"""
+    conn.cursor().execute('''
+    CREATE TABLE IF NOT EXISTS session_ledger (
+        user_id varchar(255) NOT NULL,
+        session_id varchar(255) NOT NULL,
+        filename varchar(255) NOT NULL,
+        stage varchar(16) NOT NULL,
+        -- 段階ごとの補足情報 (started は出力先のフォルダ名, import はインポートした件数)
+        detail text NULL,
+        completed_at timestamp with time zone NOT NULL DEFAULT now(),
+        PRIMARY KEY (user_id, session_id, filename, stage)
+    );
+    ''')
+
+
+def load(conn, user_id: str, session_id: str) -> dict:
+    """セッションの記録を {ファイル名: {段階: 補足情報}} で返す"""
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT filename, stage, detail FROM session_ledger WHERE user_id = %s AND session_id = %s",
+        (user_id, session_id))
+    progress = {}
+    for filename, stage, detail in cursor.fetchall():
+        progress.setdefault(filename, {})[stage] = detail
+    return progress
+
+
+def mark(conn, user_id: str, session_id: str, file: str, stage: str, detail: Optional[str] = None):
+    """file の stage が完了したことを記録する (conn のトランザクションと一緒にコミットされる)"""
+    db.execute_prepared(conn, "mark_ledger", MARK_SQL, (user_id, session_id, file, stage, detail))
+
+
+def forget(conn, user_id: str, session_id: str, files: list, stage: Optional[str] = None):
+    """files の記録 (stage を指定した場合はその段階の記録) を削除し、処理し直すようにする"""
+    conn.cursor().execute(
+        """DELETE FROM session_ledger
+        WHERE user_id = %s AND session_id = %s AND filename = ANY(%s) AND (%s IS NULL OR stage = %s)""",
+        (user_id, session_id, files, stage, stage))
+
+
+def clear(conn, user_id: str, session_id: str):
+    """セッションのすべての記録を削除する"""
+    conn.cursor().execute(
+        "DELETE FROM session_ledger WHERE user_id = %s AND session_id = %s", (user_id, session_id))
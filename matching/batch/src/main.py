@@ -1,16 +1,42 @@
+import argparse
 import boto3
+import multiprocessing
 import os
 import subprocess
 import psycopg2
 import datetime
-import shutil
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterable, Iterator
 
 from dotenv import load_dotenv
 from lxml import etree
 from pytz import timezone
 
-input_dir = f"data/input/{os.environ.get('ESTATE_ID_USER_ID')}/{os.environ.get('ESTATE_ID_SESSION_ID')}"
-output_dir = f"data/output/{os.environ.get('ESTATE_ID_USER_ID')}/{os.environ.get('ESTATE_ID_SESSION_ID')}"
+import db
+import ledger
+import match_cache
+import mesh
+import metrics
+import s3_transfer
+import scoring
+import sidecar_export
+import working_tables
+from gml_output import splice_enriched_gml, write_enriched_gml
+from gml_import import (copy_buildings, detect_lod0_type, has_appearance_members, iter_buildings,
+                        strip_appearance_members)
+from output_archive import OutputArchive
+from scoring_python import score_candidates_python
+
+
+def session_dirs() -> tuple:
+    """環境変数 ESTATE_ID_USER_ID, ESTATE_ID_SESSION_ID のセッションの (入力ディレクトリ, 出力ディレクトリ)"""
+    session = f"{os.environ.get('ESTATE_ID_USER_ID')}/{os.environ.get('ESTATE_ID_SESSION_ID')}"
+    return f"data/input/{session}", f"data/output/{session}"
+
+
+input_dir, output_dir = session_dirs()
 
 namespaces = {'gml': 'http://www.opengis.net/gml',
               'bldg': 'http://www.opengis.net/citygml/building/2.0',
@@ -18,71 +44,506 @@ namespaces = {'gml': 'http://www.opengis.net/gml',
               'uro': 'https://www.geospatial.jp/iur/uro/3.0',
               'real': 'http://www.example.com/citygml/realpropertyid/2.0'}
 
+def write_metrics(args: argparse.Namespace, folder_name: str, started_at: datetime.datetime, wall_start: float):
+    """
+    段階ごとの計測値を1つの JSON 文書にまとめて標準出力 (CloudWatch Logs) に1行で出力し、
+    出力したCityGMLファイルのZIPと同じ場所 ({folder_name}.metrics.json) にも保存する
+    """
+    job = {
+        "user_id": os.environ.get('ESTATE_ID_USER_ID'),
+        "session_id": os.environ.get('ESTATE_ID_SESSION_ID'),
+        "folder": folder_name,
+        "match_scope": args.match_scope,
+        "workers": args.workers,
+        "started_at": started_at.isoformat(),
+    }
+    document = metrics.report(job, time.perf_counter() - wall_start)
+    print(document)
+
+    metrics_path = os.path.join(output_dir, folder_name + ".metrics.json")
+    try:
+        if int(os.environ.get('NO_USE_IAM_MODE')) == 0:
+            s3_transfer.get_s3_client().put_object(
+                Bucket=os.environ["BUCKET_NAME"], Key=metrics_path,
+                Body=document.encode('utf-8'), ContentType='application/json')
+        else:
+            with open(metrics_path, 'w', encoding='utf-8') as f:
+                f.write(document)
+    except Exception as err:
+        # 計測値の保存に失敗しても、ジョブの結果には影響させない
+        print(err)
+        print(f"{metrics_path}の保存に失敗")
+
+
 def main():
     load_dotenv()
+    run_job(parse_args())
+
 
-    download_file_from_s3()
-    gml2postgis()
+def run_job(args: argparse.Namespace, executor: ProcessPoolExecutor = None):
+    """
+    環境変数 ESTATE_ID_USER_ID, ESTATE_ID_SESSION_ID のセッションのCityGMLに不動産IDを付与する。
+    常駐するワーカー (worker.py) からは、セッションごとに環境変数と input_dir, output_dir を設定して呼び出す。
+    executor を指定した場合は、ジョブをまたいで使うそのプロセスプールでファイルを並列に処理する
+    """
+    global current_job
+    started_at = datetime.datetime.now()
+    wall_start = time.perf_counter()
+    current_job = (os.environ.get('ESTATE_ID_USER_ID'), os.environ.get('ESTATE_ID_SESSION_ID'),
+                   input_dir, output_dir, time.time_ns())
 
     print("initialize")
-    create_working_table()
+    # ステージングモードでセッション単位にマッチングする場合は、インデックスを投入後に作成する
+    staging = working_tables.use_staging_mode()
+    defer_indexes = staging and args.match_scope == "session"
+    if staging:
+        print("*** ステージングモード (UNLOGGED) ***")
+    create_import_table(staging, defer_indexes)
+    create_working_table(staging, defer_indexes)
+    with db.transaction() as conn:
+        if match_cache.use_match_cache():
+            match_cache.create_table(conn)
+        ledger.create_table(conn)
+        folder_name, progress = start_session(conn)
+
+    # 出力先のフォルダを作成
+    os.makedirs(os.path.join(output_dir, folder_name), exist_ok=True)
 
     print("マッチング開始")
-    use_other_data_flag = os.environ.get('USE_ESTATE_ID_CONFIRMATION_SYSTEM')
-    if use_other_data_flag == "1":
-        match_to_estate_id_confirmation_system()
+    if use_confirmation_system():
+        print("*** 不動産ID確認システムのデータでマッチング ***")
+        print(f"ESTATE_ID_CONFIRMATION_SYSTEM_RATE_LIMIT: {os.environ.get('ESTATE_ID_CONFIRMATION_SYSTEM_RATE_LIMIT')}")
+        print(f"ESTATE_ID_CONFIRMATION_SYSTEM_AREA_MIN: {os.environ.get('ESTATE_ID_CONFIRMATION_SYSTEM_AREA_MIN')}")
+        print(f"ESTATE_ID_CONFIRMATION_SYSTEM_AREA_MAX: {os.environ.get('ESTATE_ID_CONFIRMATION_SYSTEM_AREA_MAX')}")
     else:
-        match_to_estate_id()
-        calc_algorithm_flag()
+        print("*** オープンデータでマッチング ***")
 
-    add_estate_id_to_gml()
+    try:
+        # ダウンロードが終わったファイルから順に処理を始める
+        # (再開した場合、不動産IDの付与まで完了しているファイルはダウンロードしない)
+        files = download_file_from_s3(completed_files(progress, folder_name))
+        # 処理が終わったファイルから順に ZIP に追加し、S3 へのアップロードも並行して進める
+        archive = open_output_archive(folder_name)
+        try:
+            failed_files = run_pipeline(files, folder_name, args.workers, args.match_scope, archive, progress,
+                                        executor)
+            if failed_files:
+                print(f"処理に失敗したファイル: {', '.join(failed_files)}")
+
+            # 作業用テーブルのデータを削除する前に、マッチング結果を GeoParquet などでも出力する
+            export_sidecars(folder_name)
+            archive_and_upload(folder_name, archive)
+        except BaseException:
+            # 途中で失敗した場合は ZIP を完成させず、マルチパートアップロードを破棄する
+            # (完了したアップロードや、中止済みのアップロードに対しては何もしない)
+            archive.abort()
+            raise
+    finally:
+        write_metrics(args, folder_name, started_at, wall_start)
 
     print("desirialize")
 
 
-def download_file_from_s3():
-    """指定のS3バケットからinput_dir以下のgmlファイルをダウンロードする"""
-    s3_resource = boto3.resource(
-        service_name='s3'
-    )
+def parse_args() -> argparse.Namespace:
+    """コマンドライン引数を解析する"""
+    parser = argparse.ArgumentParser(description="CityGMLに不動産IDを付与する")
+    add_job_arguments(parser)
+    return parser.parse_args()
+
+
+def add_job_arguments(parser: argparse.ArgumentParser):
+    """ジョブの処理方法のコマンドライン引数を追加する (worker.py と共通)"""
+    parser.add_argument(
+        "--workers", type=int,
+        default=int(os.environ.get('ESTATE_ID_WORKERS', '1')),
+        help="ファイルを並列に処理するプロセス数 (環境変数 ESTATE_ID_WORKERS でも指定可能)")
+    parser.add_argument(
+        "--match-scope", choices=("file", "session"),
+        default=os.environ.get('ESTATE_ID_MATCH_SCOPE', 'file'),
+        help="マッチングをファイルごとに行うか、セッション単位で1回にまとめて行うか "
+             "(環境変数 ESTATE_ID_MATCH_SCOPE でも指定可能)")
+
+
+def list_input_files() -> list:
+    """input_dir以下の処理対象のgmlファイル名の一覧を返す"""
+    return sorted(file for file in os.listdir(input_dir) if file.endswith('.gml'))
+
+
+# ファイルごとに実行する処理
+FILE_STAGES = ("import", "match", "score", "enrich")
+
+
+def start_session(conn) -> tuple:
+    """
+    セッションの処理の記録 (ledger) を読み込み、(出力先のフォルダ名, ファイルごとの記録) を返す。
+    前回のジョブが途中で終了していた場合は同じフォルダ名で再開し、記録を返す (新しいセッションの場合は None)。
+    インポートの記録と作業用テーブルの件数が合わないファイル (UNLOGGED のパーティションが
+    DB のクラッシュで空になった場合など) は、記録を削除して最初から処理し直す。
+    """
+    user_id = os.environ.get('ESTATE_ID_USER_ID')
+    session_id = os.environ.get('ESTATE_ID_SESSION_ID')
+    progress = ledger.load(conn, user_id, session_id)
+    if "started" not in progress.get(ledger.SESSION, {}):
+        folder_name = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        ledger.mark(conn, user_id, session_id, ledger.SESSION, "started", folder_name)
+        return folder_name, None
+
+    folder_name = progress[ledger.SESSION]["started"]
+    print(f"前回のジョブ ({folder_name}) の続きから再開")
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT filename, count(*) FROM building_citygml WHERE user_id = %s AND session_id = %s GROUP BY filename",
+        (user_id, session_id))
+    imported = dict(cursor.fetchall())
+    lost = sorted(file for file, stages in progress.items()
+                  if file != ledger.SESSION and stages.get("import") is not None
+                  and imported.get(file, 0) != int(stages["import"]))
+    if lost:
+        print(f"作業用テーブルのデータがないため最初から処理し直すファイル: {', '.join(lost)}")
+        ledger.forget(conn, user_id, session_id, lost)
+        for file in lost:
+            del progress[file]
+        # セッション単位のマッチングもやり直す
+        ledger.forget(conn, user_id, session_id, [ledger.SESSION], "match")
+        progress[ledger.SESSION].pop("match", None)
+    done = [file for file in progress if file != ledger.SESSION]
+    print(f"前回のジョブで処理を始めていたファイル: {len(done)}件")
+    return folder_name, progress
+
+
+def completed_stages(progress: dict, file: str, folder_name: str) -> tuple:
+    """
+    記録から file の完了した段階を返す (新しいセッションの場合は None)。
+    不動産IDを付与したファイルが出力先にない場合 (別のコンテナで再開した場合など) は、付与をやり直す
+    """
+    if progress is None:
+        return None
+    stages = set(progress.get(file, {}))
+    if "enrich" in stages and not os.path.exists(os.path.join(output_dir, folder_name, file)):
+        stages.discard("enrich")
+    return tuple(sorted(stages))
+
+
+def completed_files(progress: dict, folder_name: str) -> set:
+    """不動産IDの付与まで完了していて、入力ファイルが不要なファイル"""
+    if progress is None:
+        return set()
+    return {file for file in progress
+            if file != ledger.SESSION and "enrich" in completed_stages(progress, file, folder_name)}
+
+
+def delete_file_rows(conn, file: str):
+    """前回のジョブで途中まで処理した file の作業用テーブルのデータを削除する"""
+    params = (os.environ.get('ESTATE_ID_USER_ID'), os.environ.get('ESTATE_ID_SESSION_ID'), file)
+    cursor = conn.cursor()
+    for table in working_tables.WORKING_TABLES:
+        cursor.execute(f"DELETE FROM {table} WHERE user_id = %s AND session_id = %s AND filename = %s", params)
+
+
+def init_worker():
+    """ワーカープロセスの初期化。プロセスごとにDB接続を1本だけ持つコネクションプールを作成する"""
+    load_dotenv()
+    db.init_pool(maxconn=1)
+
+
+def create_executor(workers: int) -> ProcessPoolExecutor:
+    """ファイルを並列に処理するプロセスプールを作成する"""
+    print(f"{workers}プロセスで並列処理")
+    # S3 からのダウンロードを別スレッドで行っている間にワーカープロセスを作ることがあるので、
+    # スレッドのロックを引き継がないよう fork ではなく spawn で起動する
+    # (spawn で起動したプロセスには親プロセスの DB の接続も引き継がれない)
+    return ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                               mp_context=multiprocessing.get_context("spawn"))
+
+
+# このプロセスで処理中のジョブ (ユーザID, セッションID, input_dir, output_dir, ジョブの開始時刻)。
+# 常駐ワーカーのプロセスプールはジョブをまたいで使うので、ファイルごとにジョブを渡してセッションを切り替える
+current_job = None
+
+
+def enter_job(job: tuple):
+    """
+    (ワーカープロセス) 処理するジョブを job に切り替える。
+    ジョブが変わった場合は、環境変数と input_dir, output_dir を設定し、ジョブごとに問い合わせ直す値を消去する
+    """
+    global current_job, input_dir, output_dir
+    if job == current_job:
+        return
+    user_id, session_id, input_dir, output_dir, _ = job
+    os.environ['ESTATE_ID_USER_ID'] = user_id
+    os.environ['ESTATE_ID_SESSION_ID'] = session_id
+    match_cache.forget_version()
+    current_job = job
+
+
+def process_job_file(job: tuple, *args) -> tuple:
+    """(ワーカープロセス) job のセッションに切り替えてから process_file を実行する"""
+    enter_job(job)
+    return process_file(*args)
+
+
+def use_confirmation_system() -> bool:
+    """不動産ID確認システムのデータでマッチングするかどうか"""
+    return os.environ.get('USE_ESTATE_ID_CONFIRMATION_SYSTEM') == "1"
+
+
+def use_splice_output() -> bool:
+    """
+    不動産IDを付与したCityGMLを、元のファイルのバイト列に属性を挿入して出力するかどうか
+    (環境変数 ESTATE_ID_GML_OUTPUT が splice の場合。既定の pretty はインデントを付け直して出力する)
+    """
+    return os.environ.get('ESTATE_ID_GML_OUTPUT', 'pretty') == 'splice'
+
+
+def get_candidate_source() -> str:
+    """
+    オープンデータでのマッチングで候補を取得するテーブル (環境変数 ESTATE_ID_CANDIDATE_SOURCE)。
+    master (既定): building_master, subdivided: building_master_subdivided, mesh_candidates: mesh_candidates
+    """
+    return os.environ.get('ESTATE_ID_CANDIDATE_SOURCE', 'master')
+
+
+def match_files(conn, files: list) -> int:
+    """files のマッチング処理を行い、追加したマッチングデータの件数を返す"""
+    if use_confirmation_system():
+        return match_to_estate_id_confirmation_system(conn, files)
+    return match_to_estate_id(conn, files)
+
+
+def process_file(file: str, folder_name: str, stages: tuple = FILE_STAGES, done: tuple = None) -> tuple:
+    """
+    1ファイル分の stages (インポート・マッチング・アルゴリズムフラグ設定・不動産ID付与) を、
+    1つのトランザクションで順に実行し、完了した段階を同じトランザクションで記録 (ledger) する。
+    done は前回のジョブで完了した段階で、それらは実行しない (新しいセッションの場合は None)。
+    例外はファイル単位で捕捉し、他のファイルの処理には影響させない。
+    処理結果 (成否, このファイルの処理で増えた接続数・SQL文数, 段階ごとの計測値) を返す。
+    """
+    stats_before = db.get_stats()
+    metrics_position = metrics.mark()
+    user_id = os.environ.get('ESTATE_ID_USER_ID')
+    session_id = os.environ.get('ESTATE_ID_SESSION_ID')
+    resumed = done is not None
+    stages = tuple(stage for stage in stages if stage not in (done or ()))
+    if resumed and not stages:
+        print(f"{file}は前回のジョブで処理済み")
+    result = True
+    try:
+        with db.transaction() as conn:
+            if "import" in stages:
+                # 再開した場合は、前回のジョブで途中までインポートしたデータが残っていないようにする
+                if resumed:
+                    delete_file_rows(conn, file)
+                with metrics.stage("import", file) as record:
+                    record["rows_out"] = gml2postgis(conn, file)
+                ledger.mark(conn, user_id, session_id, file, "import",
+                            None if record["rows_out"] is None else str(record["rows_out"]))
+            # すべての建物がマッチング結果のキャッシュにある場合は、マッチングとスコア計算を行わない
+            cache_version = None
+            all_cached = False
+            if "score" in stages and not use_confirmation_system():
+                cache_version = match_cache.get_version(conn)
+            if cache_version is not None:
+                with metrics.stage("cache_lookup", file) as record:
+                    buildings, hits = match_cache.count_hits(conn, user_id, session_id, file, cache_version)
+                    record["rows_in"], record["cache_hits"] = buildings, hits
+                print(f"マッチング結果のキャッシュ: {hits}/{buildings}件")
+                all_cached = 0 < buildings == hits
+            if "match" in stages:
+                if not all_cached:
+                    with metrics.stage("match", file) as record:
+                        record["rows_out"] = match_files(conn, [file])
+                ledger.mark(conn, user_id, session_id, file, "match")
+            if "score" in stages:
+                # キャッシュを使う場合、建物IDの重複除去はキャッシュから戻した建物と合わせてから行う
+                if not all_cached and not use_confirmation_system():
+                    with metrics.stage("score", file) as record:
+                        record["rows_in"], _, record["rows_out"] = calc_algorithm_flag(
+                            conn, file, demote=cache_version is None)
+                if cache_version is not None:
+                    with metrics.stage("cache", file) as record:
+                        record["rows_out"], record["cache_stored"] = match_cache.apply_and_store(
+                            conn, user_id, session_id, file, cache_version)
+                        record["demoted"] = scoring.demote_duplicate_buildings(conn, user_id, session_id, file)
+                    print(f"建物IDの重複により除いた件数: {record['demoted']}件")
+                ledger.mark(conn, user_id, session_id, file, "score")
+            if "enrich" in stages:
+                with metrics.stage("enrich", file) as record:
+                    record["rows_in"], record["rows_out"] = add_estate_id_to_gml(conn, file, folder_name)
+                ledger.mark(conn, user_id, session_id, file, "enrich")
+    except Exception as err:
+        print(err)
+        print(f"{file}の処理に失敗")
+        result = False
+    stats_after = db.get_stats()
+    return (result, {key: stats_after[key] - stats_before[key] for key in stats_after},
+            metrics.take_since(metrics_position))
+
+
+def run_stages(files: Iterable[str], folder_name: str, stages: tuple, executor=None,
+               archive: OutputArchive = None, progress: dict = None) -> tuple:
+    """
+    ファイルごとに stages を実行し、
+    (処理したファイル名の一覧, 失敗したファイル名の一覧, ワーカープロセスで増えた接続数・SQL文数) を返す。
+    files はダウンロード中のファイルを順に返すイテレータでもよく、受け取ったファイルから処理を始める。
+    executor が指定された場合はプロセスプールで並列に実行する。
+    archive が指定された場合は、不動産IDの付与が終わったファイルをその都度 archive に追加する。
+    progress は再開したセッションの記録で、前回のジョブで完了した段階は実行しない。
+    """
+
+    def on_finished(file: str, result: bool, file_records: list):
+        metrics.extend(file_records)
+        if not result:
+            failed_files.append(file)
+        elif archive is not None and "enrich" in stages:
+            with metrics.stage("zip", file):
+                archive.add(os.path.join(output_dir, folder_name, file), file)
+
+    processed_files = []
+    failed_files = []
+    worker_stats = {key: 0 for key in db.get_stats()}
+    if executor is None:
+        for file in files:
+            processed_files.append(file)
+            result, _, file_records = process_file(
+                file, folder_name, stages, completed_stages(progress, file, folder_name))
+            on_finished(file, result, file_records)
+        return processed_files, failed_files, worker_stats
+
+    futures = {}
+    for file in files:
+        processed_files.append(file)
+        futures[executor.submit(process_job_file, current_job, file, folder_name, stages,
+                                completed_stages(progress, file, folder_name))] = file
+    for future in as_completed(futures):
+        file = futures[future]
+        file_records = []
+        try:
+            result, stats, file_records = future.result()
+            for key, value in stats.items():
+                worker_stats[key] += value
+        except Exception as err:
+            # ワーカープロセス自体が異常終了した場合
+            print(err)
+            result = False
+        on_finished(file, result, file_records)
+    return processed_files, failed_files, worker_stats
+
+
+def run_session_stages(files: Iterable[str], folder_name: str, executor=None,
+                       archive: OutputArchive = None, progress: dict = None) -> tuple:
+    """
+    セッション単位でマッチングする場合の処理。
+    ファイルごとにインポートした後、セッションのすべての建物を1つのSQL文でマッチングし、
+    その後ファイルごとにアルゴリズムフラグ設定・不動産ID付与を行う。
+    再開したセッションでマッチングが完了していない場合は、マッチングとそれ以降をやり直す。
+    """
+    user_id = os.environ.get('ESTATE_ID_USER_ID')
+    session_id = os.environ.get('ESTATE_ID_SESSION_ID')
+    files, failed_files, worker_stats = run_stages(files, folder_name, ("import",), executor, progress=progress)
+    imported_files = [file for file in files if file not in failed_files]
+
+    if progress is None or "match" not in progress.get(ledger.SESSION, {}):
+        try:
+            with db.transaction() as conn, metrics.stage("match") as record:
+                if progress is not None:
+                    # 前回のジョブのマッチング結果が残っていないようにする
+                    conn.cursor().execute(
+                        "DELETE FROM building_citygml_matched WHERE user_id = %s AND session_id = %s",
+                        (user_id, session_id))
+                record["rows_out"] = match_files(conn, imported_files)
+                # ステージングモードでは、マッチング結果を投入し終えてからインデックスを作成する
+                # (building_citygml はセッション全体をまとめて読むだけなのでインデックスは作成しない)
+                if working_tables.use_staging_mode():
+                    working_tables.create_session_indexes(
+                        conn, "building_citygml_matched", user_id, session_id, staging=True)
+                ledger.mark(conn, user_id, session_id, ledger.SESSION, "match")
+        except Exception as err:
+            print(err)
+            print("マッチング処理に失敗")
+            return files, files, worker_stats
+        if progress is not None:
+            # マッチングをやり直したので、スコア計算・不動産IDの付与もやり直す
+            progress = {file: {stage: detail for stage, detail in stages.items() if stage == "import"}
+                        for file, stages in progress.items()}
+
+    _, failed, stats = run_stages(imported_files, folder_name, ("score", "enrich"), executor, archive, progress)
+    for key, value in stats.items():
+        worker_stats[key] += value
+    return files, failed_files + failed, worker_stats
+
+
+def run_pipeline(files: Iterable[str], folder_name: str, workers: int, match_scope: str = "file",
+                 archive: OutputArchive = None, progress: dict = None,
+                 executor: ProcessPoolExecutor = None) -> list:
+    """
+    ファイルごとの処理を実行し、失敗したファイル名の一覧を返す。
+    workersが2以上の場合はプロセスプールで並列に実行する。
+    match_scope が "session" の場合は、マッチングだけをセッション単位で1回にまとめて行う。
+    progress は再開したセッションの記録 (start_session)。
+    executor を指定した場合はそのプロセスプールを使い、終了しない (常駐ワーカーがジョブをまたいで使う)。
+    """
+    own_executor = executor is None and workers > 1
+    if own_executor:
+        executor = create_executor(workers)
+
+    try:
+        if match_scope == "session":
+            _, failed_files, worker_stats = run_session_stages(files, folder_name, executor, archive, progress)
+        else:
+            _, failed_files, worker_stats = run_stages(files, folder_name, FILE_STAGES, executor, archive, progress)
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    # 並列実行時は、ワーカープロセスの接続数・SQL文数を親プロセスの値に足し合わせる
+    total_stats = db.get_stats()
+    for key, value in worker_stats.items():
+        total_stats[key] += value
+    print(f"DB接続数: {total_stats['connections_opened']}, 実行SQL数: {total_stats['statements_executed']}")
+    return sorted(failed_files)
+
+
+def download_file_from_s3(skip_files: set = frozenset()) -> Iterator[str]:
+    """
+    指定のS3バケットからinput_dir以下のgmlファイルを並行してダウンロードし、
+    ダウンロードが終わったファイルから順に、input_dir直下のファイル名を返す。
+    skip_files のファイルはダウンロードせずに返す
+    """
     print(input_dir)
+    max_workers = int(os.environ.get('ESTATE_ID_DOWNLOAD_WORKERS', s3_transfer.DEFAULT_DOWNLOAD_WORKERS))
+    skip_keys = {os.path.join(input_dir, file) for file in skip_files}
+    for key in s3_transfer.download_files(os.environ["BUCKET_NAME"], input_dir, '.gml', max_workers, skip_keys):
+        # input_dir のサブディレクトリや、名前が input_dir で始まる別のディレクトリのファイルは処理しない
+        if os.path.dirname(key) == input_dir:
+            yield os.path.basename(key)
+
+
+def create_session_tables(conn, table: str, staging: bool, defer_indexes: bool):
+    """
+    作業用テーブル table のこのセッションのパーティションを作成する。
+    staging が True の場合は UNLOGGED で作成し、defer_indexes が True の場合はインデックスを作成しない
+    (データの投入後に create_session_indexes で作成する)
+    """
+    user_id = os.environ.get('ESTATE_ID_USER_ID')
+    session_id = os.environ.get('ESTATE_ID_SESSION_ID')
+    working_tables.create_session_partition(conn, table, user_id, session_id, unlogged=staging)
+    if not defer_indexes:
+        working_tables.create_session_indexes(conn, table, user_id, session_id, staging)
+
+
+# building_citygml の lod0_area 列の式 (jgd2011_plane_area は dbbuild の 12_create_projected_area.sql で作成する)
+PLANE_AREA = 'jgd2011_plane_area(lod0geom)'
 
-    bucket = s3_resource.Bucket(os.environ["BUCKET_NAME"])
-
-    for obj in bucket.objects.filter(Prefix=input_dir):
-        if obj.key.endswith('.gml'):
-            if not os.path.exists(os.path.dirname(obj.key)):
-                os.makedirs(os.path.dirname(obj.key))
-            print("Downloading {}...".format(obj.key))
-            bucket.download_file(obj.key, obj.key)
-    print("Download completed.")
-
-
-def create_gml_removed_tag(gml: str, dst: str,
-                           rm_tag: str = "app:appearanceMember"
-                           ) -> bool:
-    """ogr2ogr コマンドの妨げになっているタグ(ex: <app:appearanceMember>)を除いたgmlを作成する。"""
-    with open(gml) as f:
-        data = f.read()
-    rm_tag = "app:appearanceMember"
-    rm_tag_idx = data.find(rm_tag)
-    result = rm_tag_idx != -1
-    if result:
-        rm_start_idx = data.rfind("\n", 0, rm_tag_idx) + 1
-        rm_end_idx = data.find("\n", data.find(f"/{rm_tag}", rm_start_idx)) + 1
-        with open(dst, 'w') as f:
-            f.write(data[:rm_start_idx])
-            f.write(data[rm_end_idx:])
-    return result
-
-
-
-def gml2postgis():
-    """S3バケットからダウンロードしたgmlファイルをPostGISにインポートする"""
-    with psycopg2.connect(
-            "host={} port={} dbname={} user={} password={}".format(os.environ["HOST"], os.environ["PORT"],
-                                                                   os.environ["DBNAME"], os.environ["USER"],
-                                                                   os.environ["PASSWORD"])) as conn:
+
+def create_import_table(staging: bool = False, defer_indexes: bool = False):
+    """
+    CityGMLのインポート先テーブルを作成する。
+    テーブルは user_id, session_id でパーティション化し、このセッションのパーティションも作成する
+    """
+    with db.transaction() as conn:
+        working_tables.migrate_unpartitioned_table(
+            conn, "building_citygml", ("building_citygml_lod0geom_geom_idx", "building_citygml_idx1"))
+        lod0_area = get_lod0_area_expression(conn)
 
         sql_create_table = '''
         CREATE TABLE IF NOT exists public.building_citygml (
@@ -99,120 +560,159 @@ def gml2postgis():
             yearOfConstruction integer NULL,
             lod0geom public.geometry(Geometry, 4326),
             user_id character varying(255) NOT NULL,
-            session_id character varying(255) NOT NULL
-            );
+            session_id character varying(255) NOT NULL,
+            lod0_area double precision GENERATED ALWAYS AS ({lod0_area}) STORED
+            ) PARTITION BY LIST (user_id);
 
             ALTER TABLE public.building_citygml OWNER TO postgres;
-            CREATE INDEX IF NOT exists building_citygml_lod0geom_geom_idx ON public.building_citygml USING gist (lod0geom);
-            CREATE INDEX IF NOT exists building_citygml_idx1 ON public.building_citygml (filename, user_id, session_id);
-            DROP TABLE IF EXISTS public.building;
-        '''
+            -- 建物の図形の面積 (平方メートル) は、インポート時に平面直角座標系で1回だけ計算しておく
+            ALTER TABLE public.building_citygml ADD COLUMN IF NOT EXISTS
+            lod0_area double precision GENERATED ALWAYS AS ({lod0_area}) STORED;
+        '''.format(lod0_area=lod0_area)
         conn.cursor().execute(sql_create_table)
+        working_tables.drop_parent_indexes(conn, "building_citygml")
+        create_session_tables(conn, "building_citygml", staging, defer_indexes)
+
+
+def get_lod0_area_expression(conn) -> str:
+    """
+    building_citygml の lod0_area 列を計算する式を返す。
+    jgd2011_plane_area がないデータベースでは、インポートが失敗しないよう測地線面積で計算する
+    (作成済みのテーブルの lod0_area 列は変更しない)。
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT to_regprocedure('jgd2011_plane_area(geometry)') IS NOT NULL")
+    if cursor.fetchone()[0]:
+        return PLANE_AREA
+    print("jgd2011_plane_area 関数がないため、lod0_area は測地線面積で計算します "
+          "(dbbuild の 12_create_projected_area.sql を実行してください)")
+    return scoring.GEOGRAPHY_AREA
+
+
+def gml2postgis(conn, file: str):
+    """S3バケットからダウンロードしたgmlファイルをPostGISにインポートし、インポートした件数を返す"""
+    source = os.path.join(input_dir, file)
+    # iter_buildings は app:appearanceMember を読み飛ばすので、元のファイルをそのまま読む。
+    # ogr2ogr は app:appearanceMember があると失敗することがあるので、ある場合だけ取り除いたgmlを作成し、
+    # 同じ走査で bldg:lod0RoofEdge / bldg:lod0FootPrint のどちらを使うか判定する
+    if os.environ.get('ESTATE_ID_IMPORTER') != 'ogr2ogr' or not has_appearance_members(source):
+        return import_gml(conn, file, source, check_lod0_type(file, detect_lod0_type(source)))
+    input_file = f"tmp_{os.getpid()}.gml"
+    try:
+        removed, lod0_type = strip_appearance_members(source, input_file)
+        print(f"app:appearanceMember を{removed}件除去")
+        return import_gml(conn, file, input_file, check_lod0_type(file, lod0_type))
+    finally:
+        if os.path.exists(input_file):
+            os.remove(input_file)
+
+
+def check_lod0_type(file: str, lod0_type: str) -> str:
+    """gmlファイルで使われている lod0 の種類を表示し、どちらもない場合は lod0RoofEdge とする"""
+    if lod0_type is None:
+        print(f"{file}にlod0RoofEdge, lod0FootPrintがありません")
+        lod0_type = "lod0RoofEdge"
+    print(lod0_type)
+    return lod0_type
+
+
+def import_gml(conn, file: str, input_file: str, lod0_type: str):
+    """
+    前処理済みのgmlファイル input_file を file としてPostGISにインポートし、インポートした件数を返す
+    (ogr2ogr でインポートした場合と、インポートに失敗した場合は None)
+    """
+    if os.environ.get('ESTATE_ID_IMPORTER') == 'ogr2ogr':
+        gml2postgis_ogr2ogr(conn, file, input_file, lod0_type)
+        return None
+
+    print(f"{file}をインポート中...")
+    try:
+        with db.savepoint(conn, "import_gml"):
+            count = copy_buildings(conn, iter_buildings(input_file, lod0_type), file,
+                                   os.environ.get('ESTATE_ID_USER_ID'), os.environ.get('ESTATE_ID_SESSION_ID'))
+        print(f"{file}をインポート完了 ({count}件)")
+        return count
+    except (etree.XMLSyntaxError, psycopg2.Error) as err:
+        print(err)
+        print(f"{file}をインポート失敗")
+        return None
+
+
+def gml2postgis_ogr2ogr(conn, file: str, input_file: str, lod0_type: str):
+    """ogr2ogr コマンドでgmlファイルをPostGISにインポートする (ESTATE_ID_IMPORTER=ogr2ogr の場合)"""
+    # 並列実行時に衝突しないよう、ogr2ogrの出力先テーブルはプロセスごとに分ける
+    tmp_table = f"building_{os.getpid()}"
+
+    print(f"{file}をインポート中...")
+    subprocess.run(
+        f'ogr2ogr -forceNullable -f "PostgreSQL" PG:"host={os.environ["HOST"]} port={os.environ["PORT"]} dbname={os.environ["DBNAME"]} user={os.environ["USER"]} password={os.environ["PASSWORD"]}" "{input_file}" -nln {tmp_table} -overwrite -oo GFS_TEMPLATE=src/{lod0_type}.gfs',
+        shell=True)
+
+    sql_move_table = f'''
+    ALTER TABLE {tmp_table} ADD COLUMN user_id character varying(255);
+    ALTER TABLE {tmp_table} ADD COLUMN session_id character varying(255);
+    ALTER TABLE {tmp_table} ADD COLUMN IF NOT EXISTS usage integer;
+    ALTER TABLE {tmp_table} ADD COLUMN IF NOT EXISTS buildingStructureType_uro double precision;
+    ALTER TABLE {tmp_table} ADD COLUMN IF NOT EXISTS buildingFootprintArea_uro double precision;
+    ALTER TABLE {tmp_table} ADD COLUMN IF NOT EXISTS storeysAboveGround integer;
+    ALTER TABLE {tmp_table} ADD COLUMN IF NOT EXISTS storeysBelowGround integer;
+    ALTER TABLE {tmp_table} ADD COLUMN IF NOT EXISTS yearOfConstruction integer;
+
+    UPDATE {tmp_table} SET filename='{file}';
+    UPDATE {tmp_table} SET user_id='{os.environ.get('ESTATE_ID_USER_ID')}';
+    UPDATE {tmp_table} SET session_id='{os.environ.get('ESTATE_ID_SESSION_ID')}';
+
+    INSERT INTO building_citygml (
+    gml_id,
+    "建物id",
+    measuredheight,
+    measuredheight_uom,
+    filename,
+    usage,
+    buildingStructureType_uro,
+    buildingFootprintArea_uro,
+    storeysAboveGround,
+    storeysBelowGround,
+    yearOfConstruction,
+    lod0geom,
+    user_id,
+    session_id)
+    SELECT
+    gml_id,
+    "建物id",
+    measuredheight,
+    measuredheight_uom,
+    filename,
+    COALESCE(usage, 0),
+    COALESCE(buildingStructureType_uro, 0),
+    COALESCE(buildingfootprintarea_uro, 0),
+    COALESCE(storeysAboveGround, 0),
+    COALESCE(storeysBelowGround, 0),
+    COALESCE(yearOfConstruction, 0),
+    ST_Transform(lod0geom, 4326),
+    user_id,
+    session_id FROM {tmp_table};
+    '''
+    try:
+        with db.savepoint(conn, "import_gml"):
+            conn.cursor().execute(sql_move_table)
+        print(f"{file}をインポート完了")
+    except Exception as err:
+        print(err)
+        print(f"{file}をインポート失敗")
+    finally:
+        conn.cursor().execute(f"DROP TABLE IF EXISTS {tmp_table};")
+
+def create_working_table(staging: bool = False, defer_indexes: bool = False):
+    """
+    マッチング結果を格納するテーブルを作成する。
+    テーブルは user_id, session_id でパーティション化し、このセッションのパーティションも作成する
+    """
+    with db.transaction() as conn:
+        working_tables.migrate_unpartitioned_table(
+            conn, "building_citygml_matched",
+            tuple(f"building_citygml_matched_idx{i}" for i in range(1, 6)))
 
-    for file in os.listdir(input_dir):
-        if file.endswith('.gml'):
-            input_file = os.path.join(input_dir, file)
-            tree = etree.parse(input_file)
-            root = tree.getroot()
-
-            # bldg:lod0RoofEdgeの場合
-            if root.find('.//bldg:lod0RoofEdge', namespaces) is not None:
-                print("lod0RoofEdge")
-                lod0_type = "lod0RoofEdge"
-
-            # bldg:lod0FootPrintの場合
-            elif root.find('.//bldg:lod0FootPrint', namespaces) is not None:
-                print("lod0FootPrint")
-                lod0_type = "lod0FootPrint"
-
-            print(f"{file}をインポート中...")
-            cp = subprocess.run(
-                f'ogr2ogr -forceNullable -f "PostgreSQL" PG:"host={os.environ["HOST"]} port={os.environ["PORT"]} dbname={os.environ["DBNAME"]} user={os.environ["USER"]} password={os.environ["PASSWORD"]}" "{input_file}" -oo GFS_TEMPLATE=src/{lod0_type}.gfs',
-                shell=True)
-
-            with psycopg2.connect(
-                    "host={} port={} dbname={} user={} password={}".format(os.environ["HOST"], os.environ["PORT"],
-                                                                           os.environ["DBNAME"], os.environ["USER"],
-                                                                           os.environ["PASSWORD"])) as conn:
-
-                sql_move_table = f'''
-                ALTER TABLE building ADD COLUMN user_id character varying(255);
-                ALTER TABLE building ADD COLUMN session_id character varying(255);
-                ALTER TABLE building ADD COLUMN IF NOT EXISTS usage integer;
-                ALTER TABLE building ADD COLUMN IF NOT EXISTS buildingStructureType_uro double precision;
-                ALTER TABLE building ADD COLUMN IF NOT EXISTS buildingFootprintArea_uro double precision;
-                ALTER TABLE building ADD COLUMN IF NOT EXISTS storeysAboveGround integer;
-                ALTER TABLE building ADD COLUMN IF NOT EXISTS storeysBelowGround integer;
-                ALTER TABLE building ADD COLUMN IF NOT EXISTS yearOfConstruction integer;
-
-                UPDATE building SET filename='{file}';
-                UPDATE building SET user_id='{os.environ.get('ESTATE_ID_USER_ID')}';
-                UPDATE building SET session_id='{os.environ.get('ESTATE_ID_SESSION_ID')}';
-
-                INSERT INTO building_citygml (
-                gml_id,
-                "建物id",
-                measuredheight,
-                measuredheight_uom,
-                filename,
-                usage,
-                buildingStructureType_uro,
-                buildingFootprintArea_uro,
-                storeysAboveGround,
-                storeysBelowGround,
-                yearOfConstruction,
-                lod0geom,
-                user_id,
-                session_id)
-                SELECT
-                gml_id,
-                "建物id",
-                measuredheight,
-                measuredheight_uom,
-                filename,
-                COALESCE(usage, 0),
-                COALESCE(buildingStructureType_uro, 0),
-                COALESCE(buildingfootprintarea_uro, 0),
-                COALESCE(storeysAboveGround, 0),
-                COALESCE(storeysBelowGround, 0),
-                COALESCE(yearOfConstruction, 0),
-                ST_Transform(lod0geom, 4326),
-                user_id,
-                session_id FROM building;
-                '''
-                try:
-                    conn.cursor().execute(sql_move_table)
-                    print(f"{file}をインポート完了")
-                except psycopg2.errors.ProgrammingError as err:
-                    conn.cursor().execute("ROLLBACK;DROP TABLE building;")
-                    tmp_gml = 'tmp.gml'
-                    if create_gml_removed_tag(input_file, tmp_gml):
-                        try:
-                            cmd = cp.args.replace(input_file, tmp_gml)
-                            subprocess.run(cmd, shell=True)
-                            try:
-                                conn.cursor().execute(sql_move_table)
-                            except Exception as err:
-                                print(err)
-                        finally:
-                            if os.path.exists(tmp_gml):
-                                os.remove(tmp_gml)
-                    else:
-                        print(err)
-                        print(f"{file}をインポート失敗")
-                except Exception as err:
-                    sql = 'ROLLBACK;'
-                    conn.cursor().execute(sql)
-                    print(err)
-                    print(f"{file}をインポート失敗")
-                finally:
-                    conn.cursor().execute("DROP TABLE building;")
-
-def create_working_table():
-    with psycopg2.connect(
-            "host={} port={} dbname={} user={} password={}".format(os.environ["HOST"], os.environ["PORT"],
-                                                                   os.environ["DBNAME"], os.environ["USER"],
-                                                                   os.environ["PASSWORD"])) as conn:
         print("マッチング用のテーブルを作成")
         # マッチング用のテーブルを作成
         create_sql = '''
@@ -254,147 +754,211 @@ def create_working_table():
             usage integer NULL,
             buildingStructureType_uro integer NULL,
             yearOfConstruction integer NULL,
-            fudosan_id_hash varchar(32) NULL
-        );
-        CREATE INDEX IF NOT exists building_citygml_matched_idx1 ON building_citygml_matched (gml_id, filename, user_id, session_id);
-        CREATE INDEX IF NOT exists building_citygml_matched_idx2 ON building_citygml_matched (gml_id, user_id, session_id);
-        CREATE INDEX IF NOT exists building_citygml_matched_idx3 ON building_citygml_matched (gml_id);
-        CREATE INDEX IF NOT exists building_citygml_matched_idx4 ON building_citygml_matched (user_id, session_id, filename);
-        CREATE INDEX IF NOT exists building_citygml_matched_idx5 ON building_citygml_matched (user_id, session_id);
+            fudosan_id_hash varchar(32) NULL,
+            lod0_area double precision NULL
+        ) PARTITION BY LIST (user_id);
+        ALTER TABLE building_citygml_matched ADD COLUMN IF NOT EXISTS lod0_area double precision NULL;
         '''
         conn.cursor().execute(create_sql)
+        working_tables.drop_parent_indexes(conn, "building_citygml_matched")
+        create_session_tables(conn, "building_citygml_matched", staging, defer_indexes)
+
+_confirmation_system_tables = None
 
-def match_to_estate_id_confirmation_system():
-    with psycopg2.connect(
-            "host={} port={} dbname={} user={} password={}".format(os.environ["HOST"], os.environ["PORT"],
-                                                                   os.environ["DBNAME"], os.environ["USER"],
-                                                                   os.environ["PASSWORD"])) as conn:
-        print("*** 不動産ID確認システムのデータでマッチング ***")
 
-        # 環境変数から条件に設定する閾値を取得
-        rate_limit = int(os.environ.get('ESTATE_ID_CONFIRMATION_SYSTEM_RATE_LIMIT'))
-        area_min = int(os.environ.get('ESTATE_ID_CONFIRMATION_SYSTEM_AREA_MIN'))
-        area_max = int(os.environ.get('ESTATE_ID_CONFIRMATION_SYSTEM_AREA_MAX'))
-
-        print(f"ESTATE_ID_CONFIRMATION_SYSTEM_RATE_LIMIT: {rate_limit}")
-        print(f"ESTATE_ID_CONFIRMATION_SYSTEM_AREA_MIN: {area_min}")
-        print(f"ESTATE_ID_CONFIRMATION_SYSTEM_AREA_MAX: {area_max}")
-        # ファイル・セッションID・ユーザID毎にマッチング処理を行い、データを格納する
-        for file in os.listdir(input_dir):
-            if file.endswith('.gml'):
-                estate_id_user_id = os.environ.get('ESTATE_ID_USER_ID')
-                estate_id_session_id = os.environ.get('ESTATE_ID_SESSION_ID')
-
-                print(f"file: {file}")
-
-                create_sql = f'''
-                INSERT INTO building_citygml_matched
-                SELECT
-                    subq.gml_id,
-                    subq.建物id,
-                    subq.lod0geom AS lod0geom,
-                    subq.filename,
-                    subq.user_id,
-                    subq.session_id,
-                    subq.fudosan_id as tatemono_id,
-                    '' as bldg_id,
-                    subq.bunrui,
-                    0 as n_touki,
-                    0 as floor_space,
-                    0 as structure_code,
-                    COALESCE(measuredheight, 0) as height,
-                    subq.measuredheight as floors,
-                    NULL as region,
-                    '' as fudosan_id,
-                    'A' as algorithm_flag,
-                    0 as score_fude,
-                    0 as score_high,
-                    0 as score_wide,
-                    0 as score_total,
-                    0 as citygml_floors,
-                    0 as citygml_floors_below_ground,
-                    0 as citygml_floor_space,
-                    0 as citygml_usage_code,
-                    0 as citygml_structure_code,
-                    0 as yearOfConstruction,
-                    0 as usage,
-                    0 as buildingStructureType_uro,
-                    0 as buildingFootprintArea,
-                    0 as storeysAboveGround,
-                    0 as storeysBelowGround,
-                    0 as yearOfConstruction
-                FROM (
-                    SELECT
-                    p.gml_id,
-                    p.建物id,
-                    p.lod0geom,
-                    p.filename,
-                    p.user_id,
-                    p.session_id,
-                    h.不動産IDリスト AS fudosan_id,
-                    h.所在及び地番リスト AS shozai_oyobi_chiban,
-                    ROUND(100 * ST_Area(ST_Intersection(p.lod0geom, h.geom)) / ST_Area(p.lod0geom)) AS rate,
-                    h.geom,
-                    b.bunrui,
-                    p.measuredheight
-                    FROM
-                    building_citygml p
-                    LEFT JOIN
-                    fudosan_id_kakunin_system_build_grouped h ON p.lod0geom && h.geom
-                    LEFT JOIN fudosan_id_kakunin_system_build b ON h.最小不動産番号 = b.fudosan_bango
-                    WHERE
-                    h.不動産ID数=1
-                    AND p.filename = '{file}'
-                    AND p.user_id = '{estate_id_user_id}'
-                    AND p.session_id = '{estate_id_session_id}'
-                ) subq
-                WHERE subq.rate > 0
-                AND subq.rate >= {rate_limit}
-                AND ST_Area(subq.lod0geom) BETWEEN (ST_Area(subq.geom) * {area_min}/100) AND (ST_Area(subq.geom) * {area_max}/100)
-                '''
-                conn.cursor().execute(create_sql)
-
-                # 取得した情報について、土地不動産IDを求めて設定する更新クエリを発行
-                create_sql = f'''
-                UPDATE building_citygml_matched
-                SET fudosan_id = subq.tochi_id,
-                region = subq.fude_geom
-                FROM (
-                    SELECT DISTINCT
-                    fudosan_id, tochi_id, bunrui, fude_geom
-                    FROM
-                    fudosan_id_kakunin_system_build_check
-                    WHERE rate > 0
-                    AND tochi_id IS NOT NULL
-                ) AS subq
-                WHERE SUBSTRING(tatemono_id, 1, 18)= subq.fudosan_id
-                AND filename = '{file}'
-                AND user_id = '{estate_id_user_id}'
-                AND session_id = '{estate_id_session_id}'
-                and algorithm_flag = 'A'
-                '''
-                conn.cursor().execute(create_sql)
-
-                # マッチングデータ追加件数チェック用SQL
-                count_sql = f'''
-                SELECT count(*) AS row_count
-                FROM building_citygml_matched
-                WHERE filename = '{file}'
-                AND user_id = '{estate_id_user_id}'
-                AND session_id = '{estate_id_session_id}'
-                '''
-                cursor = conn.cursor()
-                cursor.execute(count_sql)
-                row = cursor.fetchall()
-                len_matched = len(row)
-                if len_matched > 0:
-                    print(f"マッチングデータ追加件数: {row[0][0]}件")
-                else:
-                    print("マッチングデータ追加件数: 0件")
-
-
-def get_citygml_bbox(input_file: str) -> str:
-    """gmlファイルの <gml:lowerCorner>, <gml:upperCorner> からBBOXをWKT形式で作成します。"""
+def has_confirmation_system_tables(conn) -> bool:
+    """
+    dbbuild の 15_create_confirmation_system_tables.sql で作成した確認システムのマッチング用テーブルがあるかどうか
+    (プロセスごとに1回だけ問い合わせる)
+    """
+    global _confirmation_system_tables
+    if _confirmation_system_tables is None:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT to_regclass('fudosan_id_kakunin_system_candidates') IS NOT NULL "
+            "AND to_regclass('fudosan_id_kakunin_system_land') IS NOT NULL")
+        _confirmation_system_tables = cursor.fetchone()[0]
+        if not _confirmation_system_tables:
+            print("確認システムのマッチング用テーブル (fudosan_id_kakunin_system_candidates, "
+                  "fudosan_id_kakunin_system_land) がないため、元のテーブルでマッチング")
+    return _confirmation_system_tables
+
+
+# 確認システムでのマッチング結果として building_citygml_matched に追加する列
+CONFIRMATION_SYSTEM_MATCHED_COLUMNS = '''
+    subq.gml_id,
+    subq.建物id,
+    subq.lod0geom AS lod0geom,
+    subq.filename,
+    subq.user_id,
+    subq.session_id,
+    subq.fudosan_id as tatemono_id,
+    '' as bldg_id,
+    subq.bunrui,
+    0 as n_touki,
+    0 as floor_space,
+    0 as structure_code,
+    COALESCE(measuredheight, 0) as height,
+    subq.measuredheight as floors,
+    NULL as region,
+    '' as fudosan_id,
+    'A' as algorithm_flag,
+    0 as score_fude,
+    0 as score_high,
+    0 as score_wide,
+    0 as score_total,
+    0 as citygml_floors,
+    0 as citygml_floors_below_ground,
+    0 as citygml_floor_space,
+    0 as citygml_usage_code,
+    0 as citygml_structure_code,
+    0 as yearOfConstruction,
+    0 as usage,
+    0 as buildingStructureType_uro,
+    0 as buildingFootprintArea,
+    0 as storeysAboveGround,
+    0 as storeysBelowGround,
+    0 as yearOfConstruction
+'''
+
+# fudosan_id_kakunin_system_candidates (不動産ID数が1件の建物と面積) での候補の取得。
+# 交差の計算の前に、面積の比の条件と ST_Intersects で候補を絞り込む
+CONFIRMATION_SYSTEM_MATCH_SQL = f'''
+INSERT INTO building_citygml_matched
+SELECT
+{CONFIRMATION_SYSTEM_MATCHED_COLUMNS}
+FROM (
+    SELECT
+    p.gml_id,
+    p.建物id,
+    p.lod0geom,
+    p.filename,
+    p.user_id,
+    p.session_id,
+    h.fudosan_id,
+    h.bunrui,
+    p.measuredheight,
+    ROUND(100 * ST_Area(ST_Intersection(p.lod0geom, h.geom)) / p.lod0_planar_area) AS rate
+    FROM (
+        SELECT b.*, ST_Area(b.lod0geom) AS lod0_planar_area
+        FROM building_citygml b
+        WHERE b.filename = ANY($3::text[])
+        AND b.user_id = $1
+        AND b.session_id = $2
+    ) p
+    JOIN fudosan_id_kakunin_system_candidates h
+    ON p.lod0geom && h.geom
+    AND p.lod0_planar_area BETWEEN (h.geom_area * $5/100) AND (h.geom_area * $6/100)
+    AND ST_Intersects(p.lod0geom, h.geom)
+) subq
+WHERE subq.rate > 0
+AND subq.rate >= $4
+'''
+
+# 確認システムのマッチング用テーブルがない場合の候補の取得 (すべての候補の交差を計算してから絞り込む)
+CONFIRMATION_SYSTEM_MATCH_SQL_LEGACY = f'''
+INSERT INTO building_citygml_matched
+SELECT
+{CONFIRMATION_SYSTEM_MATCHED_COLUMNS}
+FROM (
+    SELECT
+    p.gml_id,
+    p.建物id,
+    p.lod0geom,
+    p.filename,
+    p.user_id,
+    p.session_id,
+    h.不動産IDリスト AS fudosan_id,
+    h.所在及び地番リスト AS shozai_oyobi_chiban,
+    ROUND(100 * ST_Area(ST_Intersection(p.lod0geom, h.geom)) / ST_Area(p.lod0geom)) AS rate,
+    h.geom,
+    b.bunrui,
+    p.measuredheight
+    FROM
+    building_citygml p
+    LEFT JOIN
+    fudosan_id_kakunin_system_build_grouped h ON p.lod0geom && h.geom
+    LEFT JOIN fudosan_id_kakunin_system_build b ON h.最小不動産番号 = b.fudosan_bango
+    WHERE
+    h.不動産ID数=1
+    AND p.filename = ANY($3::text[])
+    AND p.user_id = $1
+    AND p.session_id = $2
+) subq
+WHERE subq.rate > 0
+AND subq.rate >= $4
+AND ST_Area(subq.lod0geom) BETWEEN (ST_Area(subq.geom) * $5/100) AND (ST_Area(subq.geom) * $6/100)
+'''
+
+# 土地不動産IDの設定 (建物の不動産IDの先頭18桁で fudosan_id_kakunin_system_land のインデックスを引く)
+CONFIRMATION_SYSTEM_LAND_SQL = '''
+UPDATE building_citygml_matched m
+SET fudosan_id = l.tochi_id,
+region = l.fude_geom
+FROM fudosan_id_kakunin_system_land l
+WHERE l.fudosan_id = SUBSTRING(m.tatemono_id, 1, 18)
+AND m.filename = ANY($3::text[])
+AND m.user_id = $1
+AND m.session_id = $2
+AND m.algorithm_flag = 'A'
+'''
+
+CONFIRMATION_SYSTEM_LAND_SQL_LEGACY = '''
+UPDATE building_citygml_matched
+SET fudosan_id = subq.tochi_id,
+region = subq.fude_geom
+FROM (
+    SELECT DISTINCT
+    fudosan_id, tochi_id, bunrui, fude_geom
+    FROM
+    fudosan_id_kakunin_system_build_check
+    WHERE rate > 0
+    AND tochi_id IS NOT NULL
+) AS subq
+WHERE SUBSTRING(tatemono_id, 1, 18)= subq.fudosan_id
+AND filename = ANY($3::text[])
+AND user_id = $1
+AND session_id = $2
+and algorithm_flag = 'A'
+'''
+
+
+def match_to_estate_id_confirmation_system(conn, files: list):
+    """
+    不動産ID確認システムのデータでマッチング処理を行い、データを格納する。
+    files に含まれるすべてのファイルの建物を1つのSQL文でマッチングする。
+    dbbuild で確認システムのマッチング用テーブルを作成していない場合は、元のテーブルでマッチングする。
+    """
+    # 環境変数から条件に設定する閾値を取得
+    rate_limit = int(os.environ.get('ESTATE_ID_CONFIRMATION_SYSTEM_RATE_LIMIT'))
+    area_min = int(os.environ.get('ESTATE_ID_CONFIRMATION_SYSTEM_AREA_MIN'))
+    area_max = int(os.environ.get('ESTATE_ID_CONFIRMATION_SYSTEM_AREA_MAX'))
+
+    estate_id_user_id = os.environ.get('ESTATE_ID_USER_ID')
+    estate_id_session_id = os.environ.get('ESTATE_ID_SESSION_ID')
+
+    print(f"file: {', '.join(files)}")
+    # ユーザーID・セッションID・ファイル名の配列・閾値はパラメータ ($1〜$6) として渡し、
+    # PREPARE した文を同じ接続のファイル間で再利用する
+    params = (estate_id_user_id, estate_id_session_id, files, rate_limit, area_min, area_max)
+    if has_confirmation_system_tables(conn):
+        db.execute_prepared(conn, "match_to_estate_id_confirmation_system", CONFIRMATION_SYSTEM_MATCH_SQL, params)
+        # 取得した情報について、土地不動産IDを求めて設定する
+        db.execute_prepared(conn, "update_confirmation_system_land_id", CONFIRMATION_SYSTEM_LAND_SQL, params[:3])
+    else:
+        db.execute_prepared(conn, "match_to_estate_id_confirmation_system_legacy",
+                            CONFIRMATION_SYSTEM_MATCH_SQL_LEGACY, params)
+        db.execute_prepared(conn, "update_confirmation_system_land_id_legacy",
+                            CONFIRMATION_SYSTEM_LAND_SQL_LEGACY, params[:3])
+
+    return print_matched_counts(conn, files, only_unscored=False)
+
+
+def get_citygml_envelope(input_file: str):
+    """
+    gmlファイルの <gml:lowerCorner>, <gml:upperCorner> から範囲を (西端経度, 南端緯度, 東端経度, 北端緯度) で返します。
+    範囲が取得できない場合は None を返します。
+    """
     lower_corner_end = "</gml:lowerCorner>"
     lower_corner_end_length = len(lower_corner_end)
     upper_corner_end = "</"
@@ -415,583 +979,241 @@ def get_citygml_bbox(input_file: str) -> str:
             if upper_corner_end_idx == -1:
                 data += f.read(size)
                 upper_corner_end_idx = data.find(upper_corner_end, lower_corner_end_idx+1)
-    if upper_corner_end_idx != -1:
-        lower_corner_start_idx = data.rfind('>', 0, lower_corner_end_idx)+1
-        upper_corner_start_idx = data.rfind('>', 0, upper_corner_end_idx)+1
-        b, l = (lc := data[lower_corner_start_idx:lower_corner_end_idx].split(' '))[0], lc[1]
-        t, r = (uc := data[upper_corner_start_idx:upper_corner_end_idx].split(' '))[0], uc[1]
-        citygml_bbox = f"POLYGON(({l} {b}, {l} {t}, {r} {t}, {r} {b}, {l} {b}))"
-    else:
-        citygml_bbox = ''
-    return citygml_bbox
+    if upper_corner_end_idx == -1:
+        return None
+    lower_corner_start_idx = data.rfind('>', 0, lower_corner_end_idx)+1
+    upper_corner_start_idx = data.rfind('>', 0, upper_corner_end_idx)+1
+    try:
+        # EPSG:6697 の座標は 緯度 経度 (高さ) の順
+        b, l = (float(v) for v in data[lower_corner_start_idx:lower_corner_end_idx].split()[:2])
+        t, r = (float(v) for v in data[upper_corner_start_idx:upper_corner_end_idx].split()[:2])
+    except ValueError:
+        return None
+    return l, b, r, t
 
 
-def match_to_estate_id():
-    with psycopg2.connect(
-            "host={} port={} dbname={} user={} password={}".format(os.environ["HOST"], os.environ["PORT"],
-                                                                   os.environ["DBNAME"], os.environ["USER"],
-                                                                   os.environ["PASSWORD"])) as conn:
-        print("*** オープンデータでマッチング ***")
-        # ファイル・セッションID・ユーザID毎にマッチング処理を行い、データを格納する
-        for file in os.listdir(input_dir):
-            if file.endswith('.gml'):
-                estate_id_user_id = os.environ.get('ESTATE_ID_USER_ID')
-                estate_id_session_id = os.environ.get('ESTATE_ID_SESSION_ID')
-
-                print(f"file: {file}")
-                create_sql = f'''
-                INSERT INTO building_citygml_matched
-                SELECT
-                b.gml_id,b.建物id,b.lod0geom,b.filename,b.user_id,b.session_id,
-                COALESCE(fim.tatemono_id, '') as tatemono_id,
-                bm.bldg_id,
-                bm.bunrui,bm.n_touki,bm.floor_space,bm.structure_code,
-                COALESCE(b.measuredheight, 0) as height,
-                bm.floors,bm.region,
-                COALESCE(fim.tochi_id, '') as fudosan_id,
-                '' AS algorithm_flag,
-                0 as score_fude,
-                0 as score_high,
-                0 as score_wide,
-                0 as score_total,
-                COALESCE(b.storeysAboveGround, 0) as citygml_floors,
-                COALESCE(b.storeysBelowGround, 0) as citygml_floors_below_ground,
-                COALESCE(b.buildingFootprintArea_uro, 0) as citygml_floor_space,
-                COALESCE(b.usage, 0) as citygml_usage_code,
-                COALESCE(b.buildingStructureType_uro, 0) as citygml_structure_code,
-                COALESCE(b.yearOfConstruction, 0) as yearOfConstruction,
-                COALESCE(bm.floors, 0) as storeysAboveGround,
-                COALESCE(bm.floors_below_ground, 0) as storeysBelowGround,
-                COALESCE(bm.floor_space, 0) as buildingFootprintArea,
-                COALESCE(bm.usage_code, 0) as usage,
-                COALESCE(bm.structure_code, 0) as buildingStructureType_uro,
-                COALESCE(bm.construction_year, 0) as yearOfConstruction
-                FROM building_citygml b
-                JOIN building_master bm ON ST_Intersects(bm.region, b.lod0geom)
-                join propertyid_master pm on pm.bldg_id = bm.bldg_id
-                join full_id_master as fim ON  fim.bldg_id = bm.bldg_id
-                WHERE
-                b.filename = '{file}'
-                AND b.user_id = '{estate_id_user_id}'
-                AND b.session_id = '{estate_id_session_id}'
-                '''
-                citygml_bbox = get_citygml_bbox(os.path.join(input_dir, file))
-                if citygml_bbox:
-                    create_sql += f"\nAND ST_Intersects(ST_GeometryFromText('{citygml_bbox}', 4326), bm.region)"
-                conn.cursor().execute(create_sql)
-
-                # マッチングデータ追加件数チェック用SQL
-                count_sql = f'''
-                SELECT count(*) AS row_count
-                FROM building_citygml_matched
-                WHERE filename = '{file}'
-                AND user_id = '{estate_id_user_id}'
-                AND session_id = '{estate_id_session_id}'
-                AND algorithm_flag = ''
-                '''
-                cursor = conn.cursor()
-                cursor.execute(count_sql)
-                row = cursor.fetchall()
-                len_matched = len(row)
-                if len_matched > 0:
-                    print(f"マッチングデータ追加件数: {row[0][0]}件")
-                else:
-                    print("マッチングデータ追加件数: 0件")
+def get_candidate_meshes(file: str) -> list:
+    """
+    ファイルの建物とマッチングする建物データの3次メッシュのコードの一覧を返します。
+    ファイル名がメッシュコードで始まらない場合はgmlファイルの範囲から求め、求められない場合は空のリストを返します。
+    """
+    envelope = None
+    if not mesh.has_mesh_filename(file):
+        envelope = get_citygml_envelope(os.path.join(input_dir, file))
+    return mesh.candidate_meshes(file, envelope)
+
+
+# オープンデータでのマッチングの SQL
+# {source} に建物データの結合、{master}, {full_id} に建物データと full_id_master の別名を指定する。
+# {columns} には building_citygml_matched の先頭から SELECT の値の数だけのカラムを指定する
+# (SELECT の値は従来どおりテーブル定義の順に先頭から格納し、lod0_area だけは名前で指定する)。
+# {conditions} には WHERE に加える条件 (マッチング結果のキャッシュを使う場合の match_cache.MISS_CONDITION) を指定する
+MATCH_SQL = """
+INSERT INTO building_citygml_matched ({columns}, lod0_area)
+SELECT
+b.gml_id,b.建物id,b.lod0geom,b.filename,b.user_id,b.session_id,
+COALESCE({full_id}.tatemono_id, '') as tatemono_id,
+{master}.bldg_id,
+{master}.bunrui,{master}.n_touki,{master}.floor_space,{master}.structure_code,
+COALESCE(b.measuredheight, 0) as height,
+{master}.floors,{master}.region,
+COALESCE({full_id}.tochi_id, '') as fudosan_id,
+'' AS algorithm_flag,
+0 as score_fude,
+0 as score_high,
+0 as score_wide,
+0 as score_total,
+COALESCE(b.storeysAboveGround, 0) as citygml_floors,
+COALESCE(b.storeysBelowGround, 0) as citygml_floors_below_ground,
+COALESCE(b.buildingFootprintArea_uro, 0) as citygml_floor_space,
+COALESCE(b.usage, 0) as citygml_usage_code,
+COALESCE(b.buildingStructureType_uro, 0) as citygml_structure_code,
+COALESCE(b.yearOfConstruction, 0) as yearOfConstruction,
+COALESCE({master}.floors, 0) as storeysAboveGround,
+COALESCE({master}.floors_below_ground, 0) as storeysBelowGround,
+COALESCE({master}.floor_space, 0) as buildingFootprintArea,
+COALESCE({master}.usage_code, 0) as usage,
+COALESCE({master}.structure_code, 0) as buildingStructureType_uro,
+COALESCE({master}.construction_year, 0) as yearOfConstruction,
+b.lod0_area
+FROM building_citygml b
+{source}
+WHERE
+b.user_id = $1
+AND b.session_id = $2
+AND b.filename = ANY($3::text[])
+{conditions}"""
+
+MATCH_COLUMNS = ', '.join(scoring.MATCHED_COLUMNS[:33])
+
+# {mesh_filter} には、メッシュコードが決まったファイルの場合に MATCH_MESH_FILTER を指定する
+
+# building_master, propertyid_master, full_id_master を結合して候補を取得する
+MATCH_SOURCE_MASTER = """
+JOIN building_master bm ON ST_Intersects(bm.region, b.lod0geom)
+{mesh_filter}
+join propertyid_master pm on pm.bldg_id = bm.bldg_id
+join full_id_master as fim ON  fim.bldg_id = bm.bldg_id
+"""
+
+# dbbuild で作成した building_master_subdivided (領域を ST_Subdivide で分割した図形) で交差判定を行い、
+# 交差した建物IDを重複なく取り出してから building_master などを結合する
+MATCH_SOURCE_SUBDIVIDED = """
+JOIN LATERAL (
+    SELECT DISTINCT s.bldg_id
+    FROM building_master_subdivided s
+    WHERE ST_Intersects(s.geom, b.lod0geom)
+    {mesh_filter}
+) AS sub ON true
+JOIN building_master bm ON bm.bldg_id = sub.bldg_id
+join propertyid_master pm on pm.bldg_id = bm.bldg_id
+join full_id_master as fim ON  fim.bldg_id = bm.bldg_id
+"""
+
+# dbbuild で作成した mesh_candidates から候補を取得する
+# (不動産IDの数だけ候補を重複させ、propertyid_master と結合した場合と同じ件数にする)
+MATCH_SOURCE_MESH_CANDIDATES = """
+JOIN mesh_candidates mc ON ST_Intersects(mc.region, b.lod0geom)
+{mesh_filter}
+CROSS JOIN generate_series(1, mc.propertyid_count)
+"""
+
+# 建物データの mesh_codes (領域の外接矩形と重なるメッシュ, GIN インデックス) での絞り込み ($4 はメッシュコードの配列)。
+# {alias} には mesh_codes を持つ建物データの別名を指定する
+MATCH_MESH_FILTER = "AND {alias}.mesh_codes && $4::char(8)[]"
+
+
+def match_to_estate_id(conn, files: list):
+    """
+    オープンデータでマッチング処理を行い、データを格納する。
+    files に含まれるファイルの建物を、メッシュコードが決まったファイルと決まらなかったファイルごとに
+    1つのSQL文でマッチングする。
+    環境変数 ESTATE_ID_CANDIDATE_SOURCE が subdivided の場合は、領域を分割した building_master_subdivided で
+    交差判定を行い、mesh_candidates の場合は、建物データを結合する代わりに
+    dbbuild で作成した mesh_candidates からメッシュごとの候補を読む。
+    """
+    estate_id_user_id = os.environ.get('ESTATE_ID_USER_ID')
+    estate_id_session_id = os.environ.get('ESTATE_ID_SESSION_ID')
 
-def delete_working_table_data():
-    print("delete building_citygml_matched, building_citygml table data.")
-    with psycopg2.connect(
-            "host={} port={} dbname={} user={} password={}".format(os.environ["HOST"], os.environ["PORT"],
-                                                                   os.environ["DBNAME"], os.environ["USER"],
-                                                                   os.environ["PASSWORD"])) as conn:
-        estate_id_user_id = os.environ.get('ESTATE_ID_USER_ID')
-        estate_id_session_id = os.environ.get('ESTATE_ID_SESSION_ID')
+    print(f"file: {', '.join(files)}")
+    candidate_source = get_candidate_source()
+    if candidate_source == "mesh_candidates":
+        statement_name = "match_to_estate_id_mesh_candidates"
+        master, full_id, source, mesh_alias = "mc", "mc", MATCH_SOURCE_MESH_CANDIDATES, "mc"
+    elif candidate_source == "subdivided":
+        statement_name = "match_to_estate_id_subdivided"
+        master, full_id, source, mesh_alias = "bm", "fim", MATCH_SOURCE_SUBDIVIDED, "s"
+    else:
+        statement_name = "match_to_estate_id"
+        master, full_id, source, mesh_alias = "bm", "fim", MATCH_SOURCE_MASTER, "bm"
+    cache_version = match_cache.get_version(conn)
+
+    # 建物データは mesh_codes && ... を GIN インデックスで引いて絞り込んでから ST_Intersects で判定する。
+    # 複数のファイルをまとめてマッチングする場合は、各ファイルのメッシュ (隣接メッシュを含む) をまとめて絞り込む。
+    # メッシュコードが決まらなかったファイルは、メッシュで絞り込まない別の文でマッチングする
+    # (OR で絞り込みの有無を切り替えると、mesh_codes のインデックスが使われないため)
+    mesh_codes = set()
+    meshed_files = []
+    unmeshed_files = []
+    for file in files:
+        codes = get_candidate_meshes(file)
+        if codes:
+            mesh_codes.update(codes)
+            meshed_files.append(file)
+        else:
+            unmeshed_files.append(file)
+
+    for group, codes in ((meshed_files, sorted(mesh_codes)), (unmeshed_files, None)):
+        if not group:
+            continue
+        # ユーザーID・セッションID・ファイル名の配列・メッシュコードの配列はパラメータ ($1〜$4) として渡し、
+        # PREPARE した文を同じ接続のファイル間で再利用する
+        params = [estate_id_user_id, estate_id_session_id, group]
+        name = statement_name
+        mesh_filter = ""
+        if codes is not None:
+            params.append(codes)
+            name += "_meshes"
+            mesh_filter = MATCH_MESH_FILTER.format(alias=mesh_alias)
+        # マッチング結果のキャッシュを使う場合は、キャッシュにある建物は候補を作らない。
+        # キャッシュを使わない場合は match_cache テーブルがないことがあるので、条件を加えない文を別の名前で PREPARE する
+        conditions = ""
+        if cache_version is not None:
+            params.append(cache_version)
+            name += "_cache_miss"
+            conditions = match_cache.MISS_CONDITION.format(version=f"${len(params)}")
+        create_sql = MATCH_SQL.format(columns=MATCH_COLUMNS, master=master, full_id=full_id,
+                                      source=source.format(mesh_filter=mesh_filter), conditions=conditions)
+        db.execute_prepared(conn, name, create_sql, tuple(params))
+
+    return print_matched_counts(conn, files, only_unscored=True)
+
+
+def print_matched_counts(conn, files: list, only_unscored: bool) -> int:
+    """
+    マッチングデータの追加件数をファイルごとに出力し、すべてのファイルの合計を返す。
+    only_unscored が True の場合は、スコア計算前 (algorithm_flag = '') のレコードだけを数える。
+    """
+    count_sql = '''
+    SELECT filename, count(*) AS row_count
+    FROM building_citygml_matched
+    WHERE filename = ANY($3::text[])
+    AND user_id = $1
+    AND session_id = $2
+    AND (NOT $4 OR algorithm_flag = '')
+    GROUP BY filename
+    '''
+    cursor = db.execute_prepared(
+        conn, "count_matched", count_sql,
+        (os.environ.get('ESTATE_ID_USER_ID'), os.environ.get('ESTATE_ID_SESSION_ID'), files, only_unscored))
+    counts = dict(cursor.fetchall())
+    for file in files:
+        if len(files) > 1:
+            print(f"{file}: マッチングデータ追加件数: {counts.get(file, 0)}件")
+        else:
+            print(f"マッチングデータ追加件数: {counts.get(file, 0)}件")
+    return sum(counts.values())
 
-        cursor = conn.cursor()
-        delete_sql = f'''
-            DELETE FROM building_citygml_matched
-            WHERE
-            user_id = '{estate_id_user_id}'
-            AND session_id = '{estate_id_session_id}'
-        '''
-        cursor.execute(delete_sql)
 
-        delete_sql = f'''
-            DELETE FROM building_citygml
-            WHERE
-            user_id = '{estate_id_user_id}'
-            AND session_id = '{estate_id_session_id}'
-        '''
-        cursor.execute(delete_sql)
+def delete_working_table_data():
+    """このセッションの作業用テーブルのパーティションを切り離して削除する"""
+    print("delete building_citygml_matched, building_citygml table data.")
+    with db.autocommit() as conn:
+        for table in working_tables.WORKING_TABLES:
+            working_tables.drop_session_partition(
+                conn, table, os.environ.get('ESTATE_ID_USER_ID'), os.environ.get('ESTATE_ID_SESSION_ID'))
+        # セッションの処理が完了したので、再開用の記録も削除する
+        ledger.clear(conn, os.environ.get('ESTATE_ID_USER_ID'), os.environ.get('ESTATE_ID_SESSION_ID'))
     return True
 
 
-
-def calc_algorithm_flag():
-    """特にオープンデータでマッチングしたデータの値を確認し、アルゴリズムフラグを設定する"""
-    # return True
-
-    # print("*** アルゴリズムフラグを設定 ***")
-    # # ファイル・セッションID・ユーザID毎にマッチング処理を行い、データを格納する
-
-    # ファイル・セッションID・ユーザID毎にマッチング処理を行い、データを格納する
-    print("calc_algorithm_flag:")
+def calc_algorithm_flag(conn, file: str, demote: bool = True) -> tuple:
+    """
+    特にオープンデータでマッチングしたデータの値を確認し、アルゴリズムフラグを設定する。
+    demote が False の場合は、同じ建物IDが複数の建物に採用された場合の除去を行わない
+    (マッチング結果のキャッシュから戻した建物と合わせてから、scoring.demote_duplicate_buildings で行う)。
+    (候補件数, 足切り後の件数, 採用件数) を返す
+    """
     estate_id_user_id = os.environ.get('ESTATE_ID_USER_ID')
     estate_id_session_id = os.environ.get('ESTATE_ID_SESSION_ID')
-    with psycopg2.connect(
-            "host={} port={} dbname={} user={} password={}".format(
-                os.environ["HOST"], os.environ["PORT"],
-                os.environ["DBNAME"], os.environ["USER"],
-                os.environ["PASSWORD"])) as conn:
-
-        for file in os.listdir(input_dir):
-            if file.endswith('.gml'):
-                print(f"file: {file}")
-
-                # スコアの設定 score_fude
-                update_sql = f'''
-                UPDATE building_citygml_matched
-                SET score_fude = ROUND(100 * ST_Area(ST_Intersection(lod0geom, region)) / ST_Area(lod0geom))
-                WHERE
-                user_id = '{estate_id_user_id}'
-                AND session_id = '{estate_id_session_id}'
-                AND filename = '{file}'
-                '''
-                conn.cursor().execute(update_sql)
-
-                # score_fude が NULL のレコードについて、score_high = 0 に設定する
-                update_sql = f'''
-                UPDATE building_citygml_matched
-                SET score_fude = 0
-                WHERE
-                user_id = '{estate_id_user_id}'
-                AND session_id = '{estate_id_session_id}'
-                AND filename = '{file}'
-                AND score_fude IS NULL
-                '''
-                conn.cursor().execute(update_sql)
-
-
-                # スコアの設定 score_high
-                # citygmlの地上階数・地下階数が登記データの地上階数・地下階数と一致してる場合、
-                # score_high = 100 に設定する。
-                update_sql = f'''
-                UPDATE building_citygml_matched
-                SET score_high = 100
-                WHERE
-                user_id = '{estate_id_user_id}'
-                AND session_id = '{estate_id_session_id}'
-                AND filename = '{file}'
-                AND citygml_floors = storeysAboveGround
-                AND citygml_floors_below_ground = storeysBelowGround
-                '''
-                conn.cursor().execute(update_sql)
-
-                # その他 score_high の設定
-                # 登記データの地上階数・地下階数とPLATEAU階数が一致してたら、100点
-                # 一致してない場合、
-                # 100-ABS(登記データの階数 * 2.85m + 1.93m - PLATEAU 建物の高さ)
-                high_value = 2.85
-                minus_high_value = 1.93
-
-                update_sql = f'''
-                UPDATE building_citygml_matched
-                SET score_high =
-                CASE WHEN ((100 - abs(NULLIF(floors, 0) * {high_value} + {minus_high_value} / NULLIF(floors, 0)))) < 0 THEN 0
-                ELSE ((100 - abs(NULLIF(floors, 0) * {high_value} + {minus_high_value} / NULLIF(floors, 0))))
-                END
-                WHERE
-                user_id = '{estate_id_user_id}'
-                AND session_id = '{estate_id_session_id}'
-                AND filename = '{file}'
-                AND score_high = 0
-                '''
-                conn.cursor().execute(update_sql)
-
-                # score_high が NULL のレコードについて、score_high = 0 に設定する
-                update_sql = f'''
-                UPDATE building_citygml_matched
-                SET score_high = 0
-                WHERE
-                user_id = '{estate_id_user_id}'
-                AND session_id = '{estate_id_session_id}'
-                AND filename = '{file}'
-                AND score_high IS NULL
-                '''
-                conn.cursor().execute(update_sql)
-
-                # スコアの設定 score_wide
-                update_sql = f'''
-                UPDATE building_citygml_matched
-                SET score_wide = 100
-                WHERE
-                user_id = '{estate_id_user_id}'
-                AND session_id = '{estate_id_session_id}'
-                AND filename = '{file}'
-                AND citygml_floor_space = buildingFootprintArea
-                '''
-                conn.cursor().execute(update_sql)
-
-                # 登記データの床面積が、PLATEAU footPrintArea とm2単位で一致していたら、100点
-                # 一致してない場合、
-                # 100 - (ABS(登記データの1F床面積 - PLATEAU 建物の図形の面積 * 0.8) / 登記データの1F床面積) * 100
-                update_sql = f'''
-                UPDATE building_citygml_matched
-                SET score_wide = CASE when floor_space = 0 THEN 0
-                when (100 - abs(floor_space - ST_Area(lod0geom::geography) * 0.8) / NULLIF(floor_space, 0) * 100) < 0 THEN 0
-                ELSE (100 - abs(floor_space - ST_Area(lod0geom::geography) * 0.8) / NULLIF(floor_space, 0) * 100)
-                END
-                WHERE
-                user_id = '{estate_id_user_id}'
-                AND session_id = '{estate_id_session_id}'
-                AND filename = '{file}'
-                AND score_wide = 0
-                '''
-                conn.cursor().execute(update_sql)
-
-                # score_wide が NULL のレコードについて、score_high = 0 に設定する
-                update_sql = f'''
-                UPDATE building_citygml_matched
-                SET score_wide = 0
-                WHERE
-                user_id = '{estate_id_user_id}'
-                AND session_id = '{estate_id_session_id}'
-                AND filename = '{file}'
-                AND score_wide IS NULL
-                '''
-                conn.cursor().execute(update_sql)
-
-                # 各行のスコアの合計値を算出
-                update_sql = f'''
-                UPDATE building_citygml_matched
-                SET score_total = ((score_fude + score_high + score_wide) / 3)
-                WHERE
-                user_id = '{estate_id_user_id}'
-                AND session_id = '{estate_id_session_id}'
-                AND filename = '{file}'
-                '''
-                conn.cursor().execute(update_sql)
-
-                # 件数確認用SQL
-                count_sql = f'''
-                SELECT count(*) AS row_count
-                FROM building_citygml_matched
-                WHERE
-                user_id = '{estate_id_user_id}'
-                AND session_id = '{estate_id_session_id}'
-                AND filename = '{file}'
-                '''
-                cursor = conn.cursor()
-                cursor.execute(count_sql)
-                row = cursor.fetchall()
-                len_matched = len(row)
-                if len_matched > 0:
-                    print(f"削除前件数: {row[0][0]}件")
-
-                # この時点でスコア合計値が50点未満のレコードは削除(残しておくことで誤マッチングの可能性があるため)
-                legcut_score = 50
-                update_sql = f'''
-                DELETE FROM building_citygml_matched
-                WHERE
-                user_id = '{estate_id_user_id}'
-                AND session_id = '{estate_id_session_id}'
-                AND filename = '{file}'
-                AND score_total < {legcut_score}
-                '''
-                conn.cursor().execute(update_sql)
-
-                # create uuid from estate_id_user_id and estate_id_session_id
-                temporary_table_name = 'building_citygml_matched_tmp'
-
-                # create temporary table
-                create_sql = f'''
-                CREATE TEMPORARY TABLE IF NOT exists {temporary_table_name} (
-                    gml_id varchar NOT NULL,
-                    建物id varchar(16) NULL,
-                    lod0geom public.geometry(geometry, 4326) NULL,
-                    filename varchar(255) NULL,
-                    user_id varchar(255) NOT NULL,
-                    session_id varchar(255) NOT NULL,
-                    tatemono_id text NULL,
-                    bldg_id varchar(18) NOT NULL,
-                    bunrui varchar(8) NULL,
-                    n_touki integer NULL,
-                    floor_space float4 NULL,
-                    structure_code integer NULL,
-                    height double precision NULL,
-                    floors integer NULL,
-                    region public.geometry(multipolygon, 4326) NULL,
-                    fudosan_id text NOT NULL,
-                    algorithm_flag varchar(2) NULL,
-                    score_fude integer NULL,
-                    score_high integer NULL,
-                    score_wide integer NULL,
-                    score_total integer NULL,
-                    score_total_max integer NULL,
-                    matching_count integer NULL DEFAULT 0,
-
-                    citygml_floors integer NULL,
-                    citygml_floors_below_ground integer NULL,
-                    citygml_floor_space float4 NULL,
-                    citygml_usage_code integer NULL,
-                    citygml_structure_code integer NULL,
-                    citygml_construction_year integer NULL,
-
-                    storeysAboveGround integer NULL,
-                    storeysBelowGround integer NULL,
-                    buildingFootprintArea float4 NULL,
-                    usage integer NULL,
-                    buildingStructureType_uro integer NULL,
-                    yearOfConstruction integer NULL,
-                    fudosan_id_hash varchar(32) NULL
-                );
-                CREATE INDEX IF NOT exists building_citygml_matched_idx1 ON {temporary_table_name} (gml_id, filename, user_id, session_id);
-                CREATE INDEX IF NOT exists building_citygml_matched_idx2 ON {temporary_table_name} (gml_id, user_id, session_id);
-                CREATE INDEX IF NOT exists building_citygml_matched_idx3 ON {temporary_table_name} (gml_id);
-                CREATE INDEX IF NOT exists building_citygml_matched_idx4 ON {temporary_table_name} (algorithm_flag);
-                '''
-                conn.cursor().execute(create_sql)
-
-                # insert data to temporary table
-                insert_sql = f'''
-                INSERT INTO {temporary_table_name}
-                SELECT
-                *
-                FROM building_citygml_matched
-                WHERE
-                user_id = '{estate_id_user_id}'
-                AND session_id = '{estate_id_session_id}'
-                AND filename = '{file}'
-                '''
-                conn.cursor().execute(insert_sql)
-
-                # matching function on temporary table
-                # delete data from building_citygml_matched
-                delete_sql = f'''
-                DELETE FROM building_citygml_matched
-                WHERE
-                user_id = '{estate_id_user_id}'
-                AND session_id = '{estate_id_session_id}'
-                AND filename = '{file}'
-                '''
-                conn.cursor().execute(delete_sql)
-
-                # matching function on temporary table
-                # 件数確認用SQL
-                count_sql = f'''
-                SELECT count(*) AS row_count
-                FROM {temporary_table_name}
-                '''
-                cursor = conn.cursor()
-                cursor.execute(count_sql)
-                row = cursor.fetchall()
-                len_matched = len(row)
-                if len_matched > 0:
-                    print(f"一時テーブル追加件数: {row[0][0]}件")
-
-                # 建物不動産ID, 建物ID, 不動産IDの連結文字列を元にハッシュ値を作って更新する
-                # alter table {temporary_table_name} add column fudosan_id_hash varchar(32);
-                update_sql = f'''
-                update {temporary_table_name} set fudosan_id_hash = md5(tatemono_id||bldg_id||fudosan_id);
-                '''
-                conn.cursor().execute(update_sql)
-
-                # インデックスを定義する
-                create_sql = f'''
-                CREATE INDEX IF NOT exists building_citygml_matched_idx5 ON {temporary_table_name} (gml_id, fudosan_id_hash, score_total);
-                CREATE INDEX IF NOT exists building_citygml_matched_idx6 ON {temporary_table_name} (gml_id, fudosan_id_hash);
-                '''
-                conn.cursor().execute(create_sql)
-
-                # ウィンドウ関数を利用してランキング1位のレコードにalgorithm_flag = 1 を設定する
-                update_sql = f'''
-                UPDATE {temporary_table_name} as a
-                set algorithm_flag = '1',
-                score_total_max = subq.score_total
-                FROM (
-                    SELECT gml_id, fudosan_id_hash, score_total
-                    FROM (
-                        SELECT
-                        gml_id, fudosan_id_hash, score_total,
-                        rank() over (partition by gml_id ORDER BY score_total desc) AS score_rank
-                        FROM {temporary_table_name} bcm
-                        group by gml_id, fudosan_id_hash, score_total
-                    ) as b
-                    where b.score_rank = 1
-                ) as subq
-                WHERE
-                a.gml_id = subq.gml_id
-                and a.fudosan_id_hash = subq.fudosan_id_hash
-                '''
-                conn.cursor().execute(update_sql)
-
-                # 点数が最高点+-5点であるレコードについて、algorithm_flag = 10 に設定する
-                update_sql = f'''
-                UPDATE {temporary_table_name}
-                SET algorithm_flag = '10'
-                WHERE
-                gml_id in (
-                    SELECT gml_id
-                    FROM (
-                        SELECT gml_id, count(gml_id) as count_gml_id
-                        FROM {temporary_table_name}
-                        WHERE score_total BETWEEN (score_total_max - 5) AND (score_total_max + 5)
-                        GROUP BY gml_id
-                    ) AS a
-                    WHERE count_gml_id > 1
-                )
-                '''
-                conn.cursor().execute(update_sql)
-
-                # 同点1位のlgorithm_flag = 10 のレコードを他の条件でチェック。
-                # 建築年が+-1であるか
-                # 該当するレコードがあれば、matching_countを増やす
-                update_sql = f'''
-                UPDATE {temporary_table_name}
-                SET matching_count = matching_count + 1
-                WHERE
-                algorithm_flag = '10'
-                AND citygml_construction_year BETWEEN (yearOfConstruction-1) AND (yearOfConstruction+1)
-                '''
-                conn.cursor().execute(update_sql)
-
-                # 同点1位のlgorithm_flag = 10 のレコードを他の条件でチェック。
-                # 構造が同じかどうか
-                # 該当するレコードがあれば、matching_countを増やす
-                update_sql = f'''
-                UPDATE {temporary_table_name}
-                SET matching_count = matching_count + 1
-                WHERE
-                algorithm_flag = '10'
-                AND citygml_structure_code = buildingStructureType_uro
-                '''
-                conn.cursor().execute(update_sql)
-
-                # 同点1位のlgorithm_flag = 10 のレコードを他の条件でチェック。
-                # 用途が同じか
-                # 該当するレコードがあれば、matching_countを増やす
-                update_sql = f'''
-                UPDATE {temporary_table_name}
-                SET matching_count = matching_count + 1
-                WHERE
-                algorithm_flag = '10'
-                AND citygml_usage_code = usage
-                '''
-                conn.cursor().execute(update_sql)
-
-                # matching_count が最も高いレコードについて、algorithm_flag = 1 に設定する
-                # gml_idが複数発生するので、この条件は不要
-                # update_sql = f'''
-                # UPDATE {temporary_table_name} as a
-                # set algorithm_flag = '1'
-                # FROM (
-                #     SELECT gml_id, fudosan_id_hash, matching_count
-                #     FROM (
-                #         SELECT
-                #         gml_id, fudosan_id_hash, score_total, matching_count,
-                #         rank() over (partition by gml_id ORDER BY matching_count desc) AS score_rank
-                #         FROM {temporary_table_name} bcm
-                #         WHERE algorithm_flag = '10'
-                #         group by gml_id, fudosan_id_hash, score_total, matching_count
-                #     ) as b
-                #     where b.score_rank = 1 and matching_count > 0
-                # ) as subq
-                # where a.gml_id = subq.gml_id
-                # and a.fudosan_id_hash = subq.fudosan_id_hash
-                # '''
-                # conn.cursor().execute(update_sql)
-
-                # matching_count, score_total が最も高いレコードについて、algorithm_flag = 1 に設定する
-                update_sql = f'''
-                UPDATE {temporary_table_name} as a
-                set algorithm_flag = '1'
-                FROM (
-                    SELECT gml_id, fudosan_id_hash, score_total, matching_count
-                    FROM (
-                        SELECT
-                        gml_id, fudosan_id_hash, score_total, matching_count,
-                        rank() over (partition by gml_id ORDER BY matching_count desc, score_total desc) AS score_rank
-                        FROM {temporary_table_name} bcm
-                        WHERE algorithm_flag = '10'
-                        group by gml_id, fudosan_id_hash, score_total, matching_count
-                    ) as b
-                    where b.score_rank = 1 and matching_count > 0
-                ) as subq
-                where a.gml_id = subq.gml_id
-                and a.fudosan_id_hash = subq.fudosan_id_hash
-                and a.score_total = subq.score_total
-                '''
-                conn.cursor().execute(update_sql)
-
-                # 敷地に含まれるため同じ建物不動産IDが設定される敷地内の複数の建物について、
-                # 最もマッチングスコアが大きなものに対してだけ、algorithm_flag = 1 に設定するための処理
-                update_sql = f'''
-                UPDATE {temporary_table_name} as a
-                set algorithm_flag = '10'
-                FROM (
-                    SELECT gml_id, bldg_id, fudosan_id_hash, score_total
-                    FROM (
-                        SELECT
-                        gml_id, bldg_id, fudosan_id_hash, score_total,
-                        rank() over (partition by bldg_id ORDER BY score_total desc) AS score_rank
-                        FROM {temporary_table_name} bcm
-                        WHERE algorithm_flag = '1'
-                        GROUP by gml_id, bldg_id, fudosan_id_hash, score_total
-                    ) as b
-                    WHERE b.score_rank > 1
-                ) as subq
-                WHERE a.gml_id = subq.gml_id
-                and a.fudosan_id_hash = subq.fudosan_id_hash
-                '''
-                conn.cursor().execute(update_sql)
-
-                # algorithm_flag = 1以外のレコードを削除する
-                delete_sql = f'''
-                DELETE FROM {temporary_table_name}
-                WHERE
-                algorithm_flag <> '1'
-                '''
-                conn.cursor().execute(delete_sql)
-
-                # 不動産idから生成したハッシュ値を削除する
-                update_sql = f'''
-                ALTER TABLE {temporary_table_name} DROP COLUMN fudosan_id_hash;
-                '''
-                # conn.cursor().execute(update_sql)
-
-                # building_citygml_matched にデータを戻す
-                insert_sql = f'''
-                INSERT INTO building_citygml_matched
-                SELECT
-                DISTINCT
-                *
-                FROM {temporary_table_name}
-                '''
-                conn.cursor().execute(insert_sql)
-
-                # drop temporary table
-                drop_sql = f'''
-                DROP TABLE {temporary_table_name}
-                '''
-                conn.cursor().execute(drop_sql)
-
-                # 件数チェック
-                count_sql = f'''
-                SELECT count(*) AS row_count
-                FROM building_citygml_matched
-                WHERE
-                user_id = '{estate_id_user_id}'
-                AND session_id = '{estate_id_session_id}'
-                AND filename = '{file}'
-                '''
-                cursor = conn.cursor()
-                cursor.execute(count_sql)
-                row = cursor.fetchall()
-                len_matched = len(row)
-                if len_matched > 0:
-                    print(f"不動産ID付与件数: {row[0][0]}件")
+    print(f"file: {file}")
+
+    # SCORING_BACKEND=python の場合はバッチ側 (Shapely, NumPy) で、
+    # SCORING_BACKEND=legacy の場合は従来のスコアごとの UPDATE で計算する
+    scoring_backend = os.environ.get('SCORING_BACKEND')
+    if scoring_backend == 'python':
+        score = score_candidates_python
+    elif scoring_backend == 'legacy':
+        score = scoring.score_candidates_legacy
+    else:
+        score = scoring.score_candidates
+    candidate_count, passed_count, matched_count = score(conn, estate_id_user_id, estate_id_session_id, file,
+                                                   demote)
+    print(f"削除前件数: {candidate_count}件")
+    print(f"一時テーブル追加件数: {passed_count}件")
+    print(f"不動産ID付与件数: {matched_count}件")
 
-    return True
+    return candidate_count, passed_count, matched_count
 
 
 def append_new_elements(parent: etree._Element, tag_order_list: list, uro_uri: str):
@@ -1019,211 +1241,227 @@ def append_new_elements(parent: etree._Element, tag_order_list: list, uro_uri: s
     return True
 
 
-def add_estate_id_to_gml():
+def add_estate_id_to_gml(conn, file: str, folder_name: str) -> tuple:
     """
     マッチング結果格納テーブルの結果を元にCityGMLファイルに不動産IDなどを付与し、
-    S3バケットにアップロードする
+    出力先のフォルダに保存する。(マッチング結果のある建物数, 不動産IDを付与した建物数) を返す
     """
-    # 出力先のフォルダを作成
-    now = datetime.datetime.now()
-    folder_name = now.strftime('%Y%m%d%H%M%S')
-    os.makedirs(os.path.join(output_dir, folder_name), exist_ok=True)
-
     estate_id_user_id = os.environ.get('ESTATE_ID_USER_ID')
     estate_id_session_id = os.environ.get('ESTATE_ID_SESSION_ID')
 
-    with psycopg2.connect(
-            "host={} port={} dbname={} user={} password={}".format(
-                os.environ["HOST"], os.environ["PORT"],
-                os.environ["DBNAME"], os.environ["USER"],
-                os.environ["PASSWORD"])) as conn:
-        for file in os.listdir(input_dir):
-            if file.endswith('.gml'):
-                print(f"{file}にマッチング結果を付与...")
-
-                result_rows = []
-                # マッチング情報を building_citygml_matched テーブルから取得
-                select_sql = f'''
-                SELECT
-                    gml_id,
-                    tatemono_id,
-                    fudosan_id,
-                    bunrui,
-                    bldg_id,
-                    algorithm_flag,
-                    score_fude,
-                    score_high,
-                    score_wide,
-                    CEILING(score_total) as score_total,
-                    score_total_max,
-                    fudosan_id_hash
-                FROM building_citygml_matched as p
-                WHERE
-                p.user_id = '{estate_id_user_id}'
-                AND p.session_id = '{estate_id_session_id}'
-                AND p.filename = '{file}'
-                ORDER BY gml_id, score_total DESC
-                '''
-                cursor = conn.cursor()
-                cursor.execute(select_sql)
-                result_rows = cursor.fetchall()
-
-            len_matched = len(result_rows)
-            # CityGMLファイルを読み込む
-            tree = etree.parse(os.path.join(input_dir, file))
-            root = tree.getroot()
-
-            # CityGMLファイルの名前空間を取得。
-            # CityGMLファイルごとに定義が異なることがあるuroの名前空間URIを取得する
-            uro_uri = namespaces["uro"]
-            if root.nsmap is not None:
-                uro_uri = root.nsmap["uro"]
-            print("uro_uri", uro_uri)
-
-            if len_matched > 0:
-
-                search_ids = []
-                search_ids = list(map(lambda x: x[0], result_rows))
-                # print(search_ids)
-                # print(result_rows)
-                matching_counter = 0
-                for building in root.findall('.//bldg:Building', namespaces):
-                    search_row = []
-                    for search_id in search_ids:
-                        # ファイル内の建物IDを検索
-                        if building.attrib['{http://www.opengis.net/gml}id'] == search_id:
-                            search_row = list(filter(lambda x: x[0] == search_id, result_rows))
-                            break
-                    if len(search_row) > 0:
-                        # 建物不動産ID
-                        tag_order_list = []
-                        record = search_row[0]
-                        tatemono_id = record[1]
-                        tatemono_id = tatemono_id.split(",")[0]
-                        obj = {
-                            "name": "realEstateIDOfBuilding",
-                            "type": "string",
-                            "value": tatemono_id,
-                        }
-                        tag_order_list.append(obj)
-
-                        # 区分所有建物ID
-                        bunrui = str(record[3])
-                        bldg_id = str(record[4])
-                        if bunrui == '区建':
-                            result = get_kubun_tatemono_id_list(bldg_id)
-                            kubun_tatemono_id = result[0]
-                            kubun_tatemono_count = result[1]
-                            if kubun_tatemono_count > 0:
-                                obj = {
-                                    "name": "numberOfBuildingUnitOwnership",
-                                    "type": "integer",
-                                    "value": str(kubun_tatemono_count),
-                                }
-                                tag_order_list.append(obj)
-
-                                for fid in kubun_tatemono_id.split(","):
-                                    obj = {
-                                        "name": "realEstateIDOfBuildingUnitOwnership",
-                                        "type": "string",
-                                        "value": fid.strip(),
-                                    }
-                                    tag_order_list.append(obj)
-
-                        # 土地不動産ID
-                        tochi_fudosan_id = record[2]
-                        tochi_fudosan_id_len = str(len(tochi_fudosan_id.split(",")))
-                        obj = {
-                            "name": "numberOfRealEstateIDOfLand",
-                            "type": "integer",
-                            "value": tochi_fudosan_id_len
-                        }
-                        tag_order_list.append(obj)
-
-                        for fid in tochi_fudosan_id.split(","):
-                            obj = {
-                                "name": "realEstateIDOfLand",
-                                "type": "string",
-                                "value": fid.strip(),
-                            }
-                            tag_order_list.append(obj)
-
-                        # その他、スコアを記録
-                        score_total = int(record[9])
-                        obj = {
-                            "name": "matchingScore",
-                            "type": "integer",
-                            "value": str(score_total),
-                        }
-                        tag_order_list.append(obj)
-
-                        # print(tag_order_list)
-                        append_new_elements(building, tag_order_list, uro_uri)
-                        matching_counter += 1
-
-                print(f"マッチングデータ追加件数: {matching_counter}件")
-            else:
-                print("マッチングデータ追加件数: 0件")
-
-            # citygmlファイルを出力
-            etree.indent(tree, space="\t")
-            tree.write(
-                os.path.join(output_dir, folder_name, file),
-                pretty_print=True,
-                xml_declaration=True,
-                encoding="utf-8"
-                )
+    print(f"{file}にマッチング結果を付与...")
+
+    result_rows = []
+    # マッチング情報を building_citygml_matched テーブルから取得
+    select_sql = '''
+    SELECT
+        gml_id,
+        tatemono_id,
+        fudosan_id,
+        bunrui,
+        bldg_id,
+        algorithm_flag,
+        score_fude,
+        score_high,
+        score_wide,
+        CEILING(score_total) as score_total,
+        score_total_max,
+        fudosan_id_hash
+    FROM building_citygml_matched as p
+    WHERE
+    p.user_id = $1
+    AND p.session_id = $2
+    AND p.filename = $3
+    ORDER BY gml_id, score_total DESC
+    '''
+    cursor = db.execute_prepared(conn, "select_matched", select_sql,
+                                 (estate_id_user_id, estate_id_session_id, file))
+    result_rows = cursor.fetchall()
+
+    # 区分所有建物の個別不動産IDは、ファイル単位で1回のクエリでまとめて取得する
+    kubun_tatemono_ids = get_kubun_tatemono_id_map(
+        conn, sorted({str(row[4]) for row in result_rows if str(row[3]) == '区建'}))
+
+    # gml_id ごとにマッチング結果をまとめる (スコアの高い順に並んでいるので先頭の1件を使う)
+    rows_by_gml_id = {}
+    for row in result_rows:
+        rows_by_gml_id.setdefault(row[0], row)
+
+    def enrich(building: etree._Element, uro_uri: str) -> bool:
+        record = rows_by_gml_id.get(building.get('{http://www.opengis.net/gml}id'))
+        if record is None:
+            return False
+        append_new_elements(building, build_tag_order_list(record, kubun_tatemono_ids), uro_uri)
+        return True
+
+    def attributes(gml_id: str):
+        record = rows_by_gml_id.get(gml_id)
+        return None if record is None else build_tag_order_list(record, kubun_tatemono_ids)
+
+    src = os.path.join(input_dir, file)
+    dst = os.path.join(output_dir, folder_name, file)
+    if use_splice_output():
+        # 元のファイルのバイト列に、付与する建物の属性だけを挿入して出力
+        matching_counter = splice_enriched_gml(src, dst, namespaces["uro"], attributes)
+    else:
+        # CityGMLファイルを1要素ずつ読み込みながら、不動産IDを付与して出力
+        matching_counter = write_enriched_gml(src, dst, namespaces["uro"], enrich)
+    print(f"マッチングデータ追加件数: {matching_counter}件")
+    return len(rows_by_gml_id), matching_counter
+
 
+def build_tag_order_list(record: tuple, kubun_tatemono_ids: dict) -> list:
+    """
+    マッチング結果の1行から、付与する不動産ID属性の要素名と値のリストを作成する。
+    kubun_tatemono_ids は get_kubun_tatemono_id_map で取得した区分所有建物の個別不動産ID。
+    """
+    tag_order_list = []
+
+    # 建物不動産ID
+    tatemono_id = record[1]
+    tatemono_id = tatemono_id.split(",")[0]
+    obj = {
+        "name": "realEstateIDOfBuilding",
+        "type": "string",
+        "value": tatemono_id,
+    }
+    tag_order_list.append(obj)
+
+    # 区分所有建物ID
+    bunrui = str(record[3])
+    bldg_id = str(record[4])
+    if bunrui == '区建':
+        kubun_tatemono_id, kubun_tatemono_count = kubun_tatemono_ids.get(bldg_id, ("", 0))
+        if kubun_tatemono_count > 0:
+            obj = {
+                "name": "numberOfBuildingUnitOwnership",
+                "type": "integer",
+                "value": str(kubun_tatemono_count),
+            }
+            tag_order_list.append(obj)
+
+            for fid in kubun_tatemono_id.split(","):
+                obj = {
+                    "name": "realEstateIDOfBuildingUnitOwnership",
+                    "type": "string",
+                    "value": fid.strip(),
+                }
+                tag_order_list.append(obj)
+
+    # 土地不動産ID
+    tochi_fudosan_id = record[2]
+    tochi_fudosan_id_len = str(len(tochi_fudosan_id.split(",")))
+    obj = {
+        "name": "numberOfRealEstateIDOfLand",
+        "type": "integer",
+        "value": tochi_fudosan_id_len
+    }
+    tag_order_list.append(obj)
+
+    for fid in tochi_fudosan_id.split(","):
+        obj = {
+            "name": "realEstateIDOfLand",
+            "type": "string",
+            "value": fid.strip(),
+        }
+        tag_order_list.append(obj)
+
+    # その他、スコアを記録
+    score_total = int(record[9])
+    obj = {
+        "name": "matchingScore",
+        "type": "integer",
+        "value": str(score_total),
+    }
+    tag_order_list.append(obj)
+
+    return tag_order_list
+
+
+def open_output_archive(folder_name: str) -> OutputArchive:
+    """
+    出力したCityGMLファイルをまとめるZIPを開く。
+    NO_USE_IAM_MODE が 0 の場合はS3バケットにマルチパートアップロードで直接書き込み、
+    それ以外の場合はローカルの出力先に書き込む
+    """
+    zip_path = os.path.join(output_dir, folder_name + ".zip")
+    if int(os.environ.get('NO_USE_IAM_MODE')) == 0:
+        print(f"{zip_path}をS3にアップロード...")
+        fileobj = s3_transfer.MultipartUploadWriter(os.environ["BUCKET_NAME"], zip_path)
+    else:
+        fileobj = open(zip_path, 'wb')
+    return OutputArchive(fileobj)
+
+
+def export_sidecars(folder_name: str):
+    """
+    セッションのマッチング結果を、環境変数 ESTATE_ID_SIDECAR_FORMATS で指定した形式 (parquet, fgb, csv) で
+    出力したCityGMLファイルのZIPと同じ場所 ({folder_name}.matching.[拡張子]) に出力する。
+    NO_USE_IAM_MODE が 0 の場合は、ローカルに書き込んだファイルをS3バケットにアップロードする
+    """
+    base_path = os.path.join(output_dir, folder_name + ".matching")
+    try:
+        formats = sidecar_export.get_formats()
+        if not formats:
+            return
+        with db.transaction() as conn, metrics.stage("export") as record:
+            outputs = sidecar_export.export(
+                conn, os.environ.get('ESTATE_ID_USER_ID'), os.environ.get('ESTATE_ID_SESSION_ID'), base_path, formats)
+            record["rows_out"] = max((rows for _, rows in outputs.values()), default=0)
+            record["object_bytes"] = sum(os.path.getsize(path) for path, _ in outputs.values())
+            if int(os.environ.get('NO_USE_IAM_MODE')) == 0:
+                for path, _ in outputs.values():
+                    s3_transfer.upload_file(os.environ["BUCKET_NAME"], path, path)
+                    os.remove(path)
+        for name, (path, rows) in outputs.items():
+            print(f"{path}に{rows}件のマッチング結果を出力しました ({name})")
+    except Exception as err:
+        # マッチング結果の出力に失敗しても、CityGMLのZIPの出力には影響させない
+        print(err)
+        print(f"{base_path}の出力に失敗")
+
+
+def archive_and_upload(folder_name: str, archive: OutputArchive):
+    """
+    作業用テーブルのデータを削除し、出力したCityGMLファイルのZIPを完成させる。
+    S3バケットへのアップロードが完了したら、完了メールを送信する
+    """
     # テーブルを削除
-    delete_working_table_data()
+    with metrics.stage("cleanup"):
+        delete_working_table_data()
 
-    # 出力のgmlファイルをZIP化する
-    shutil.make_archive(os.path.join(output_dir, folder_name), 'zip', os.path.join(output_dir, folder_name))
+    # ZIPファイルを閉じる (S3へのアップロードは最後のパートを送信して完了する)
+    with metrics.stage("upload") as record:
+        upload_res = archive.close()
+        record["rows_out"] = archive.file_count
+        record["object_bytes"] = archive.size
 
     no_use_iam_mode = int(os.environ.get('NO_USE_IAM_MODE'))
 
-    # zipファイルをS3にアップロードする
-    if no_use_iam_mode == 0:
-        upload_res = upload_to_s3(os.path.join(output_dir, folder_name + ".zip"))
-        if upload_res:
-            send_complete_mail()
+    if no_use_iam_mode == 0 and upload_res:
+        print("s3バケットへのアップロードが完了しました")
+        send_complete_mail()
 
     return True
 
-def get_kubun_tatemono_id_list(bldg_id):
-    kubun_tatemono_id = ""
-    kubun_tatemono_count = 0
-    with psycopg2.connect(
-            "host={} port={} dbname={} user={} password={}".format(os.environ["HOST"], os.environ["PORT"],
-                                                                    os.environ["DBNAME"], os.environ["USER"],
-                                                                    os.environ["PASSWORD"])) as conn:
-        cursor = conn.cursor()
-        cond = bldg_id
-        cond = f"'{cond}'"
-        cursor.execute(
-            f"""SELECT
-            fudosan_id, fudosan_bango, bldg_id,
-            bldg_number, room_number
-            FROM propertyid_master
-            WHERE bldg_id IN ({cond})
-            ORDER BY fudosan_bango
-            """)
-        rows = cursor.fetchall()
-        if len(rows) > 0:
-            kubun_tatemono_id = ", ".join(list(map(lambda x: x[0], rows)))
-            kubun_tatemono_count = len(rows)
-
-    return kubun_tatemono_id, kubun_tatemono_count
-
-def upload_to_s3(file_path: str):
-    print(f"{file_path}をS3にアップロード...")
-    s3_client = boto3.client(service_name="s3")
-    try:
-        s3_client.upload_file(file_path, os.environ["BUCKET_NAME"], file_path)
-    except:
-        return False
-    print("s3バケットへのアップロードが完了しました")
-    return True
+def get_kubun_tatemono_id_map(conn, bldg_ids: list) -> dict:
+    """
+    建物IDのリストに対応する区分所有建物の個別不動産IDを full_id_master からまとめて取得し、
+    建物ID -> (個別不動産IDのカンマ区切り文字列, 個別不動産ID数) の辞書で返す
+    """
+    if not bldg_ids:
+        return {}
+    cursor = conn.cursor()
+    cursor.execute(
+        """SELECT
+        bldg_id, kobetsu_id, kobetsu_id_count
+        FROM full_id_master
+        WHERE bldg_id = ANY(%s)
+        """, (bldg_ids,))
+    return {
+        bldg_id: (kobetsu_id or "", kobetsu_id_count or 0)
+        for bldg_id, kobetsu_id, kobetsu_id_count in cursor.fetchall()
+    }
 
 
 def send_complete_mail():
@@ -0,0 +1,202 @@
+"""
+建物単位のマッチング結果のキャッシュ (match_cache テーブル) を扱うモジュール。
+
+同じ建物 (gml_id, lod0 の図形, 属性が同じ) を同じ版数の建物データでマッチングした結果は同じになるので、
+スコア計算後の採用結果 (建物IDの重複除去の前) を建物のキー (cache_key) ごとに保存しておき、次のジョブでは
+キャッシュにある建物をマッチング・スコア計算の対象から外して、保存した結果をそのまま使う。
+採用された候補がなかった建物も、結果が0件であること (result_no = 0) を保存する。
+
+キャッシュの版数 (cache_version) は、dbbuild の 14_create_master_data_version.sql で記録した
+建物データの版数に、score_wide の面積の計算方法 (ESTATE_ID_SCORING_AREA) を加えたもの。
+建物データを作り直すと版数が変わり、古い版数のキャッシュは使われなくなる (dbbuild 側で削除する)。
+
+環境変数 ESTATE_ID_MATCH_CACHE が 1 の場合に使う (不動産ID確認システムのデータでマッチングする場合は使わない)。
+同じ建物IDが複数の建物に採用された場合にスコアの低い方を除く処理は、他の建物の結果によって変わるので、
+キャッシュを使う場合はスコア計算では行わず、キャッシュから戻した建物の結果と合わせてから
+ファイルのすべての建物について行う (scoring.demote_duplicate_buildings)。
+"""
+import os
+from typing import Optional
+
+import db
+import scoring
+
+# ジョブごとに変わる列 (キャッシュから戻すときは building_citygml の値を使う)
+SESSION_COLUMNS = ('gml_id', '建物id', 'lod0geom', 'filename', 'user_id', 'session_id', 'lod0_area')
+# キャッシュに保存するマッチング結果の列
+CACHED_COLUMNS = tuple(column for column in scoring.MATCHED_COLUMNS if column not in SESSION_COLUMNS)
+
+# building_citygml の建物のキャッシュのキー (図形の WKB と、スコア計算に使う属性のハッシュ値)
+CACHE_KEY_SQL = """md5(ST_AsBinary({alias}.lod0geom) || convert_to(concat_ws('|',
+    {alias}.gml_id, {alias}."建物id", {alias}.measuredheight, {alias}.usage, {alias}.buildingStructureType_uro,
+    {alias}.buildingFootprintArea_uro, {alias}.storeysAboveGround, {alias}.storeysBelowGround,
+    {alias}.yearOfConstruction), 'UTF8'))"""
+
+# マッチング処理 (main.MATCH_SQL) の WHERE に加える条件: キャッシュにある建物は候補を作らない
+# ({{version}} にキャッシュの版数のパラメータを指定する。
+# match_cache テーブルはキャッシュを使う場合にだけ作成するので、キャッシュを使わない場合はこの条件を加えない)
+MISS_CONDITION = f"""AND NOT EXISTS (
+    SELECT 1 FROM match_cache mcache
+    WHERE mcache.cache_version = {{version}}::varchar AND mcache.cache_key = {CACHE_KEY_SQL.format(alias='b')})
+"""
+
+# ファイルの建物の数と、そのうちキャッシュにある建物の数
+COUNT_SQL = f"""
+SELECT
+count(*),
+count(*) FILTER (WHERE EXISTS (
+    SELECT 1 FROM match_cache c WHERE c.cache_version = $4 AND c.cache_key = {CACHE_KEY_SQL.format(alias='b')}))
+FROM building_citygml b
+WHERE b.user_id = $1 AND b.session_id = $2 AND b.filename = $3
+"""
+
+# スコア計算後 (建物IDの重複除去の前) に、キャッシュにある建物の結果を building_citygml_matched に戻し、
+# キャッシュになかった建物の結果 (採用された候補がなければ0件であること) をキャッシュに保存する。
+# 1つの SQL 文の中では applied で追加した行は stored から見えないので、stored は今回計算した結果だけを保存する
+APPLY_SQL = f"""
+WITH buildings AS (
+    SELECT
+    b.gml_id, b."建物id", b.lod0geom, b.filename, b.user_id, b.session_id, b.lod0_area,
+    {CACHE_KEY_SQL.format(alias='b')} AS cache_key
+    FROM building_citygml b
+    WHERE b.user_id = $1 AND b.session_id = $2 AND b.filename = $3
+    AND b.lod0geom IS NOT NULL
+),
+looked_up AS (
+    SELECT
+    bu.*,
+    EXISTS (SELECT 1 FROM match_cache c WHERE c.cache_version = $4 AND c.cache_key = bu.cache_key) AS hit
+    FROM buildings bu
+),
+applied AS (
+    INSERT INTO building_citygml_matched ({', '.join(scoring.MATCHED_COLUMNS)})
+    SELECT
+    {', '.join(f'l.{column}' if column in SESSION_COLUMNS else f'c.{column}' for column in scoring.MATCHED_COLUMNS)}
+    FROM looked_up l
+    JOIN match_cache c ON c.cache_version = $4 AND c.cache_key = l.cache_key AND c.result_no > 0
+    WHERE l.hit
+    -- 他のジョブが同じ建物をキャッシュに保存した直後の場合は、今回計算した結果を使う
+    AND NOT EXISTS (
+        SELECT 1 FROM building_citygml_matched m
+        WHERE m.user_id = $1 AND m.session_id = $2 AND m.filename = $3 AND m.gml_id = l.gml_id)
+    RETURNING 1
+),
+stored AS (
+    INSERT INTO match_cache (cache_version, cache_key, result_no, {', '.join(CACHED_COLUMNS)})
+    SELECT
+    $4, l.cache_key,
+    CASE WHEN m.gml_id IS NULL THEN 0
+    ELSE row_number() over (partition by l.cache_key ORDER BY m.score_total DESC, m.fudosan_id_hash)
+    END,
+    {', '.join(f'm.{column}' for column in CACHED_COLUMNS)}
+    FROM looked_up l
+    LEFT JOIN building_citygml_matched m
+    ON m.user_id = $1 AND m.session_id = $2 AND m.filename = $3 AND m.gml_id = l.gml_id
+    WHERE NOT l.hit
+    ON CONFLICT (cache_version, cache_key, result_no) DO NOTHING
+    RETURNING 1
+)
+SELECT
+(SELECT count(*) FROM applied),
+(SELECT count(*) FROM stored)
+"""
+
+_version = None
+_version_loaded = False
+
+
+def use_match_cache() -> bool:
+    """マッチング結果のキャッシュを使うかどうか"""
+    return os.environ.get('ESTATE_ID_MATCH_CACHE') == '1'
+
+
+def create_table(conn):
+    """キャッシュのテーブルを作成する (列の型は building_citygml_matched に合わせる)"""
+    conn.cursor().execute('''
+    CREATE TABLE IF NOT EXISTS match_cache (
+        cache_version varchar(64) NOT NULL,
+        cache_key char(32) NOT NULL,
+        -- 0 は採用された候補がなかったことを表す
+        result_no integer NOT NULL,
+        tatemono_id text NULL,
+        bldg_id varchar(18) NULL,
+        bunrui varchar(8) NULL,
+        n_touki integer NULL,
+        floor_space float4 NULL,
+        structure_code integer NULL,
+        height double precision NULL,
+        floors integer NULL,
+        region public.geometry(multipolygon, 4326) NULL,
+        fudosan_id text NULL,
+        algorithm_flag varchar(2) NULL,
+        score_fude integer NULL,
+        score_high integer NULL,
+        score_wide integer NULL,
+        score_total integer NULL,
+        score_total_max integer NULL,
+        matching_count integer NULL,
+        citygml_floors integer NULL,
+        citygml_floors_below_ground integer NULL,
+        citygml_floor_space float4 NULL,
+        citygml_usage_code integer NULL,
+        citygml_structure_code integer NULL,
+        citygml_construction_year integer NULL,
+        storeysAboveGround integer NULL,
+        storeysBelowGround integer NULL,
+        buildingFootprintArea float4 NULL,
+        usage integer NULL,
+        buildingStructureType_uro integer NULL,
+        yearOfConstruction integer NULL,
+        fudosan_id_hash varchar(32) NULL,
+        created_at timestamp with time zone NOT NULL DEFAULT now(),
+        PRIMARY KEY (cache_version, cache_key, result_no)
+    );
+    ''')
+
+
+def get_version(conn) -> Optional[str]:
+    """
+    キャッシュの版数を返す (プロセスごとに1回だけ問い合わせる)。
+    キャッシュを使わない場合と、建物データの版数が記録されていない場合は None
+    """
+    global _version, _version_loaded
+    if not use_match_cache():
+        return None
+    if not _version_loaded:
+        cursor = conn.cursor()
+        cursor.execute("SELECT to_regclass('master_data_version') IS NOT NULL")
+        if cursor.fetchone()[0]:
+            cursor.execute("SELECT version FROM master_data_version ORDER BY built_at DESC LIMIT 1")
+            row = cursor.fetchone()
+        else:
+            row = None
+        if row is None:
+            print("建物データの版数 (master_data_version) がないため、マッチング結果のキャッシュを使いません")
+            _version = None
+        else:
+            area = 'geography' if scoring.use_geography_area() else 'projected'
+            _version = f"{row[0].strip()}:{area}"
+        _version_loaded = True
+    return _version
+
+
+def forget_version():
+    """キャッシュの版数を次の get_version() で問い合わせ直す (常駐するワーカーがジョブごとに呼び出す)"""
+    global _version, _version_loaded
+    _version = None
+    _version_loaded = False
+
+
+def count_hits(conn, user_id: str, session_id: str, file: str, version: str) -> tuple:
+    """ファイルの (建物数, キャッシュにある建物数) を返す"""
+    cursor = db.execute_prepared(conn, "count_match_cache_hits", COUNT_SQL, (user_id, session_id, file, version))
+    return cursor.fetchone()
+
+
+def apply_and_store(conn, user_id: str, session_id: str, file: str, version: str) -> tuple:
+    """
+    スコア計算後のファイルについて、キャッシュにある建物の結果を戻し、なかった建物の結果を保存する。
+    (キャッシュから戻した行数, キャッシュに保存した行数) を返す
+    """
+    cursor = db.execute_prepared(conn, "apply_match_cache", APPLY_SQL, (user_id, session_id, file, version))
+    return cursor.fetchone()
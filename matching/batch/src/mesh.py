@@ -0,0 +1,85 @@
+"""
+3次メッシュ（基準地域メッシュ, JIS X 0410）のコードを扱うモジュール。
+
+building_master の mesh_codes (dbbuild の 10_create_mesh_code.sql で付与) は
+建物の領域の外接矩形と重なる3次メッシュのコードの配列なので、CityGML のタイルと隣接するメッシュのコードで
+マッチング候補を GIN インデックスで絞り込むことができる。
+meshes_for_envelope は SQL の jis_mesh3_codes と同じメッシュを返す。
+"""
+import math
+import os
+import re
+
+# 1次メッシュは緯度 40分 x 経度 1度、2次メッシュは1次を 8x8、3次メッシュは2次を 10x10 に分割する
+MESH3_LAT = 1 / 1.5 / 8 / 10
+MESH3_LON = 1 / 8 / 10
+
+# CityGML 1ファイルに対応するメッシュ数の上限 (超える場合はメッシュによる絞り込みを行わない)
+MAX_MESHES = 10000
+
+# PLATEAU の CityGML のファイル名 (例: 50324684_bldg_6697_op.gml) の先頭のメッシュコード
+_FILENAME_MESH = re.compile(r'^(\d{8})_')
+
+
+def mesh3_code(lon: float, lat: float) -> str:
+    """点 (経度, 緯度) を含む3次メッシュのコードを返す"""
+    return mesh3_code_at(*_mesh3_index(lon, lat))
+
+
+def _mesh3_index(lon: float, lat: float) -> tuple:
+    """点 (経度, 緯度) を含む3次メッシュの (row, col) (境界上の点の浮動小数点誤差を吸収する)"""
+    return math.floor(lat / MESH3_LAT + 1e-9), math.floor(lon / MESH3_LON + 1e-9)
+
+
+def mesh3_code_at(row: int, col: int) -> str:
+    """南北方向に row 番目、東西方向に col 番目 (緯度0度・経度0度から数えて) の3次メッシュのコード"""
+    p, r = divmod(row, 80)
+    u, c = divmod(col, 80)
+    return f"{p:02d}{u - 100:02d}{r // 10}{c // 10}{r % 10}{c % 10}"
+
+
+def mesh3_position(code: str) -> tuple:
+    """3次メッシュのコードから (row, col) を返す"""
+    return (int(code[0:2]) * 80 + int(code[4]) * 10 + int(code[6]),
+            (int(code[2:4]) + 100) * 80 + int(code[5]) * 10 + int(code[7]))
+
+
+def with_neighbours(codes: set) -> set:
+    """メッシュのコードに、周囲8方向の隣接メッシュのコードを加える"""
+    positions = {mesh3_position(code) for code in codes}
+    return {mesh3_code_at(row + dr, col + dc)
+            for row, col in positions for dr in (-1, 0, 1) for dc in (-1, 0, 1)}
+
+
+def meshes_for_envelope(envelope: tuple) -> set:
+    """範囲 (西端経度, 南端緯度, 東端経度, 北端緯度) と重なる3次メッシュのコード"""
+    west, south, east, north = envelope
+    row0, col0 = _mesh3_index(west, south)
+    row1, col1 = _mesh3_index(east, north)
+    if (row1 - row0 + 1) * (col1 - col0 + 1) > MAX_MESHES:
+        return set()
+    return {mesh3_code_at(row, col) for row in range(row0, row1 + 1) for col in range(col0, col1 + 1)}
+
+
+def has_mesh_filename(file: str) -> bool:
+    """ファイル名がメッシュコードで始まるかどうか"""
+    return _FILENAME_MESH.match(os.path.basename(file)) is not None
+
+
+def candidate_meshes(file: str, envelope: tuple = None) -> list:
+    """
+    CityGML ファイルの建物とマッチングする建物データを探す3次メッシュのコードの一覧を返す。
+    ファイル名がメッシュコードで始まる場合はそのメッシュ、そうでなければ範囲 envelope と重なるメッシュに、
+    隣接するメッシュを加える (タイルの境界からはみ出す CityGML の建物と重なる建物データも含める)。
+    メッシュが決まらない場合は空のリストを返す。
+    """
+    match = _FILENAME_MESH.match(os.path.basename(file))
+    if match:
+        codes = {match.group(1)}
+    elif envelope is not None:
+        codes = meshes_for_envelope(envelope)
+    else:
+        codes = set()
+    if not codes or len(codes) > MAX_MESHES:
+        return []
+    return sorted(with_neighbours(codes))
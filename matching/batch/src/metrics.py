@@ -0,0 +1,155 @@
+"""
+バッチ処理の段階 (ダウンロード・インポート・マッチング・スコア計算・付与・ZIP・アップロード) ごとの計測値を記録するモジュール。
+
+stage() のブロックごとに、経過時間・CPU時間・最大RSS・SQL文の数・読み書きしたバイト数を1件の記録にする。
+件数 (rows_in, rows_out) はブロックの中で記録の辞書に設定する。
+記録はプロセスごとに records にたまるので、ワーカープロセスの記録は親プロセスに返して extend() で追加する。
+ジョブの最後に report() で1つの JSON 文書にまとめる。
+
+CPU時間と読み書きしたバイト数 (/proc/self/io の rchar, wchar) はプロセス全体の値の差分なので、
+ダウンロードのように別スレッドで並行して実行する段階では、他の段階の分も含まれる。
+"""
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import db
+
+# このプロセスで記録した計測値
+records = []
+
+# stage() が記録する項目
+RECORD_KEYS = ("stage", "file", "pid", "rows_in", "rows_out", "failed", "wall_s", "cpu_s", "peak_rss_kb",
+               "db_statements", "bytes_read", "bytes_written")
+_lock = threading.Lock()
+# reset() した時点のプロセスの CPU 時間と、終了したワーカープロセスの CPU 時間
+_cpu_start = 0.0
+_children_cpu_start = 0.0
+
+
+def _io_counters() -> tuple:
+    """このプロセスが読み書きしたバイト数 (ファイル・ソケットを含む)。取得できない環境では (None, None)"""
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _diff(after: Optional[int], before: Optional[int]) -> Optional[int]:
+    return None if after is None or before is None else after - before
+
+
+@contextmanager
+def stage(name: str, file: str = None) -> Iterator[dict]:
+    """
+    name の段階の計測値を記録する。ブロックで例外が発生した場合も、failed を True にして記録する。
+    ブロックに渡す辞書に rows_in, rows_out などを設定すると、記録に含まれる。
+    """
+    record = {"stage": name, "file": file, "pid": os.getpid(), "rows_in": None, "rows_out": None}
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    statements_start = db.stats["statements_executed"]
+    read_start, written_start = _io_counters()
+    record["failed"] = True
+    try:
+        yield record
+        record["failed"] = False
+    finally:
+        read_end, written_end = _io_counters()
+        record.update(
+            wall_s=round(time.perf_counter() - wall_start, 6),
+            cpu_s=round(time.process_time() - cpu_start, 6),
+            # Linux の ru_maxrss は KB 単位
+            peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            db_statements=db.stats["statements_executed"] - statements_start,
+            bytes_read=_diff(read_end, read_start),
+            bytes_written=_diff(written_end, written_start),
+        )
+        with _lock:
+            records.append(record)
+
+
+def _children_cpu() -> float:
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return children.ru_utime + children.ru_stime
+
+
+def reset():
+    """
+    記録を消去し、CPU 時間を数え直す。
+    常駐するワーカー (worker.py) がジョブごとに呼び出し、ジョブごとに report() できるようにする
+    (最大RSS はプロセス全体の値のまま)
+    """
+    global _cpu_start, _children_cpu_start
+    with _lock:
+        del records[:]
+        _cpu_start = time.process_time()
+        _children_cpu_start = _children_cpu()
+
+
+def mark() -> int:
+    """現在の記録の位置 (take_since に渡す)"""
+    return len(records)
+
+
+def take_since(position: int) -> list:
+    """position 以降の記録を取り出す (ワーカープロセスから親プロセスに返すため)"""
+    with _lock:
+        taken = records[position:]
+        del records[position:]
+    return taken
+
+
+def extend(new_records: list):
+    """ワーカープロセスから返された記録を追加する"""
+    with _lock:
+        records.extend(new_records)
+
+
+def summarize(stage_records: list) -> dict:
+    """段階ごとに記録を集計する"""
+    summary = {}
+    for record in stage_records:
+        total = summary.setdefault(record["stage"], {
+            "count": 0, "failed": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_rss_kb": 0,
+            "rows_in": 0, "rows_out": 0, "db_statements": 0, "bytes_read": 0, "bytes_written": 0})
+        total["count"] += 1
+        total["failed"] += int(record["failed"])
+        total["peak_rss_kb"] = max(total["peak_rss_kb"], record["peak_rss_kb"])
+        for key in ("wall_s", "cpu_s", "rows_in", "rows_out", "db_statements", "bytes_read", "bytes_written"):
+            total[key] += record[key] or 0
+        # 段階ごとに追加した件数 (cache_hits など) も合計する
+        for key, value in record.items():
+            if key not in RECORD_KEYS and isinstance(value, int) and not isinstance(value, bool):
+                total[key] = total.get(key, 0) + value
+    for total in summary.values():
+        total["wall_s"] = round(total["wall_s"], 6)
+        total["cpu_s"] = round(total["cpu_s"], 6)
+        if "cache_hits" in total:
+            total["cache_hit_rate"] = round(total["cache_hits"] / total["rows_in"], 4) if total["rows_in"] else None
+    return summary
+
+
+def report(job: dict, wall_s: float) -> str:
+    """ジョブの情報 job とすべての記録を1つの JSON 文書 (1行) にする"""
+    with _lock:
+        stage_records = list(records)
+    document = dict(job)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    document.update(
+        wall_s=round(wall_s, 6),
+        cpu_s=round(time.process_time() - _cpu_start, 6),
+        # 終了したワーカープロセスの CPU 時間と最大RSS
+        children_cpu_s=round(children.ru_utime + children.ru_stime - _children_cpu_start, 6),
+        children_peak_rss_kb=children.ru_maxrss,
+        peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        summary=summarize(stage_records),
+        stages=stage_records,
+    )
+    return json.dumps(document, ensure_ascii=False)
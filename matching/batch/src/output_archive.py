@@ -0,0 +1,60 @@
+"""
+不動産IDを付与した CityGML を ZIP にまとめるモジュール。
+
+出力フォルダ全体を最後に shutil.make_archive で圧縮するのではなく、
+ファイルの処理が終わるたびに ZIP に追加していく。
+ZIP は S3 へのマルチパートアップロード (s3_transfer.MultipartUploadWriter) に直接書き込めるので、
+圧縮とアップロードが残りのファイルの処理と並行して進み、ローカルに ZIP ファイルを作らずに済む。
+"""
+import zipfile
+
+
+class OutputArchive:
+    """処理が終わったファイルを順に ZIP に追加する"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.zip_file = zipfile.ZipFile(fileobj, 'w', compression=zipfile.ZIP_DEFLATED)
+        self.error = None
+        # ZIP に追加したファイル数と、閉じた後の ZIP の大きさ (バイト)
+        self.file_count = 0
+        self.size = None
+
+    def add(self, path: str, arcname: str):
+        """path のファイルを arcname という名前で ZIP に追加する。失敗した場合は以降の追加を行わない"""
+        if self.error is not None:
+            return
+        try:
+            self.zip_file.write(path, arcname)
+            self.file_count += 1
+        except Exception as err:
+            print(err)
+            print(f"{arcname}のZIPへの追加に失敗")
+            self.error = err
+
+    def close(self) -> bool:
+        """
+        ZIP を閉じて書き込みを完了する。
+        途中で失敗していた場合は書き込みを中止 (マルチパートアップロードの場合は破棄) し、False を返す。
+        """
+        try:
+            if self.error is None:
+                self.zip_file.close()
+                self.size = getattr(self.fileobj, 'size', None)
+                if self.size is None:
+                    self.size = self.fileobj.tell()
+                self.fileobj.close()
+                return True
+        except Exception as err:
+            print(err)
+        self.abort()
+        return False
+
+    def abort(self):
+        """ZIP を完成させずに書き込みを中止する (マルチパートアップロードの場合は送信済みのパートを破棄する)"""
+        # ZipFile が破棄されるときに、中止した書き込み先へ ZIP の終端を書き込まないよう切り離す
+        self.zip_file.fp = None
+        if hasattr(self.fileobj, 'abort'):
+            self.fileobj.abort()
+        else:
+            self.fileobj.close()
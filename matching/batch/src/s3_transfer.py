@@ -0,0 +1,183 @@
+"""
+S3 バケットとのファイルのやり取りを行うモジュール。
+
+ダウンロードはスレッドプールで並行して行い、ダウンロードが終わったファイルから順に呼び出し元に渡す。
+アップロードは書き込まれたデータをパートごとにマルチパートアップロードし、複数のパートを並行して送信する。
+接続先は boto3 の設定に従うので、環境変数 AWS_ENDPOINT_URL を指定すれば
+MinIO や moto のサーバーなど、ローカルの S3 互換サーバーを使うこともできる。
+"""
+import io
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+import metrics
+
+MB = 1024 * 1024
+
+# 大きなファイルは 8MB ずつの範囲指定 GET (マルチパート) で並行してダウンロードする
+DOWNLOAD_CONFIG = TransferConfig(
+    multipart_threshold=8 * MB,
+    multipart_chunksize=8 * MB,
+    max_concurrency=4,
+    use_threads=True,
+)
+
+# 同時にダウンロードするファイル数の既定値
+DEFAULT_DOWNLOAD_WORKERS = 8
+
+# マルチパートアップロードの1パートの大きさと、同時に送信するパートの数
+# (メモリ上に保持するデータは最大でおよそ UPLOAD_PART_SIZE * (UPLOAD_MAX_CONCURRENCY + 1))
+UPLOAD_PART_SIZE = 16 * MB
+UPLOAD_MAX_CONCURRENCY = 4
+
+
+def get_s3_client():
+    """S3 クライアントを作成する (クライアントはスレッド間で共有できる)"""
+    return boto3.client(service_name='s3')
+
+
+def list_keys(s3_client, bucket_name: str, prefix: str, suffix: str = '') -> list:
+    """prefix 以下にある、名前が suffix で終わるオブジェクトのキーの一覧を返す"""
+    keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []) if obj['Key'].endswith(suffix))
+    return keys
+
+
+def download_file(s3_client, bucket_name: str, key: str, config: TransferConfig = DOWNLOAD_CONFIG) -> str:
+    """
+    key のオブジェクトを同じパスのローカルファイルにダウンロードし、そのパスを返す。
+    boto3 は一時ファイルに書き込んでから名前を変更するので、途中まで書き込まれたファイルが見えることはない。
+    """
+    if os.path.dirname(key):
+        os.makedirs(os.path.dirname(key), exist_ok=True)
+    print("Downloading {}...".format(key))
+    with metrics.stage("download", key) as record:
+        s3_client.download_file(bucket_name, key, key, Config=config)
+        record["rows_out"] = 1
+        record["object_bytes"] = os.path.getsize(key)
+    return key
+
+
+def download_files(bucket_name: str, prefix: str, suffix: str = '.gml',
+                   max_workers: int = DEFAULT_DOWNLOAD_WORKERS, skip_keys: set = frozenset()) -> Iterator[str]:
+    """
+    prefix 以下の suffix で終わるオブジェクトを max_workers 個のスレッドで並行してダウンロードし、
+    ダウンロードが終わったものから順にローカルファイルのパスを返す。
+    呼び出し元が受け取ったファイルを処理している間も、残りのダウンロードは続く。
+    skip_keys のオブジェクトはダウンロードせず、最初にそのまま返す (中断したジョブを再開した場合に使う)。
+    """
+    s3_client = get_s3_client()
+    keys = list_keys(s3_client, bucket_name, prefix, suffix)
+    for key in keys:
+        if key in skip_keys:
+            yield key
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = [executor.submit(download_file, s3_client, bucket_name, key) for key in keys if key not in skip_keys]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # 途中で処理が中断された場合は、まだ始まっていないダウンロードを取り消す
+        executor.shutdown(wait=True, cancel_futures=True)
+    print("Download completed.")
+
+
+class MultipartUploadWriter(io.RawIOBase):
+    """
+    書き込まれたデータを S3 のマルチパートアップロードで送信するファイルライクオブジェクト。
+    part_size バイトたまるごとに1パートとして別スレッドで送信し、close() でアップロードを完了する。
+    シークはできないので、zipfile.ZipFile に渡すとストリーミング形式の ZIP が書き込まれる。
+    """
+
+    def __init__(self, bucket_name: str, key: str, s3_client=None,
+                 part_size: int = UPLOAD_PART_SIZE, max_concurrency: int = UPLOAD_MAX_CONCURRENCY):
+        super().__init__()
+        self.s3_client = s3_client or get_s3_client()
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = self.s3_client.create_multipart_upload(Bucket=bucket_name, Key=key)['UploadId']
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        # 送信中のパートが max_concurrency を超えないよう、空きができるまで書き込みを待たせる
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.futures = []
+        self.buffer = bytearray()
+        # 書き込まれたデータの合計 (バイト)
+        self.size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._raise_if_failed()
+        self.buffer += b
+        self.size += len(b)
+        while len(self.buffer) >= self.part_size:
+            self._submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(b)
+
+    def _submit(self, data: bytes):
+        self.slots.acquire()
+        future = self.executor.submit(self._upload_part, len(self.futures) + 1, data)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    def _upload_part(self, part_number: int, data: bytes) -> dict:
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=data)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def _raise_if_failed(self):
+        for future in self.futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def abort(self):
+        """アップロードを中止し、送信済みのパートを破棄する"""
+        if self.closed:
+            return
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+        super().close()
+
+    def close(self):
+        """残りのデータを送信し、すべてのパートの送信を待ってアップロードを完了する"""
+        if self.closed:
+            return
+        try:
+            # 最後のパートは part_size 未満でもよい (データが空の場合も1パートは必要)
+            if self.buffer or not self.futures:
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+            parts = [future.result() for future in self.futures]
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={'Parts': parts})
+        except BaseException:
+            self.abort()
+            raise
+        self.executor.shutdown()
+        super().close()
+
+
+def upload_file(bucket_name: str, path: str, key: str) -> int:
+    """ローカルのファイル path を key にマルチパートアップロードし、送信したバイト数を返す"""
+    writer = MultipartUploadWriter(bucket_name, key)
+    try:
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, writer, UPLOAD_PART_SIZE)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return writer.size
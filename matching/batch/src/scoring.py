@@ -0,0 +1,690 @@
+"""
+オープンデータでマッチングした候補 (building_citygml_matched) のスコアを計算し、
+CityGML の建物ごとに採用する不動産IDを決めるモジュール。
+
+score_candidates は、スコア計算・足切り・順位付け・同点時の判定・建物IDの重複除去を
+CTE とウィンドウ関数による1つの SQL 文で行う。候補の読み出しと採用レコードの書き戻しは1回ずつで済む。
+score_candidates_legacy は、同じ処理を従来どおり20件ほどの UPDATE/DELETE/INSERT で行う。
+マッチング結果のキャッシュを使う場合は、demote=False で建物IDの重複除去を行わずにスコアを計算し、
+キャッシュから戻した建物の結果と合わせてから demote_duplicate_buildings で重複除去を行う。
+"""
+import os
+
+import db
+
+# score_high の算出に使う係数 (1階あたりの高さ, 加算する高さ)
+HIGH_VALUE = 2.85
+MINUS_HIGH_VALUE = 1.93
+# スコア合計値がこの値未満の候補は誤マッチングとして除外する
+LEGCUT_SCORE = 50
+
+# building_citygml_matched のカラム (テーブル定義の順)
+MATCHED_COLUMNS = (
+    'gml_id', '建物id', 'lod0geom', 'filename', 'user_id', 'session_id',
+    'tatemono_id', 'bldg_id', 'bunrui', 'n_touki', 'floor_space', 'structure_code',
+    'height', 'floors', 'region', 'fudosan_id', 'algorithm_flag',
+    'score_fude', 'score_high', 'score_wide', 'score_total', 'score_total_max', 'matching_count',
+    'citygml_floors', 'citygml_floors_below_ground', 'citygml_floor_space',
+    'citygml_usage_code', 'citygml_structure_code', 'citygml_construction_year',
+    'storeysAboveGround', 'storeysBelowGround', 'buildingFootprintArea',
+    'usage', 'buildingStructureType_uro', 'yearOfConstruction', 'fudosan_id_hash', 'lod0_area',
+)
+
+# score_wide で使う建物の図形の面積
+# 既定ではインポート時に平面直角座標系で計算した lod0_area を使い、
+# 環境変数 ESTATE_ID_SCORING_AREA が geography の場合は従来どおり測地線面積を計算する
+PROJECTED_AREA = 'lod0_area'
+GEOGRAPHY_AREA = 'ST_Area(lod0geom::geography)'
+
+
+def use_geography_area() -> bool:
+    """score_wide の面積を従来どおり測地線面積で計算するかどうか"""
+    return os.environ.get('ESTATE_ID_SCORING_AREA') == 'geography'
+
+# 各 CTE の役割 (score_candidates_legacy の各 SQL 文との対応)
+#   candidates: ファイルの候補を取り出す (一時テーブルへのコピーと削除)
+#   scored:     score_fude, score_high, score_wide を算出する (NULL は 0)
+#   totaled:    score_total と fudosan_id_hash を算出する
+#   ranked:     score_total が50点未満の候補を除き、gml_id ごと・gml_id + ハッシュごとの最高点を求める
+#   flagged:    最高点の候補に algorithm_flag = 1 と score_total_max を設定する
+#   tied:       最高点 +-5点の候補が複数ある gml_id を algorithm_flag = 10 とし、matching_count を加算する
+#   tie_ranked: algorithm_flag = 10 の候補を matching_count, score_total の順に順位付けする
+#   resolved:   同点の中で matching_count が最も高い候補を algorithm_flag = 1 に戻す
+#   demoted:    同じ建物IDが複数の建物に採用された場合、最もスコアの高いもの以外を algorithm_flag = 10 にする
+#   inserted:   algorithm_flag = 1 の候補を building_citygml_matched に書き戻す
+SCORING_SQL_TEMPLATE = f'''
+WITH candidates AS (
+    DELETE FROM building_citygml_matched
+    WHERE
+    user_id = $1
+    AND session_id = $2
+    AND filename = $3
+    RETURNING *
+),
+scored AS (
+    SELECT
+    c.*,
+    COALESCE(ROUND(100 * ST_Area(ST_Intersection(lod0geom, region)) / ST_Area(lod0geom))::integer, 0) AS new_score_fude,
+    CASE WHEN citygml_floors = storeysAboveGround AND citygml_floors_below_ground = storeysBelowGround THEN 100
+    ELSE COALESCE((
+        CASE WHEN ((100 - abs(NULLIF(floors, 0) * {HIGH_VALUE} + {MINUS_HIGH_VALUE} / NULLIF(floors, 0)))) < 0 THEN 0
+        ELSE ((100 - abs(NULLIF(floors, 0) * {HIGH_VALUE} + {MINUS_HIGH_VALUE} / NULLIF(floors, 0))))
+        END)::integer, 0)
+    END AS new_score_high,
+    CASE WHEN citygml_floor_space = buildingFootprintArea THEN 100
+    ELSE COALESCE((
+        CASE when floor_space = 0 THEN 0
+        when (100 - abs(floor_space - {{footprint_area}} * 0.8) / NULLIF(floor_space, 0) * 100) < 0 THEN 0
+        ELSE (100 - abs(floor_space - {{footprint_area}} * 0.8) / NULLIF(floor_space, 0) * 100)
+        END)::integer, 0)
+    END AS new_score_wide
+    FROM candidates c
+),
+totaled AS (
+    SELECT
+    s.*,
+    (new_score_fude + new_score_high + new_score_wide) / 3 AS new_score_total,
+    md5(tatemono_id||bldg_id||fudosan_id) AS new_fudosan_id_hash
+    FROM scored s
+),
+ranked AS (
+    SELECT
+    t.*,
+    max(new_score_total) over (partition by gml_id) AS gml_score_max,
+    max(new_score_total) over (partition by gml_id, new_fudosan_id_hash) AS hash_score_max
+    FROM totaled t
+    WHERE new_score_total >= {LEGCUT_SCORE}
+),
+flagged AS (
+    SELECT
+    r.*,
+    CASE WHEN hash_score_max = gml_score_max THEN '1' ELSE '' END AS top_flag,
+    CASE WHEN hash_score_max = gml_score_max THEN gml_score_max ELSE score_total_max END AS new_score_total_max
+    FROM ranked r
+),
+tied AS (
+    SELECT
+    f.*,
+    count(*) FILTER (
+        WHERE new_score_total BETWEEN (new_score_total_max - 5) AND (new_score_total_max + 5)
+    ) over (partition by gml_id) > 1 AS is_tied
+    FROM flagged f
+),
+tie_ranked AS (
+    SELECT
+    t.*,
+    CASE WHEN is_tied THEN '10' ELSE top_flag END AS tie_flag,
+    CASE WHEN is_tied THEN matching_count
+        + CASE WHEN citygml_construction_year BETWEEN (yearOfConstruction-1) AND (yearOfConstruction+1) THEN 1 ELSE 0 END
+        + CASE WHEN citygml_structure_code = buildingStructureType_uro THEN 1 ELSE 0 END
+        + CASE WHEN citygml_usage_code = usage THEN 1 ELSE 0 END
+    ELSE matching_count
+    END AS new_matching_count
+    FROM tied t
+),
+tie_winners AS (
+    SELECT
+    t.*,
+    is_tied
+    AND rank() over (partition by gml_id ORDER BY new_matching_count desc, new_score_total desc) = 1
+    AND new_matching_count > 0 AS is_tie_winner
+    FROM tie_ranked t
+),
+resolved AS (
+    SELECT
+    w.*,
+    CASE WHEN bool_or(is_tie_winner) over (partition by gml_id, new_fudosan_id_hash, new_score_total) THEN '1'
+    ELSE tie_flag
+    END AS resolved_flag
+    FROM tie_winners w
+),
+demoted AS (
+    SELECT
+    r.*,
+    resolved_flag = '1'
+    AND new_score_total < max(new_score_total) FILTER (WHERE resolved_flag = '1') over (partition by bldg_id)
+    AS is_bldg_loser
+    FROM resolved r
+),
+inserted AS (
+    INSERT INTO building_citygml_matched ({', '.join(MATCHED_COLUMNS)})
+    SELECT
+    DISTINCT
+    gml_id, 建物id, lod0geom, filename, user_id, session_id,
+    tatemono_id, bldg_id, bunrui, n_touki, floor_space, structure_code,
+    height, floors, region, fudosan_id, '1',
+    new_score_fude, new_score_high, new_score_wide, new_score_total, new_score_total_max, new_matching_count,
+    citygml_floors, citygml_floors_below_ground, citygml_floor_space,
+    citygml_usage_code, citygml_structure_code, citygml_construction_year,
+    storeysAboveGround, storeysBelowGround, buildingFootprintArea,
+    usage, buildingStructureType_uro, yearOfConstruction, new_fudosan_id_hash, lod0_area
+    FROM (
+        SELECT
+        d.*,
+        bool_or(is_bldg_loser) over (partition by gml_id, new_fudosan_id_hash) AS is_demoted
+        FROM demoted d
+    ) AS final
+    WHERE resolved_flag = '1'
+    {{demoted_condition}}
+    RETURNING 1
+)
+SELECT
+(SELECT count(*) FROM candidates),
+(SELECT count(*) FROM ranked),
+(SELECT count(*) FROM inserted)
+'''
+
+# 建物IDの重複除去で除かれる候補を書き戻さない条件 (demote=False の場合は条件を付けない)
+DEMOTED_CONDITION = 'AND is_demoted IS NOT TRUE'
+
+SCORING_SQL = SCORING_SQL_TEMPLATE.format(footprint_area=PROJECTED_AREA, demoted_condition=DEMOTED_CONDITION)
+SCORING_SQL_GEOGRAPHY = SCORING_SQL_TEMPLATE.format(footprint_area=GEOGRAPHY_AREA,
+                                                    demoted_condition=DEMOTED_CONDITION)
+
+# 採用された候補 (algorithm_flag = 1) のうち、同じ建物IDが複数の建物に採用された場合に
+# 最もスコアの高いもの以外を削除する (SCORING_SQL_TEMPLATE の demoted と同じ判定)
+DEMOTE_SQL = '''
+WITH losers AS (
+    SELECT DISTINCT gml_id, fudosan_id_hash
+    FROM (
+        SELECT
+        gml_id, fudosan_id_hash, score_total,
+        max(score_total) over (partition by bldg_id) AS bldg_score_max
+        FROM building_citygml_matched
+        WHERE
+        user_id = $1
+        AND session_id = $2
+        AND filename = $3
+    ) AS m
+    WHERE score_total < bldg_score_max
+),
+deleted AS (
+    DELETE FROM building_citygml_matched m
+    USING losers l
+    WHERE
+    m.user_id = $1
+    AND m.session_id = $2
+    AND m.filename = $3
+    AND m.gml_id = l.gml_id
+    AND m.fudosan_id_hash IS NOT DISTINCT FROM l.fudosan_id_hash
+    RETURNING 1
+)
+SELECT count(*) FROM deleted
+'''
+
+
+def score_candidates(conn, user_id: str, session_id: str, file: str, demote: bool = True) -> tuple:
+    """
+    ファイル file の候補のスコアを計算し、建物ごとに採用する候補 (algorithm_flag = 1) だけを残す。
+    demote が False の場合は、同じ建物IDが複数の建物に採用された場合の除去を行わない。
+
+    Returns
+    -------
+    (候補件数, 足切り後の件数, 採用件数)
+    """
+    if demote:
+        if use_geography_area():
+            cursor = db.execute_prepared(conn, "score_candidates_geography", SCORING_SQL_GEOGRAPHY,
+                                         (user_id, session_id, file))
+        else:
+            cursor = db.execute_prepared(conn, "score_candidates", SCORING_SQL, (user_id, session_id, file))
+        return cursor.fetchone()
+
+    geography = use_geography_area()
+    cursor = db.execute_prepared(
+        conn, "score_candidates_geography_keep_duplicates" if geography else "score_candidates_keep_duplicates",
+        SCORING_SQL_TEMPLATE.format(footprint_area=GEOGRAPHY_AREA if geography else PROJECTED_AREA,
+                                    demoted_condition=''),
+        (user_id, session_id, file))
+    return cursor.fetchone()
+
+
+def demote_duplicate_buildings(conn, user_id: str, session_id: str, file: str) -> int:
+    """
+    ファイル file の採用された候補について、同じ建物IDが複数の建物に採用された場合に
+    最もスコアの高いもの以外を削除し、削除した件数を返す (demote=False でスコアを計算した場合に使う)
+    """
+    cursor = db.execute_prepared(conn, "demote_duplicate_buildings", DEMOTE_SQL, (user_id, session_id, file))
+    return cursor.fetchone()[0]
+
+
+def score_candidates_legacy(conn, user_id: str, session_id: str, file: str, demote: bool = True) -> tuple:
+    """
+    score_candidates と同じ処理を、従来どおりスコアごとの UPDATE/DELETE/INSERT と一時テーブルで行う
+    (SCORING_BACKEND=legacy の場合、および結果の比較用)。面積は常に測地線面積で計算する
+    """
+    # スコアの設定 score_fude
+    update_sql = f'''
+    UPDATE building_citygml_matched
+    SET score_fude = ROUND(100 * ST_Area(ST_Intersection(lod0geom, region)) / ST_Area(lod0geom))
+    WHERE
+    user_id = '{user_id}'
+    AND session_id = '{session_id}'
+    AND filename = '{file}'
+    '''
+    conn.cursor().execute(update_sql)
+
+    # score_fude が NULL のレコードについて、score_high = 0 に設定する
+    update_sql = f'''
+    UPDATE building_citygml_matched
+    SET score_fude = 0
+    WHERE
+    user_id = '{user_id}'
+    AND session_id = '{session_id}'
+    AND filename = '{file}'
+    AND score_fude IS NULL
+    '''
+    conn.cursor().execute(update_sql)
+
+
+    # スコアの設定 score_high
+    # citygmlの地上階数・地下階数が登記データの地上階数・地下階数と一致してる場合、
+    # score_high = 100 に設定する。
+    update_sql = f'''
+    UPDATE building_citygml_matched
+    SET score_high = 100
+    WHERE
+    user_id = '{user_id}'
+    AND session_id = '{session_id}'
+    AND filename = '{file}'
+    AND citygml_floors = storeysAboveGround
+    AND citygml_floors_below_ground = storeysBelowGround
+    '''
+    conn.cursor().execute(update_sql)
+
+    # その他 score_high の設定
+    # 登記データの地上階数・地下階数とPLATEAU階数が一致してたら、100点
+    # 一致してない場合、
+    # 100-ABS(登記データの階数 * 2.85m + 1.93m - PLATEAU 建物の高さ)
+
+    update_sql = f'''
+    UPDATE building_citygml_matched
+    SET score_high =
+    CASE WHEN ((100 - abs(NULLIF(floors, 0) * {HIGH_VALUE} + {MINUS_HIGH_VALUE} / NULLIF(floors, 0)))) < 0 THEN 0
+    ELSE ((100 - abs(NULLIF(floors, 0) * {HIGH_VALUE} + {MINUS_HIGH_VALUE} / NULLIF(floors, 0))))
+    END
+    WHERE
+    user_id = '{user_id}'
+    AND session_id = '{session_id}'
+    AND filename = '{file}'
+    AND score_high = 0
+    '''
+    conn.cursor().execute(update_sql)
+
+    # score_high が NULL のレコードについて、score_high = 0 に設定する
+    update_sql = f'''
+    UPDATE building_citygml_matched
+    SET score_high = 0
+    WHERE
+    user_id = '{user_id}'
+    AND session_id = '{session_id}'
+    AND filename = '{file}'
+    AND score_high IS NULL
+    '''
+    conn.cursor().execute(update_sql)
+
+    # スコアの設定 score_wide
+    update_sql = f'''
+    UPDATE building_citygml_matched
+    SET score_wide = 100
+    WHERE
+    user_id = '{user_id}'
+    AND session_id = '{session_id}'
+    AND filename = '{file}'
+    AND citygml_floor_space = buildingFootprintArea
+    '''
+    conn.cursor().execute(update_sql)
+
+    # 登記データの床面積が、PLATEAU footPrintArea とm2単位で一致していたら、100点
+    # 一致してない場合、
+    # 100 - (ABS(登記データの1F床面積 - PLATEAU 建物の図形の面積 * 0.8) / 登記データの1F床面積) * 100
+    update_sql = f'''
+    UPDATE building_citygml_matched
+    SET score_wide = CASE when floor_space = 0 THEN 0
+    when (100 - abs(floor_space - ST_Area(lod0geom::geography) * 0.8) / NULLIF(floor_space, 0) * 100) < 0 THEN 0
+    ELSE (100 - abs(floor_space - ST_Area(lod0geom::geography) * 0.8) / NULLIF(floor_space, 0) * 100)
+    END
+    WHERE
+    user_id = '{user_id}'
+    AND session_id = '{session_id}'
+    AND filename = '{file}'
+    AND score_wide = 0
+    '''
+    conn.cursor().execute(update_sql)
+
+    # score_wide が NULL のレコードについて、score_high = 0 に設定する
+    update_sql = f'''
+    UPDATE building_citygml_matched
+    SET score_wide = 0
+    WHERE
+    user_id = '{user_id}'
+    AND session_id = '{session_id}'
+    AND filename = '{file}'
+    AND score_wide IS NULL
+    '''
+    conn.cursor().execute(update_sql)
+
+    # 各行のスコアの合計値を算出
+    update_sql = f'''
+    UPDATE building_citygml_matched
+    SET score_total = ((score_fude + score_high + score_wide) / 3)
+    WHERE
+    user_id = '{user_id}'
+    AND session_id = '{session_id}'
+    AND filename = '{file}'
+    '''
+    conn.cursor().execute(update_sql)
+
+    # 件数確認用SQL
+    count_sql = f'''
+    SELECT count(*) AS row_count
+    FROM building_citygml_matched
+    WHERE
+    user_id = '{user_id}'
+    AND session_id = '{session_id}'
+    AND filename = '{file}'
+    '''
+    cursor = conn.cursor()
+    cursor.execute(count_sql)
+    candidate_count = cursor.fetchone()[0]
+
+    # この時点でスコア合計値が50点未満のレコードは削除(残しておくことで誤マッチングの可能性があるため)
+    update_sql = f'''
+    DELETE FROM building_citygml_matched
+    WHERE
+    user_id = '{user_id}'
+    AND session_id = '{session_id}'
+    AND filename = '{file}'
+    AND score_total < {LEGCUT_SCORE}
+    '''
+    conn.cursor().execute(update_sql)
+
+    # create uuid from user_id and session_id
+    temporary_table_name = 'building_citygml_matched_tmp'
+
+    # create temporary table
+    create_sql = f'''
+    CREATE TEMPORARY TABLE IF NOT exists {temporary_table_name} (
+        gml_id varchar NOT NULL,
+        建物id varchar(16) NULL,
+        lod0geom public.geometry(geometry, 4326) NULL,
+        filename varchar(255) NULL,
+        user_id varchar(255) NOT NULL,
+        session_id varchar(255) NOT NULL,
+        tatemono_id text NULL,
+        bldg_id varchar(18) NOT NULL,
+        bunrui varchar(8) NULL,
+        n_touki integer NULL,
+        floor_space float4 NULL,
+        structure_code integer NULL,
+        height double precision NULL,
+        floors integer NULL,
+        region public.geometry(multipolygon, 4326) NULL,
+        fudosan_id text NOT NULL,
+        algorithm_flag varchar(2) NULL,
+        score_fude integer NULL,
+        score_high integer NULL,
+        score_wide integer NULL,
+        score_total integer NULL,
+        score_total_max integer NULL,
+        matching_count integer NULL DEFAULT 0,
+
+        citygml_floors integer NULL,
+        citygml_floors_below_ground integer NULL,
+        citygml_floor_space float4 NULL,
+        citygml_usage_code integer NULL,
+        citygml_structure_code integer NULL,
+        citygml_construction_year integer NULL,
+
+        storeysAboveGround integer NULL,
+        storeysBelowGround integer NULL,
+        buildingFootprintArea float4 NULL,
+        usage integer NULL,
+        buildingStructureType_uro integer NULL,
+        yearOfConstruction integer NULL,
+        fudosan_id_hash varchar(32) NULL,
+        lod0_area double precision NULL
+    );
+    CREATE INDEX IF NOT exists building_citygml_matched_idx1 ON {temporary_table_name} (gml_id, filename, user_id, session_id);
+    CREATE INDEX IF NOT exists building_citygml_matched_idx2 ON {temporary_table_name} (gml_id, user_id, session_id);
+    CREATE INDEX IF NOT exists building_citygml_matched_idx3 ON {temporary_table_name} (gml_id);
+    CREATE INDEX IF NOT exists building_citygml_matched_idx4 ON {temporary_table_name} (algorithm_flag);
+    '''
+    conn.cursor().execute(create_sql)
+
+    # insert data to temporary table
+    insert_sql = f'''
+    INSERT INTO {temporary_table_name}
+    SELECT
+    *
+    FROM building_citygml_matched
+    WHERE
+    user_id = '{user_id}'
+    AND session_id = '{session_id}'
+    AND filename = '{file}'
+    '''
+    conn.cursor().execute(insert_sql)
+
+    # matching function on temporary table
+    # delete data from building_citygml_matched
+    delete_sql = f'''
+    DELETE FROM building_citygml_matched
+    WHERE
+    user_id = '{user_id}'
+    AND session_id = '{session_id}'
+    AND filename = '{file}'
+    '''
+    conn.cursor().execute(delete_sql)
+
+    # matching function on temporary table
+    # 件数確認用SQL
+    count_sql = f'''
+    SELECT count(*) AS row_count
+    FROM {temporary_table_name}
+    '''
+    cursor = conn.cursor()
+    cursor.execute(count_sql)
+    passed_count = cursor.fetchone()[0]
+
+    # 建物不動産ID, 建物ID, 不動産IDの連結文字列を元にハッシュ値を作って更新する
+    # alter table {temporary_table_name} add column fudosan_id_hash varchar(32);
+    update_sql = f'''
+    update {temporary_table_name} set fudosan_id_hash = md5(tatemono_id||bldg_id||fudosan_id);
+    '''
+    conn.cursor().execute(update_sql)
+
+    # インデックスを定義する
+    create_sql = f'''
+    CREATE INDEX IF NOT exists building_citygml_matched_idx5 ON {temporary_table_name} (gml_id, fudosan_id_hash, score_total);
+    CREATE INDEX IF NOT exists building_citygml_matched_idx6 ON {temporary_table_name} (gml_id, fudosan_id_hash);
+    '''
+    conn.cursor().execute(create_sql)
+
+    # ウィンドウ関数を利用してランキング1位のレコードにalgorithm_flag = 1 を設定する
+    update_sql = f'''
+    UPDATE {temporary_table_name} as a
+    set algorithm_flag = '1',
+    score_total_max = subq.score_total
+    FROM (
+        SELECT gml_id, fudosan_id_hash, score_total
+        FROM (
+            SELECT
+            gml_id, fudosan_id_hash, score_total,
+            rank() over (partition by gml_id ORDER BY score_total desc) AS score_rank
+            FROM {temporary_table_name} bcm
+            group by gml_id, fudosan_id_hash, score_total
+        ) as b
+        where b.score_rank = 1
+    ) as subq
+    WHERE
+    a.gml_id = subq.gml_id
+    and a.fudosan_id_hash = subq.fudosan_id_hash
+    '''
+    conn.cursor().execute(update_sql)
+
+    # 点数が最高点+-5点であるレコードについて、algorithm_flag = 10 に設定する
+    update_sql = f'''
+    UPDATE {temporary_table_name}
+    SET algorithm_flag = '10'
+    WHERE
+    gml_id in (
+        SELECT gml_id
+        FROM (
+            SELECT gml_id, count(gml_id) as count_gml_id
+            FROM {temporary_table_name}
+            WHERE score_total BETWEEN (score_total_max - 5) AND (score_total_max + 5)
+            GROUP BY gml_id
+        ) AS a
+        WHERE count_gml_id > 1
+    )
+    '''
+    conn.cursor().execute(update_sql)
+
+    # 同点1位のlgorithm_flag = 10 のレコードを他の条件でチェック。
+    # 建築年が+-1であるか
+    # 該当するレコードがあれば、matching_countを増やす
+    update_sql = f'''
+    UPDATE {temporary_table_name}
+    SET matching_count = matching_count + 1
+    WHERE
+    algorithm_flag = '10'
+    AND citygml_construction_year BETWEEN (yearOfConstruction-1) AND (yearOfConstruction+1)
+    '''
+    conn.cursor().execute(update_sql)
+
+    # 同点1位のlgorithm_flag = 10 のレコードを他の条件でチェック。
+    # 構造が同じかどうか
+    # 該当するレコードがあれば、matching_countを増やす
+    update_sql = f'''
+    UPDATE {temporary_table_name}
+    SET matching_count = matching_count + 1
+    WHERE
+    algorithm_flag = '10'
+    AND citygml_structure_code = buildingStructureType_uro
+    '''
+    conn.cursor().execute(update_sql)
+
+    # 同点1位のlgorithm_flag = 10 のレコードを他の条件でチェック。
+    # 用途が同じか
+    # 該当するレコードがあれば、matching_countを増やす
+    update_sql = f'''
+    UPDATE {temporary_table_name}
+    SET matching_count = matching_count + 1
+    WHERE
+    algorithm_flag = '10'
+    AND citygml_usage_code = usage
+    '''
+    conn.cursor().execute(update_sql)
+
+    # matching_count が最も高いレコードについて、algorithm_flag = 1 に設定する
+    # gml_idが複数発生するので、この条件は不要
+    # update_sql = f'''
+    # UPDATE {temporary_table_name} as a
+    # set algorithm_flag = '1'
+    # FROM (
+    #     SELECT gml_id, fudosan_id_hash, matching_count
+    #     FROM (
+    #         SELECT
+    #         gml_id, fudosan_id_hash, score_total, matching_count,
+    #         rank() over (partition by gml_id ORDER BY matching_count desc) AS score_rank
+    #         FROM {temporary_table_name} bcm
+    #         WHERE algorithm_flag = '10'
+    #         group by gml_id, fudosan_id_hash, score_total, matching_count
+    #     ) as b
+    #     where b.score_rank = 1 and matching_count > 0
+    # ) as subq
+    # where a.gml_id = subq.gml_id
+    # and a.fudosan_id_hash = subq.fudosan_id_hash
+    # '''
+    # conn.cursor().execute(update_sql)
+
+    # matching_count, score_total が最も高いレコードについて、algorithm_flag = 1 に設定する
+    update_sql = f'''
+    UPDATE {temporary_table_name} as a
+    set algorithm_flag = '1'
+    FROM (
+        SELECT gml_id, fudosan_id_hash, score_total, matching_count
+        FROM (
+            SELECT
+            gml_id, fudosan_id_hash, score_total, matching_count,
+            rank() over (partition by gml_id ORDER BY matching_count desc, score_total desc) AS score_rank
+            FROM {temporary_table_name} bcm
+            WHERE algorithm_flag = '10'
+            group by gml_id, fudosan_id_hash, score_total, matching_count
+        ) as b
+        where b.score_rank = 1 and matching_count > 0
+    ) as subq
+    where a.gml_id = subq.gml_id
+    and a.fudosan_id_hash = subq.fudosan_id_hash
+    and a.score_total = subq.score_total
+    '''
+    conn.cursor().execute(update_sql)
+
+    # 敷地に含まれるため同じ建物不動産IDが設定される敷地内の複数の建物について、
+    # 最もマッチングスコアが大きなものに対してだけ、algorithm_flag = 1 に設定するための処理
+    # (demote が False の場合は、キャッシュから戻した建物と合わせてから demote_duplicate_buildings で行う)
+    update_sql = f'''
+    UPDATE {temporary_table_name} as a
+    set algorithm_flag = '10'
+    FROM (
+        SELECT gml_id, bldg_id, fudosan_id_hash, score_total
+        FROM (
+            SELECT
+            gml_id, bldg_id, fudosan_id_hash, score_total,
+            rank() over (partition by bldg_id ORDER BY score_total desc) AS score_rank
+            FROM {temporary_table_name} bcm
+            WHERE algorithm_flag = '1'
+            GROUP by gml_id, bldg_id, fudosan_id_hash, score_total
+        ) as b
+        WHERE b.score_rank > 1
+    ) as subq
+    WHERE a.gml_id = subq.gml_id
+    and a.fudosan_id_hash = subq.fudosan_id_hash
+    '''
+    if demote:
+        conn.cursor().execute(update_sql)
+
+    # algorithm_flag = 1以外のレコードを削除する
+    delete_sql = f'''
+    DELETE FROM {temporary_table_name}
+    WHERE
+    algorithm_flag <> '1'
+    '''
+    conn.cursor().execute(delete_sql)
+
+    # 不動産idから生成したハッシュ値を削除する
+    update_sql = f'''
+    ALTER TABLE {temporary_table_name} DROP COLUMN fudosan_id_hash;
+    '''
+    # conn.cursor().execute(update_sql)
+
+    # building_citygml_matched にデータを戻す
+    insert_sql = f'''
+    INSERT INTO building_citygml_matched
+    SELECT
+    DISTINCT
+    *
+    FROM {temporary_table_name}
+    '''
+    conn.cursor().execute(insert_sql)
+
+    # drop temporary table
+    drop_sql = f'''
+    DROP TABLE {temporary_table_name}
+    '''
+    conn.cursor().execute(drop_sql)
+
+    # 件数チェック
+    count_sql = f'''
+    SELECT count(*) AS row_count
+    FROM building_citygml_matched
+    WHERE
+    user_id = '{user_id}'
+    AND session_id = '{session_id}'
+    AND filename = '{file}'
+    '''
+    cursor = conn.cursor()
+    cursor.execute(count_sql)
+    matched_count = cursor.fetchone()[0]
+
+    return candidate_count, passed_count, matched_count
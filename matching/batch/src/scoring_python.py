@@ -0,0 +1,237 @@
+"""
+マッチング候補のスコア計算を、データベースではなくバッチのコンテナ上で行うモジュール (SCORING_BACKEND=python)。
+
+ファイルの候補を1回の SQL で取り出し、Shapely 2 のベクトル演算 (intersection, area) と NumPy で
+scoring.score_candidates と同じスコア計算・順位付け・同点時の判定・建物IDの重複除去を行い、
+採用する候補を1回の COPY で building_citygml_matched に書き戻す。
+複数のセッションが同じデータベースを使う場合に、PostGIS の CPU 負荷をバッチ側に移すことができる。
+"""
+import hashlib
+import io
+
+import numpy as np
+import shapely
+
+from scoring import (GEOGRAPHY_AREA, HIGH_VALUE, LEGCUT_SCORE, MATCHED_COLUMNS, MINUS_HIGH_VALUE, PROJECTED_AREA,
+                     use_geography_area)
+
+# 候補を取り出す SQL
+# ジオメトリは16進数の EWKB のまま受け取り、書き戻すときもそのまま使う。
+# score_wide の面積 (インポート時に計算した平面直角座標系の面積、または測地線面積) も合わせて受け取る
+FETCH_SQL_TEMPLATE = f'''
+DELETE FROM building_citygml_matched
+WHERE
+user_id = %s
+AND session_id = %s
+AND filename = %s
+RETURNING {', '.join(MATCHED_COLUMNS)}, {{footprint_area}}
+'''
+FETCH_SQL = FETCH_SQL_TEMPLATE.format(footprint_area=PROJECTED_AREA)
+# 測地線面積は PostGIS と同じ値にするため、データベースに計算させる
+FETCH_SQL_GEOGRAPHY = FETCH_SQL_TEMPLATE.format(footprint_area=GEOGRAPHY_AREA)
+
+_INDEX = {name: i for i, name in enumerate(MATCHED_COLUMNS)}
+
+
+def _column(rows: list, name: str) -> list:
+    i = _INDEX[name]
+    return [row[i] for row in rows]
+
+
+def _float_array(values: list, dtype=np.float64) -> np.ndarray:
+    """値のリストを NULL (None) を NaN とした浮動小数点数の配列にする"""
+    return np.array([np.nan if v is None else v for v in values], dtype=dtype).astype(np.float64)
+
+
+def _round_half_away(values: np.ndarray) -> np.ndarray:
+    """numeric から integer への変換と同じく、0.5 を0から遠い方に丸める"""
+    return np.sign(values) * np.floor(np.abs(values) + 0.5)
+
+
+def _group_max(keys: np.ndarray, values: np.ndarray, size: int) -> np.ndarray:
+    """keys ごとの values の最大値 (NaN は無視し、値がなければ NaN)"""
+    result = np.full(size, -np.inf)
+    valid = ~np.isnan(values)
+    np.maximum.at(result, keys[valid], values[valid])
+    result[np.isneginf(result)] = np.nan
+    return result
+
+
+def _group_any(keys: np.ndarray, flags: np.ndarray, size: int) -> np.ndarray:
+    """keys ごとに flags が1つでも True か"""
+    return np.bincount(keys, weights=flags.astype(np.float64), minlength=size) > 0
+
+
+def _factorize(*columns: list) -> tuple:
+    """複数カラムの値の組に 0 から始まる番号を振り、(番号の配列, 組の数) を返す"""
+    codes = {}
+    keys = np.array([codes.setdefault(key, len(codes)) for key in zip(*columns)], dtype=np.int64)
+    return keys, len(codes)
+
+
+def _fudosan_id_hash(tatemono_id, bldg_id, fudosan_id):
+    """md5(tatemono_id||bldg_id||fudosan_id) と同じハッシュ値 (いずれかが NULL なら NULL)"""
+    if tatemono_id is None or bldg_id is None or fudosan_id is None:
+        return None
+    return hashlib.md5(f"{tatemono_id}{bldg_id}{fudosan_id}".encode('utf-8')).hexdigest()
+
+
+def _copy_value(value) -> str:
+    """COPY (テキスト形式) の1フィールド分の文字列"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, float):
+        return repr(value)
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def calc_scores(rows: list, footprint_areas: list) -> tuple:
+    """
+    候補の行 (MATCHED_COLUMNS の順) からスコアを計算する。
+
+    Returns
+    -------
+    (score_fude, score_high, score_wide, score_total) の配列のタプル
+    """
+    lod0geom = shapely.from_wkb(np.array(_column(rows, 'lod0geom'), dtype=object))
+    region = shapely.from_wkb(np.array(_column(rows, 'region'), dtype=object))
+
+    # score_fude: 建物の図形のうち、登記の筆の範囲に含まれる面積の割合
+    lod0_area = shapely.area(lod0geom)
+    if np.any(lod0_area == 0):
+        raise ZeroDivisionError("lod0geom の面積が0の建物があります")
+    with np.errstate(invalid='ignore'):
+        fude = np.rint(100 * shapely.area(shapely.intersection(lod0geom, region)) / lod0_area)
+    score_fude = np.nan_to_num(fude, nan=0).astype(np.int64)
+
+    # score_high: 階数が一致すれば100点、一致しなければ登記の階数から求める
+    floors = _float_array(_column(rows, 'floors'))
+    floors[floors == 0] = np.nan
+    high = 100 - np.abs(floors * HIGH_VALUE + MINUS_HIGH_VALUE / floors)
+    high = _round_half_away(np.where(high < 0, 0, high))
+    floors_match = ((_float_array(_column(rows, 'citygml_floors')) == _float_array(_column(rows, 'storeysAboveGround')))
+                    & (_float_array(_column(rows, 'citygml_floors_below_ground'))
+                       == _float_array(_column(rows, 'storeysBelowGround'))))
+    score_high = np.where(floors_match, 100, np.nan_to_num(high, nan=0)).astype(np.int64)
+
+    # score_wide: 床面積が一致すれば100点、一致しなければ登記の床面積と建物の図形の面積から求める
+    floor_space = _float_array(_column(rows, 'floor_space'), dtype=np.float32)
+    area = _float_array(footprint_areas)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        wide = 100 - np.abs(floor_space - area * 0.8) / np.where(floor_space == 0, np.nan, floor_space) * 100
+    wide = np.rint(np.where((floor_space == 0) | (wide < 0), 0, wide))
+    space_match = (_float_array(_column(rows, 'citygml_floor_space'), dtype=np.float32)
+                   == _float_array(_column(rows, 'buildingFootprintArea'), dtype=np.float32))
+    score_wide = np.where(space_match, 100, np.nan_to_num(wide, nan=0)).astype(np.int64)
+
+    score_total = (score_fude + score_high + score_wide) // 3
+    return score_fude, score_high, score_wide, score_total
+
+
+def select_winners(rows: list, score_total: np.ndarray, demote: bool = True) -> tuple:
+    """
+    スコア合計値が足切り点以上の候補 rows について、建物ごとに採用する候補を決める。
+    demote が False の場合は、同じ建物IDが複数の建物に採用された場合の除去を行わない。
+
+    Returns
+    -------
+    (採用する候補の真偽値配列, score_total_max, matching_count, fudosan_id_hash)
+    """
+    size = len(rows)
+    gml_ids = _column(rows, 'gml_id')
+    hashes = [_fudosan_id_hash(t, b, f) for t, b, f in zip(
+        _column(rows, 'tatemono_id'), _column(rows, 'bldg_id'), _column(rows, 'fudosan_id'))]
+    total = score_total.astype(np.float64)
+
+    gml, gml_count = _factorize(gml_ids)
+    gml_hash, gml_hash_count = _factorize(gml_ids, hashes)
+    gml_hash_total, gml_hash_total_count = _factorize(gml_ids, hashes, score_total.tolist())
+
+    # gml_id ごとの最高点を持つ候補に algorithm_flag = 1 と score_total_max を設定する
+    gml_max = _group_max(gml, total, gml_count)[gml]
+    top = _group_max(gml_hash, total, gml_hash_count)[gml_hash] == gml_max
+    score_total_max = np.where(top, gml_max, _float_array(_column(rows, 'score_total_max')))
+
+    # 最高点 +-5点の候補が複数ある gml_id は algorithm_flag = 10 とし、他の属性が一致する数を matching_count に加算する
+    in_range = (total >= score_total_max - 5) & (total <= score_total_max + 5)
+    tied = (np.bincount(gml, weights=in_range.astype(np.float64), minlength=gml_count) > 1)[gml]
+    construction_year = _float_array(_column(rows, 'yearOfConstruction'))
+    citygml_construction_year = _float_array(_column(rows, 'citygml_construction_year'))
+    matches = (((citygml_construction_year >= construction_year - 1)
+                & (citygml_construction_year <= construction_year + 1)).astype(np.int64)
+               + (_float_array(_column(rows, 'citygml_structure_code'))
+                  == _float_array(_column(rows, 'buildingStructureType_uro'))).astype(np.int64)
+               + (_float_array(_column(rows, 'citygml_usage_code'))
+                  == _float_array(_column(rows, 'usage'))).astype(np.int64))
+    matching_count = _float_array(_column(rows, 'matching_count'))
+    matching_count = np.where(tied, matching_count + matches, matching_count)
+
+    # 同点の gml_id では、matching_count, score_total の順で1位の候補を algorithm_flag = 1 に戻す
+    # (matching_count が NULL の候補があると、降順で先頭になる NULL が1位になるため採用されない)
+    has_null = _group_any(gml, np.isnan(matching_count), gml_count)[gml]
+    count_max = _group_max(gml, matching_count, gml_count)[gml]
+    at_count_max = matching_count == count_max
+    total_max_at_count_max = _group_max(gml, np.where(at_count_max, total, np.nan), gml_count)[gml]
+    tie_winner = tied & ~has_null & at_count_max & (total == total_max_at_count_max) & (matching_count > 0)
+    resolved = _group_any(gml_hash_total, tie_winner, gml_hash_total_count)[gml_hash_total]
+    flag_one = np.where(tied, resolved, top)
+
+    if not demote:
+        return flag_one, score_total_max, matching_count, hashes
+
+    # 同じ建物IDが複数の建物に採用された場合、最もスコアの高いもの以外は採用しない
+    bldg, bldg_count = _factorize(_column(rows, 'bldg_id'))
+    bldg_max = _group_max(bldg, np.where(flag_one, total, np.nan), bldg_count)[bldg]
+    loser = flag_one & (total < bldg_max)
+    demoted = _group_any(gml_hash, loser, gml_hash_count)[gml_hash]
+
+    return flag_one & ~demoted, score_total_max, matching_count, hashes
+
+
+def score_candidates_python(conn, user_id: str, session_id: str, file: str, demote: bool = True) -> tuple:
+    """
+    scoring.score_candidates と同じ処理を、Shapely と NumPy で行う。
+    demote が False の場合は、同じ建物IDが複数の建物に採用された場合の除去を行わない。
+
+    Returns
+    -------
+    (候補件数, 足切り後の件数, 採用件数)
+    """
+    cursor = conn.cursor()
+    cursor.execute(FETCH_SQL_GEOGRAPHY if use_geography_area() else FETCH_SQL, (user_id, session_id, file))
+    fetched = cursor.fetchall()
+    if not fetched:
+        return 0, 0, 0
+    rows = [row[:-1] for row in fetched]
+    score_fude, score_high, score_wide, score_total = calc_scores(rows, [row[-1] for row in fetched])
+
+    passed = np.flatnonzero(score_total >= LEGCUT_SCORE)
+    rows = [rows[i] for i in passed]
+    score_fude, score_high, score_wide, score_total = (
+        score_fude[passed], score_high[passed], score_wide[passed], score_total[passed])
+    if not rows:
+        return len(fetched), 0, 0
+    winners, score_total_max, matching_count, hashes = select_winners(rows, score_total, demote)
+
+    # 採用する候補を重複を除いて書き戻す
+    records = {}
+    for i in np.flatnonzero(winners):
+        record = list(rows[i])
+        record[_INDEX['algorithm_flag']] = '1'
+        record[_INDEX['score_fude']] = int(score_fude[i])
+        record[_INDEX['score_high']] = int(score_high[i])
+        record[_INDEX['score_wide']] = int(score_wide[i])
+        record[_INDEX['score_total']] = int(score_total[i])
+        record[_INDEX['score_total_max']] = None if np.isnan(score_total_max[i]) else int(score_total_max[i])
+        record[_INDEX['matching_count']] = None if np.isnan(matching_count[i]) else int(matching_count[i])
+        record[_INDEX['fudosan_id_hash']] = hashes[i]
+        records.setdefault(tuple(record), None)
+
+    buffer = io.StringIO()
+    for record in records:
+        buffer.write('\t'.join(_copy_value(value) for value in record) + '\n')
+    buffer.seek(0)
+    cursor.copy_expert(
+        f"COPY building_citygml_matched ({', '.join(MATCHED_COLUMNS)}) FROM STDIN", buffer)
+    return len(fetched), len(rows), len(records)
@@ -0,0 +1,185 @@
+"""
+セッションのマッチング結果 (building_citygml_matched) を、不動産IDを付与した CityGML の ZIP と同じ場所に
+GeoParquet / FlatGeobuf / CSV でも出力するモジュール。
+
+CityGML を解析し直さなくても、GIS や分析基盤で gml_id と不動産IDの対応を読み込めるようにする。
+出力する形式は環境変数 ESTATE_ID_SIDECAR_FORMATS にカンマ区切りで指定する (parquet, fgb, csv。既定は出力しない)。
+
+建物ごとに、不動産IDを付与した CityGML と同じ結果 (スコアの最も高いマッチング結果) を1行にする。
+DB からはサーバーサイドカーソルで BATCH_ROWS 行ずつ読み出し、Arrow の RecordBatch にして各形式に書き込むので、
+セッション全体の結果をメモリに載せることはない。
+
+- parquet: GeoParquet 1.0 (geometry 列は WKB。crs は省略しているので OGC:CRS84 (経度・緯度) とみなされる)
+- csv: 土地・区分所有建物の不動産IDはカンマ区切り、geometry 列は WKT
+- fgb: CSV を ogr2ogr で FlatGeobuf に変換する (不動産IDのリストはカンマ区切りの文字列)
+"""
+import os
+import subprocess
+from typing import Iterator
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv
+import pyarrow.parquet
+import shapely
+
+FORMATS = ("parquet", "fgb", "csv")
+
+# サーバーサイドカーソルから一度に読み出す行数
+BATCH_ROWS = 10000
+
+# 建物ごとに、スコアの最も高いマッチング結果を1行にする
+# (main.add_estate_id_to_gml と同じく、建物不動産IDはカンマ区切りの先頭、区分所有建物の個別不動産IDは full_id_master から)
+EXPORT_SQL = r"""
+SELECT DISTINCT ON (m.filename, m.gml_id)
+m.filename,
+m.gml_id,
+split_part(m.tatemono_id, ',', 1) AS tatemono_id,
+regexp_split_to_array(NULLIF(m.fudosan_id, ''), '\s*,\s*') AS tochi_ids,
+regexp_split_to_array(NULLIF(f.kobetsu_id, ''), '\s*,\s*') AS kobetsu_ids,
+m.bldg_id,
+m.bunrui,
+m.algorithm_flag,
+m.score_fude,
+m.score_high,
+m.score_wide,
+m.score_total,
+m.score_total_max,
+ST_AsBinary(m.lod0geom) AS geometry
+FROM building_citygml_matched m
+LEFT JOIN full_id_master f ON m.bunrui = '区建' AND f.bldg_id = m.bldg_id
+WHERE m.user_id = %s AND m.session_id = %s
+ORDER BY m.filename, m.gml_id, m.score_total DESC
+"""
+
+SCHEMA = pa.schema([
+    ("filename", pa.string()),
+    ("gml_id", pa.string()),
+    ("tatemono_id", pa.string()),
+    ("tochi_ids", pa.list_(pa.string())),
+    ("kobetsu_ids", pa.list_(pa.string())),
+    ("bldg_id", pa.string()),
+    ("bunrui", pa.string()),
+    ("algorithm_flag", pa.string()),
+    ("score_fude", pa.int32()),
+    ("score_high", pa.int32()),
+    ("score_wide", pa.int32()),
+    ("score_total", pa.int32()),
+    ("score_total_max", pa.int32()),
+    ("geometry", pa.binary()),
+])
+
+# CSV に書き込む列 (不動産IDのリストはカンマ区切り、geometry は WKT)
+TEXT_SCHEMA = pa.schema([
+    pa.field(field.name, pa.string()) if pa.types.is_list(field.type) or field.name == "geometry" else field
+    for field in SCHEMA])
+
+# GeoParquet のメタデータ
+GEO_METADATA = (
+    b'{"version": "1.0.0", "primary_column": "geometry", '
+    b'"columns": {"geometry": {"encoding": "WKB", "geometry_types": []}}}'
+)
+
+
+def get_formats() -> list:
+    """環境変数 ESTATE_ID_SIDECAR_FORMATS で指定された出力形式"""
+    formats = [name.strip() for name in os.environ.get('ESTATE_ID_SIDECAR_FORMATS', '').split(',') if name.strip()]
+    unknown = [name for name in formats if name not in FORMATS]
+    if unknown:
+        raise ValueError(f"ESTATE_ID_SIDECAR_FORMATS に指定できない形式があります: {', '.join(unknown)}")
+    return formats
+
+
+def iter_batches(conn, user_id: str, session_id: str, batch_rows: int = BATCH_ROWS) -> Iterator[pa.RecordBatch]:
+    """セッションのマッチング結果をサーバーサイドカーソルで読み出し、batch_rows 行ずつ RecordBatch にして返す"""
+    cursor = conn.cursor(name="sidecar_export")
+    cursor.itersize = batch_rows
+    try:
+        cursor.execute(EXPORT_SQL, (user_id, session_id))
+        while True:
+            rows = cursor.fetchmany(batch_rows)
+            if not rows:
+                break
+            yield to_record_batch(rows)
+    finally:
+        cursor.close()
+
+
+def to_record_batch(rows: list) -> pa.RecordBatch:
+    """EXPORT_SQL の行のリストを RecordBatch にする"""
+    columns = [list(column) for column in zip(*rows)]
+    geometry = SCHEMA.get_field_index("geometry")
+    columns[geometry] = [None if value is None else bytes(value) for value in columns[geometry]]
+    return pa.RecordBatch.from_arrays(
+        [pa.array(column, type=field.type) for column, field in zip(columns, SCHEMA)], schema=SCHEMA)
+
+
+def to_text_batch(batch: pa.RecordBatch) -> pa.RecordBatch:
+    """CSV 用に、不動産IDのリストをカンマ区切りの文字列に、geometry を WKT にした RecordBatch を返す"""
+    arrays = []
+    for field, array in zip(batch.schema, batch.columns):
+        if pa.types.is_list(field.type):
+            array = pc.binary_join(array, ",")
+        elif field.name == "geometry":
+            array = pa.array(shapely.to_wkt(shapely.from_wkb(array.to_numpy(zero_copy_only=False))), pa.string())
+        arrays.append(array)
+    return pa.RecordBatch.from_arrays(arrays, schema=TEXT_SCHEMA)
+
+
+def write_sidecars(batches: Iterator[pa.RecordBatch], base_path: str, formats: list) -> dict:
+    """
+    batches を formats の形式で base_path + 拡張子 (.parquet, .fgb, .csv) に書き込み、
+    {形式: (パス, 行数)} を返す
+    """
+    paths = {}
+    parquet_writer = None
+    csv_writer = None
+    csv_path = None
+    rows = 0
+    try:
+        if "parquet" in formats:
+            paths["parquet"] = base_path + ".parquet"
+            parquet_writer = pyarrow.parquet.ParquetWriter(
+                paths["parquet"], SCHEMA.with_metadata({b"geo": GEO_METADATA}), compression="zstd")
+        if "csv" in formats or "fgb" in formats:
+            # FlatGeobuf は CSV から変換する (CSV を出力しない場合は一時ファイルにする)
+            csv_path = base_path + (".csv" if "csv" in formats else ".fgb.csv")
+            csv_writer = pyarrow.csv.CSVWriter(csv_path, TEXT_SCHEMA)
+        for batch in batches:
+            rows += batch.num_rows
+            if parquet_writer is not None:
+                parquet_writer.write_batch(batch)
+            if csv_writer is not None:
+                csv_writer.write_batch(to_text_batch(batch))
+    finally:
+        if parquet_writer is not None:
+            parquet_writer.close()
+        if csv_writer is not None:
+            csv_writer.close()
+
+    if "csv" in formats:
+        paths["csv"] = csv_path
+    if "fgb" in formats:
+        paths["fgb"] = base_path + ".fgb"
+        try:
+            csv_to_flatgeobuf(csv_path, paths["fgb"])
+        finally:
+            if "csv" not in formats:
+                os.remove(csv_path)
+    return {name: (path, rows) for name, path in paths.items()}
+
+
+def csv_to_flatgeobuf(csv_path: str, fgb_path: str):
+    """ogr2ogr で CSV (geometry 列は WKT) を FlatGeobuf に変換する"""
+    if os.path.exists(fgb_path):
+        os.remove(fgb_path)
+    subprocess.run([
+        "ogr2ogr", "-f", "FlatGeobuf", fgb_path, csv_path,
+        "-nln", "matching", "-a_srs", "EPSG:4326",
+        "-oo", "GEOM_POSSIBLE_NAMES=geometry", "-oo", "KEEP_GEOM_COLUMNS=NO", "-oo", "AUTODETECT_TYPE=YES",
+    ], check=True)
+
+
+def export(conn, user_id: str, session_id: str, base_path: str, formats: list) -> dict:
+    """セッションのマッチング結果を formats の形式で出力し、{形式: (パス, 行数)} を返す"""
+    return write_sidecars(iter_batches(conn, user_id, session_id), base_path, formats)
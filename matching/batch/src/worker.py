@@ -0,0 +1,187 @@
+"""
+キューからセッションのジョブを取り出して、不動産IDの付与 (main.run_job) を続けて実行する常駐ワーカー。
+
+/receipt_request ごとに AWS Batch のコンテナを起動すると、イメージの取得、boto3 / lxml / psycopg2 のインポート、
+DB への接続、PREPARE、DB のキャッシュの読み込みを1件のジョブごとに行うことになり、
+メッシュ1枚分のような小さなジョブでは、処理時間のほとんどがこれらの準備になる。
+ワーカーは起動したプロセスでジョブを続けて処理するので、モジュール、DB の接続と PREPARE した文、
+S3 クライアント、DB 側のキャッシュがジョブをまたいで使われる。
+--workers が2以上の場合にファイルを並列に処理するプロセスプールも、ワーカーの起動時に1回だけ作成し、
+そのプロセスの DB の接続と PREPARE した文とともにジョブをまたいで使う。
+
+--concurrency の数だけジョブ処理用のプロセスを起動し、プロセスごとに1件ずつジョブを処理する
+(各プロセスの DB の接続は1つ)。main.py は環境変数でセッションを決めるので、同じプロセスで複数のジョブを同時には処理しない。
+SIGTERM / SIGINT を受け取ると、処理中のジョブを終えてから終了する。
+終了までに処理が終わらなかったジョブは、キューから再配信されたときに session_ledger の記録から再開する。
+
+実行方法:
+    python src/worker.py --queue https://sqs.ap-northeast-1.amazonaws.com/123456789012/estate-id-jobs --concurrency 4
+    python src/worker.py --queue file:data/queue --enqueue [ユーザID] [セッションID]
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import signal
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from dotenv import load_dotenv
+
+import db
+import job_queue
+import main
+import match_cache
+import metrics
+
+_stopping = False
+
+
+def parse_args() -> argparse.Namespace:
+    """コマンドライン引数を解析する"""
+    parser = argparse.ArgumentParser(description="キューからジョブを取り出して不動産IDを付与する常駐ワーカー")
+    parser.add_argument(
+        "--queue", default=os.environ.get('ESTATE_ID_WORKER_QUEUE'),
+        help="ジョブのキュー (SQS のキューの URL, file:[ディレクトリ], postgres。"
+             "環境変数 ESTATE_ID_WORKER_QUEUE でも指定可能)")
+    parser.add_argument(
+        "--concurrency", type=int,
+        default=int(os.environ.get('ESTATE_ID_WORKER_CONCURRENCY', '1')),
+        help="同時に処理するジョブの数 (環境変数 ESTATE_ID_WORKER_CONCURRENCY でも指定可能)")
+    parser.add_argument(
+        "--max-jobs", type=int, default=0,
+        help="プロセスごとに処理するジョブの数の上限 (0 は無制限。試験用)")
+    parser.add_argument(
+        "--idle-exit", action="store_true",
+        help="キューが空になったら終了する (試験用)")
+    parser.add_argument(
+        "--enqueue", nargs=2, metavar=("USER_ID", "SESSION_ID"),
+        help="ジョブを処理せずに、キューにジョブを1件追加する")
+    main.add_job_arguments(parser)
+    args = parser.parse_args()
+    if not args.queue:
+        parser.error("--queue または環境変数 ESTATE_ID_WORKER_QUEUE を指定してください")
+    return args
+
+
+def stop(signum, frame):
+    """処理中のジョブを終えたら終了する"""
+    global _stopping
+    _stopping = True
+
+
+def set_session(user_id: str, session_id: str):
+    """main.py が処理するセッションを切り替える"""
+    os.environ['ESTATE_ID_USER_ID'] = user_id
+    os.environ['ESTATE_ID_SESSION_ID'] = session_id
+    main.input_dir, main.output_dir = main.session_dirs()
+
+
+def remove_local_files():
+    """
+    処理が完了したセッションのローカルの入出力ファイルを削除する。
+    S3 にアップロードしない場合 (NO_USE_IAM_MODE が 0 以外) は、出力先が結果になるので削除しない
+    """
+    if int(os.environ.get('NO_USE_IAM_MODE')) == 0:
+        shutil.rmtree(main.input_dir, ignore_errors=True)
+        shutil.rmtree(main.output_dir, ignore_errors=True)
+
+
+def run_one(job: job_queue.Job, args: argparse.Namespace, executor: ProcessPoolExecutor = None) -> bool:
+    """ジョブを1件処理し、成否を返す"""
+    set_session(job.user_id, job.session_id)
+    # 計測値と建物データの版数は、ジョブごとに数え直す・問い合わせ直す
+    # (プロセスプールのプロセスでは、ジョブが変わったときに main.enter_job で問い合わせ直す)
+    metrics.reset()
+    match_cache.forget_version()
+    try:
+        main.run_job(args, executor)
+        return True
+    except Exception as err:
+        print(err)
+        print(f"ジョブ {job.user_id}/{job.session_id} の処理に失敗")
+        return False
+
+
+def check_executor(executor: ProcessPoolExecutor, workers: int) -> ProcessPoolExecutor:
+    """
+    プロセスプールのプロセスが異常終了して使えなくなっていたら、プロセスプールを作り直す
+    (使えなくなったプロセスプールでは、以降のジョブのすべてのファイルが失敗するため)
+    """
+    try:
+        executor.submit(os.getpid).result()
+        return executor
+    except BrokenProcessPool:
+        print("ワーカープロセスが異常終了したため、プロセスプールを作り直します")
+        executor.shutdown(wait=False)
+        return main.create_executor(workers)
+
+
+def serve(args: argparse.Namespace) -> list:
+    """キューからジョブを取り出して処理し続け、処理したジョブの処理時間 (秒) の一覧を返す"""
+    load_dotenv()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    db.init_pool(maxconn=1)
+    queue = job_queue.open_queue(args.queue)
+    executor = main.create_executor(args.workers) if args.workers > 1 else None
+    latencies = []
+    try:
+        while not _stopping and (args.max_jobs == 0 or len(latencies) < args.max_jobs):
+            job = queue.receive()
+            if job is None:
+                if args.idle_exit:
+                    break
+                continue
+            print(f"ジョブ {job.user_id}/{job.session_id} を開始 ({job.attempts}回目)")
+            start = time.perf_counter()
+            if run_one(job, args, executor):
+                queue.ack(job)
+                remove_local_files()
+            else:
+                queue.fail(job)
+            latencies.append(time.perf_counter() - start)
+            print(f"ジョブ {job.user_id}/{job.session_id} を終了 ({latencies[-1]:.2f}秒)")
+            if executor is not None:
+                executor = check_executor(executor, args.workers)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if latencies:
+        print(f"処理したジョブ: {len(latencies)}件, 処理時間の中央値: {statistics.median(latencies):.2f}秒")
+    db.close_pool()
+    return latencies
+
+
+def main_worker():
+    load_dotenv()
+    args = parse_args()
+    if args.enqueue:
+        job_queue.open_queue(args.queue).enqueue(*args.enqueue)
+        return
+    if args.concurrency <= 1:
+        serve(args)
+        return
+
+    print(f"{args.concurrency}プロセスでジョブを処理")
+    # main.py と同じく、スレッドのロックを引き継がないよう spawn で起動する
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=serve, args=(args,)) for _ in range(args.concurrency)]
+    for process in processes:
+        process.start()
+
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main_worker()
@@ -0,0 +1,182 @@
+"""
+作業用テーブル (building_citygml, building_citygml_matched) のパーティションを管理するモジュール。
+
+作業用テーブルは user_id で LIST パーティション化し、さらに各ユーザーのパーティションを
+session_id で LIST パーティション化する。セッションのデータはすべて1つの小さなパーティションに入るので、
+user_id, session_id を指定した問い合わせはそのパーティションだけを参照し、
+後片付けは行ごとの DELETE ではなくパーティションの切り離しと DROP で済む。
+
+パーティション名は user_id, session_id のハッシュ値から作る (任意の文字列を識別子に使わないため)。
+
+インデックスは親テーブルではなくセッションのパーティションごとに作成する。
+ステージングモード (ESTATE_ID_STAGING_MODE=unlogged) では、パーティションを UNLOGGED で作成して WAL を書かず、
+インデックスは後続の問い合わせで使うもの (STAGING_INDEXES) だけを、可能であればデータの投入後に作成する。
+"""
+import hashlib
+import os
+
+# 作業用テーブルの名前
+WORKING_TABLES = ("building_citygml", "building_citygml_matched")
+
+# セッションのパーティションに作成するインデックス (インデックス名の接尾辞, 定義)
+INDEXES = {
+    "building_citygml": (
+        ("lod0geom_geom_idx", "USING gist (lod0geom)"),
+        ("idx1", "(filename, user_id, session_id)"),
+    ),
+    "building_citygml_matched": (
+        ("idx1", "(gml_id, filename, user_id, session_id)"),
+        ("idx2", "(gml_id, user_id, session_id)"),
+        ("idx3", "(gml_id)"),
+        ("idx4", "(user_id, session_id, filename)"),
+        ("idx5", "(user_id, session_id)"),
+    ),
+}
+
+# ステージングモードで作成するインデックス
+# パーティションにはセッションのデータしかないので user_id, session_id は不要で、
+# ファイル単位の問い合わせ (マッチング・スコア計算・付与結果の取得) に使うインデックスだけを作成する
+STAGING_INDEXES = {
+    "building_citygml": (
+        ("filename_idx", "(filename)"),
+    ),
+    "building_citygml_matched": (
+        ("filename_idx", "(filename, gml_id)"),
+    ),
+}
+
+# パーティション化した時点では親テーブルに作成していたインデックス
+# (親テーブルのインデックスはすべてのパーティションに作成されてしまうので削除する)
+_PARENT_INDEXES = {
+    "building_citygml": ("building_citygml_lod0geom_geom_idx", "building_citygml_idx1"),
+    "building_citygml_matched": tuple(f"building_citygml_matched_idx{i}" for i in range(1, 6)),
+}
+
+
+def use_staging_mode() -> bool:
+    """作業用テーブルを UNLOGGED のステージングモードで作成するかどうか"""
+    return os.environ.get('ESTATE_ID_STAGING_MODE') == 'unlogged'
+
+
+def partition_names(table: str, user_id: str, session_id: str) -> tuple:
+    """table のユーザーのパーティション名と、セッションのパーティション名を返す"""
+    user_digest = hashlib.md5(user_id.encode('utf-8')).hexdigest()[:16]
+    session_digest = hashlib.md5(f"{user_id}/{session_id}".encode('utf-8')).hexdigest()[:16]
+    return f"{table}_u{user_digest}", f"{table}_s{session_digest}"
+
+
+def _lock(conn, table: str):
+    """table のパーティションの作成・変更を、同時に実行される他のジョブと排他する"""
+    conn.cursor().execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"working_tables:{table}",))
+
+
+def _user_lock_key(user_partition: str) -> str:
+    """ユーザーのパーティションの作成と削除を排他するアドバイザリロックのキー"""
+    return f"working_tables:{user_partition}"
+
+
+def migrate_unpartitioned_table(conn, table: str, index_names: tuple):
+    """
+    パーティション化されていない以前の作業用テーブルが残っている場合は、
+    テーブルとインデックスの名前を {名前}_unpartitioned に変更して、新しいテーブルを作成できるようにする
+    (以前のテーブルには作業中のデータしか入っていないので、不要になったら DROP してよい)
+    """
+    _lock(conn, table)
+    cursor = conn.cursor()
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (f"public.{table}",))
+    row = cursor.fetchone()
+    if row is None or row[0] != 'r':
+        return
+    print(f"{table}の名前を{table}_unpartitionedに変更")
+    cursor.execute(f"ALTER TABLE public.{table} RENAME TO {table}_unpartitioned")
+    for index_name in index_names:
+        cursor.execute(f"ALTER INDEX IF EXISTS public.{index_name} RENAME TO {index_name}_unpartitioned")
+
+
+def drop_parent_indexes(conn, table: str):
+    """親テーブルに作成されているインデックスを削除する"""
+    _lock(conn, table)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT 1 FROM pg_class WHERE oid = to_regclass(%s) AND relkind = 'I'",
+        (f"public.{_PARENT_INDEXES[table][0]}",))
+    if cursor.fetchone() is not None:
+        cursor.execute(f"DROP INDEX IF EXISTS {', '.join(f'public.{name}' for name in _PARENT_INDEXES[table])}")
+
+
+def create_session_partition(conn, table: str, user_id: str, session_id: str, unlogged: bool = False):
+    """
+    table に user_id, session_id のデータを格納するパーティションがなければ作成する。
+    unlogged が True の場合は UNLOGGED テーブルとして作成する
+    """
+    user_partition, session_partition = partition_names(table, user_id, session_id)
+    _lock(conn, table)
+    cursor = conn.cursor()
+    # 同じユーザーの以前のジョブがユーザーのパーティションを削除している間は、削除し終えるまで待つ
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (_user_lock_key(user_partition),))
+    cursor.execute(
+        f'''
+        CREATE TABLE IF NOT exists public.{user_partition}
+        PARTITION OF public.{table} FOR VALUES IN (%s)
+        PARTITION BY LIST (session_id)
+        ''', (user_id,))
+    cursor.execute(
+        f'''
+        CREATE {'UNLOGGED ' if unlogged else ''}TABLE IF NOT exists public.{session_partition}
+        PARTITION OF public.{user_partition} FOR VALUES IN (%s)
+        ''', (session_id,))
+
+
+def create_session_indexes(conn, table: str, user_id: str, session_id: str, staging: bool = False):
+    """
+    table の user_id, session_id のパーティションにインデックスを作成する。
+    staging が True の場合は STAGING_INDEXES のインデックスだけを作成し、作成後に統計情報を更新する
+    """
+    _, session_partition = partition_names(table, user_id, session_id)
+    cursor = conn.cursor()
+    for suffix, definition in (STAGING_INDEXES if staging else INDEXES)[table]:
+        cursor.execute(
+            f"CREATE INDEX IF NOT exists {session_partition}_{suffix} ON public.{session_partition} {definition}")
+    if staging:
+        cursor.execute(f"ANALYZE public.{session_partition}")
+
+
+def _detach_partition(cursor, parent: str, partition: str):
+    """
+    partition が parent のパーティションであれば、CONCURRENTLY で切り離す。
+    以前の切り離しが中断していた (pg_inherits.inhdetachpending が true) 場合は、FINALIZE で完了させる
+    """
+    cursor.execute(
+        "SELECT inhdetachpending FROM pg_inherits WHERE inhrelid = to_regclass(%s) AND inhparent = to_regclass(%s)",
+        (f"public.{partition}", f"public.{parent}"))
+    row = cursor.fetchone()
+    if row is not None:
+        # 他のジョブが実行中でもテーブル全体をロックしないよう、CONCURRENTLY で切り離す
+        cursor.execute(
+            f"ALTER TABLE public.{parent} DETACH PARTITION public.{partition} {'FINALIZE' if row[0] else 'CONCURRENTLY'}")
+
+
+def drop_session_partition(conn, table: str, user_id: str, session_id: str):
+    """
+    table の user_id, session_id のパーティションを切り離して削除する。
+    ユーザーのセッションのパーティションがなくなった場合は、ユーザーのパーティションも切り離して削除する。
+    DETACH PARTITION CONCURRENTLY はトランザクションブロックの中では実行できないので、
+    conn は autocommit の接続を渡すこと (PostgreSQL 14 以降)。
+    """
+    user_partition, session_partition = partition_names(table, user_id, session_id)
+    cursor = conn.cursor()
+    _detach_partition(cursor, user_partition, session_partition)
+    cursor.execute(f"DROP TABLE IF EXISTS public.{session_partition}")
+
+    # 同じユーザーの別のジョブがセッションのパーティションを作成しないよう、
+    # ユーザーのパーティションを削除し終えるまでセッション単位のアドバイザリロックを保持する
+    # (autocommit の接続なので、トランザクション単位のロックでは文ごとに解放されてしまう)
+    cursor.execute("SELECT pg_advisory_lock(hashtext(%s))", (_user_lock_key(user_partition),))
+    try:
+        cursor.execute("SELECT 1 FROM pg_inherits WHERE inhparent = to_regclass(%s)", (f"public.{user_partition}",))
+        if cursor.fetchone() is not None:
+            return
+        _detach_partition(cursor, table, user_partition)
+        cursor.execute(f"DROP TABLE IF EXISTS public.{user_partition}")
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(hashtext(%s))", (_user_lock_key(user_partition),))
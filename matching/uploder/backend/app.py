@@ -7,6 +7,7 @@ from fastapi.responses import JSONResponse
 from functools import lru_cache
 import config
 import datetime
+import json
 
 @lru_cache()
 def get_settings():
@@ -154,20 +155,31 @@ async def get_receipt_request(session_info: RequestSessionInfo):
 
     # batch job submit
     response = {}
-    batch_client = boto3.client('batch')
-
-    response = batch_client.submit_job(
-        jobName = settings.job_name,
-        jobQueue = settings.job_queue,
-        jobDefinition = settings.job_definition,
-        containerOverrides = {
-            'command': ["python","src/main.py"],
-            'environment': [
-                {"name": "ESTATE_ID_USER_ID", "value": session_info.user_id},
-                {"name": "ESTATE_ID_SESSION_ID", "value": session_info.session_id}
-            ]
-        }
-    )
+    if settings.worker_queue_url:
+        # 常駐ワーカーのキューにジョブを送る
+        sqs_client = boto3.client('sqs')
+        response = sqs_client.send_message(
+            QueueUrl = settings.worker_queue_url,
+            MessageBody = json.dumps({
+                "user_id": session_info.user_id,
+                "session_id": session_info.session_id
+            })
+        )
+    else:
+        batch_client = boto3.client('batch')
+
+        response = batch_client.submit_job(
+            jobName = settings.job_name,
+            jobQueue = settings.job_queue,
+            jobDefinition = settings.job_definition,
+            containerOverrides = {
+                'command': ["python","src/main.py"],
+                'environment': [
+                    {"name": "ESTATE_ID_USER_ID", "value": session_info.user_id},
+                    {"name": "ESTATE_ID_SESSION_ID", "value": session_info.session_id}
+                ]
+            }
+        )
 
     # get email address
     obj = get_cognito_mail_address(session_info.user_id)
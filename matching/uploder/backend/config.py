@@ -6,6 +6,8 @@ class Settings(BaseSettings):
     job_name: str
     job_queue: str
     job_definition: str
+    # 常駐ワーカー (matching/batch/src/worker.py) の SQS キューの URL。指定した場合は AWS Batch の代わりにキューに送る
+    worker_queue_url: str = ""
     user_pool_id: str
     ses_source_email_address: str
 